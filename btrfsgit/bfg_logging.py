@@ -1,11 +1,11 @@
 import logging
 import logging.config
 import os
-import argparse
 
 def configure_logging():
 	log_config_file = os.path.join(os.path.dirname(__file__), 'logging.conf')
-	logging.config.fileConfig(log_config_file)
+	# the module loggers exist by now, leave them enabled
+	logging.config.fileConfig(log_config_file, disable_existing_loggers=False)
 	overrides = parse_logging_overrides()
 	update_logging_levels(overrides)
 
@@ -0,0 +1,210 @@
+"""
+listing subvolumes straight from the root tree, with the BTRFS tree search ioctl, instead of parsing `btrfs subvolume list`.
+
+needs CAP_SYS_ADMIN, same as `btrfs subvolume list`.
+"""
+
+import os
+import fcntl
+import struct
+import uuid
+import logging
+
+
+log = logging.getLogger('btrfs_ioctl')
+
+
+BTRFS_IOC_TREE_SEARCH = 0xd0009411 # _IOWR(0x94, 17, struct btrfs_ioctl_search_args)
+BTRFS_IOC_INO_LOOKUP = 0xd0009412 # _IOWR(0x94, 18, struct btrfs_ioctl_ino_lookup_args)
+BTRFS_IOC_FS_INFO = 0x8400941f # _IOR(0x94, 31, struct btrfs_ioctl_fs_info_args)
+BTRFS_FS_INFO_FLAG_GENERATION = 1 << 1
+
+BTRFS_ROOT_TREE_OBJECTID = 1
+BTRFS_FS_TREE_OBJECTID = 5
+BTRFS_FIRST_FREE_OBJECTID = 256
+BTRFS_LAST_FREE_OBJECTID = 2**64 - 256
+BTRFS_ROOT_ITEM_KEY = 132
+BTRFS_ROOT_BACKREF_KEY = 144
+BTRFS_ROOT_SUBVOL_RDONLY = 1
+
+U64_MAX = 2**64 - 1
+U32_MAX = 2**32 - 1
+
+SEARCH_ARGS_SIZE = 4096
+# tree_id, min/max objectid, min/max offset, min/max transid, min/max type, nr_items, 5x unused
+SEARCH_KEY = struct.Struct('<7Q4I4Q')
+# transid, objectid, offset, type, len
+SEARCH_HEADER = struct.Struct('<3Q2I')
+INO_LOOKUP_ARGS = struct.Struct('<QQ4080s')
+# dirid, sequence, name_len
+ROOT_REF = struct.Struct('<QQH')
+FS_INFO_ARGS_SIZE = 1024
+FS_INFO_FSID = 16
+FS_INFO_FLAGS = 48
+FS_INFO_GENERATION = 56
+
+# offsets into struct btrfs_root_item
+ROOT_ITEM_GENERATION = 160
+ROOT_ITEM_FLAGS = 208
+ROOT_ITEM_UUID = 247
+ROOT_ITEM_PARENT_UUID = 263
+ROOT_ITEM_RECEIVED_UUID = 279
+ROOT_ITEM_UUIDS_END = 295
+
+
+class IoctlSource:
+	"""
+	the real thing: an open fd on the filesystem. Anything with the same tree_search and ino_lookup methods can stand in for it.
+	"""
+
+	def __init__(s, path):
+		s.fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+	def close(s):
+		os.close(s.fd)
+
+	def __enter__(s):
+		return s
+
+	def __exit__(s, *args):
+		s.close()
+
+	def tree_search(s, tree_id, min_objectid, max_objectid, min_type, max_type):
+		"""yield (objectid, type, offset, transid, data) for every item in the key range"""
+		objectid, type, offset = min_objectid, min_type, 0
+		while True:
+			buf = bytearray(SEARCH_ARGS_SIZE)
+			SEARCH_KEY.pack_into(buf, 0, tree_id, objectid, max_objectid, offset, U64_MAX, 0, U64_MAX, type, max_type, SEARCH_ARGS_SIZE, 0, 0, 0, 0, 0)
+			fcntl.ioctl(s.fd, BTRFS_IOC_TREE_SEARCH, buf, True)
+			nr_items = SEARCH_KEY.unpack_from(buf, 0)[9]
+			if nr_items == 0:
+				return
+			pos = SEARCH_KEY.size
+			for _ in range(nr_items):
+				transid, objectid, offset, type, length = SEARCH_HEADER.unpack_from(buf, pos)
+				pos += SEARCH_HEADER.size
+				yield objectid, type, offset, transid, bytes(buf[pos:pos + length])
+				pos += length
+			# continue right after the last key we got
+			if offset < U64_MAX:
+				offset += 1
+			elif type < U32_MAX:
+				type, offset = type + 1, 0
+			elif objectid < U64_MAX:
+				objectid, type, offset = objectid + 1, 0, 0
+			else:
+				return
+			if (objectid, type) > (max_objectid, max_type):
+				return
+
+	def fs_info(s):
+		"""filesystem uuid, and the generation of the last committed transaction, if the kernel tells (5.15+). Doesn't need root."""
+		buf = bytearray(FS_INFO_ARGS_SIZE)
+		struct.pack_into('<Q', buf, FS_INFO_FLAGS, BTRFS_FS_INFO_FLAG_GENERATION)
+		fcntl.ioctl(s.fd, BTRFS_IOC_FS_INFO, buf, True)
+		flags, generation = struct.unpack_from('<QQ', buf, FS_INFO_FLAGS)
+		return dict(
+			fsid=str(uuid.UUID(bytes=bytes(buf[FS_INFO_FSID:FS_INFO_FSID + 16]))),
+			generation=generation if flags & BTRFS_FS_INFO_FLAG_GENERATION else None)
+
+	def ino_lookup(s, tree_id, objectid):
+		"""path of directory objectid inside subvolume tree_id, relative to the subvolume, with a trailing slash (or empty)"""
+		buf = bytearray(INO_LOOKUP_ARGS.pack(tree_id, objectid, b''))
+		fcntl.ioctl(s.fd, BTRFS_IOC_INO_LOOKUP, buf, True)
+		return INO_LOOKUP_ARGS.unpack_from(buf)[2].split(b'\0', 1)[0].decode()
+
+
+def _uuid(raw):
+	if raw == bytes(16):
+		return None
+	return str(uuid.UUID(bytes=raw))
+
+
+def parse_root_item(data):
+	generation, = struct.unpack_from('<Q', data, ROOT_ITEM_GENERATION)
+	flags, = struct.unpack_from('<Q', data, ROOT_ITEM_FLAGS)
+	r = dict(generation=generation, ro=bool(flags & BTRFS_ROOT_SUBVOL_RDONLY), local_uuid=None, parent_uuid=None, received_uuid=None)
+	# root items written by very old kernels end before the uuids
+	if len(data) >= ROOT_ITEM_UUIDS_END:
+		r['local_uuid'] = _uuid(data[ROOT_ITEM_UUID:ROOT_ITEM_UUID + 16])
+		r['parent_uuid'] = _uuid(data[ROOT_ITEM_PARENT_UUID:ROOT_ITEM_PARENT_UUID + 16])
+		r['received_uuid'] = _uuid(data[ROOT_ITEM_RECEIVED_UUID:ROOT_ITEM_RECEIVED_UUID + 16])
+	return r
+
+
+def parse_root_ref(data):
+	dirid, _, name_len = ROOT_REF.unpack_from(data)
+	return dirid, data[ROOT_REF.size:ROOT_REF.size + name_len].decode()
+
+
+def fs_info(path):
+	with IoctlSource(path) as source:
+		return source.fs_info()
+
+
+def list_subvolumes(source, cached=None, cached_generation=None):
+	"""
+	one record per subvolume, in the shape that `_make_snapshot_struct_from_sub_list_output_line` produces, plus 'ro', 'generation' and 'backref'. 'path' is relative to the id5 subvolume.
+
+	:param cached: records from an earlier listing, taken at filesystem generation cached_generation. Their paths are reused where nothing that the path depends on has changed since, so that only new and changed subvolumes need path lookups.
+	"""
+	items = {}
+	backrefs = {}
+	for objectid, type, offset, transid, data in source.tree_search(BTRFS_ROOT_TREE_OBJECTID, BTRFS_FS_TREE_OBJECTID, BTRFS_LAST_FREE_OBJECTID, BTRFS_ROOT_ITEM_KEY, BTRFS_ROOT_BACKREF_KEY):
+		if type == BTRFS_ROOT_ITEM_KEY:
+			items[objectid] = parse_root_item(data)
+		elif type == BTRFS_ROOT_BACKREF_KEY:
+			# offset is the subvolume that contains this one
+			backrefs[objectid] = (offset,) + parse_root_ref(data)
+
+	reusable = {}
+	if cached and cached_generation is not None:
+		reusable = {r['subvol_id']: r for r in cached if r.get('backref')}
+
+	paths = {BTRFS_FS_TREE_OBJECTID: ''}
+	result = []
+	for subvol_id, item in items.items():
+		# no backref: id5 itself (we search from 5, to know its generation), internal trees, or a subvolume that is deleted, but not cleaned up yet. `btrfs subvolume list` doesn't show these either
+		if subvol_id not in backrefs:
+			continue
+		path = _resolve_path(source, subvol_id, backrefs, paths, items, reusable, cached_generation)
+		if path is None:
+			continue
+		r = dict(item)
+		r['subvol_id'] = subvol_id
+		r['path'] = path
+		r['backref'] = list(backrefs[subvol_id])
+		result.append(r)
+	log.debug(f'list_subvolumes: {len(result)=}')
+	return result
+
+
+def _resolve_path(source, subvol_id, backrefs, paths, items, reusable, cached_generation):
+	"""
+	follow backrefs up to a subvolume with a known path, then resolve back down. paths is a memo, relative to id5, without a trailing slash.
+
+	A cached path is still good if the backref is the same, the containing subvolume wasn't modified since (a directory could have been renamed in it), and the containing subvolume's own path is still the same.
+	"""
+	chain = []
+	sv = subvol_id
+	while sv not in paths:
+		if sv not in backrefs or sv in chain:
+			return None
+		chain.append(sv)
+		sv = backrefs[sv][0]
+	for sv in reversed(chain):
+		parent_id, dirid, name = backrefs[sv]
+		old = reusable.get(sv)
+		if old and list(old['backref']) == list(backrefs[sv]) and _unchanged(parent_id, paths, items, reusable, cached_generation):
+			paths[sv] = old['path']
+			continue
+		prefix = paths[parent_id] + '/' if paths[parent_id] else ''
+		paths[sv] = prefix + source.ino_lookup(parent_id, dirid) + name
+	return paths[subvol_id]
+
+
+def _unchanged(subvol_id, paths, items, reusable, cached_generation):
+	if subvol_id == BTRFS_FS_TREE_OBJECTID:
+		return items.get(subvol_id, {}).get('generation', 0) <= cached_generation
+	old = reusable.get(subvol_id)
+	return old is not None and items[subvol_id]['generation'] <= cached_generation and paths[subvol_id] == old['path']
@@ -41,26 +41,40 @@ implementation points:
 """
 
 import logging
-from btrfsgit.bfg_logging import configure_logging
-configure_logging()
 logbtrfs = logging.getLogger('btrfs')
 logbfg = logging.getLogger('bfg')
 
 
-from sqlalchemy.orm import undefer
 from pathlib import Path
-from pathvalidate import sanitize_filename
 import sys, os
 import time
+import socket
 import subprocess
-import fire
 import shlex  # python 3.8 required (for shlex.join)
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 from .volwalker import *
 from collections import defaultdict
 import re
 from datetime import datetime
-import btrfsgit.db as db
+import btrfsgit.lazy as lazy
+from btrfsgit import trace
+# sqlalchemy (and psycopg) take longer to import than most commands take to run, and most don't need them
+db = lazy.module('btrfsgit.db')
+pathvalidate = lazy.module('pathvalidate')
+import btrfsgit.btrfs_ioctl as btrfs_ioctl
+import btrfsgit.mounts as mounts
+import btrfsgit.daemon as daemon
+from btrfsgit.scheduler import Scheduler
+from btrfsgit.ssh import SshConnection
+import btrfsgit.remote_agent as remote_agent
+from btrfsgit.remote_agent import AgentClient, AgentError
+from btrfsgit.listing_cache import ListingCache
+import btrfsgit.pump as pump
+import btrfsgit.compression as compression
+import btrfsgit.spool as spool
+from btrfsgit.patch_store import PatchStore, sha256_file
 
 
 def datetime_to_json(o):
@@ -88,6 +102,48 @@ def try_unlink(f):
 		pass
 
 
+def mutates_subvolumes(cmd):
+	"""does this btrfs command line create, delete or change subvolumes"""
+	if len(cmd) < 2 or cmd[0] != 'btrfs':
+		return False
+	if cmd[1] == 'receive':
+		return True
+	if len(cmd) < 3:
+		return False
+	if 'subvolume'.startswith(cmd[1]):
+		return cmd[2] in ('snapshot', 'delete', 'create')
+	if 'property'.startswith(cmd[1]):
+		return cmd[2] == 'set'
+	return False
+
+
+# how much to send over ssh to see how fast the link is, for COMPRESS=auto
+LINK_PROBE_SIZE = 4 << 20
+# paths per btrfs subvolume delete
+DELETE_BATCH = 64
+
+def _no_args(op, args):
+	""" for the ops that take no extra arguments, so that they aren't dropped silently """
+	if args:
+		raise TypeError(f'{op} takes no args, got {args}')
+
+
+# what a run_manifest job can do: op -> f(bfg, subvol, remote path, extra args)
+MANIFEST_OPS = {
+	'update_db': lambda b, subvol, remote, args: _no_args('update_db', args) or b.update_db(subvol),
+	'update_db_remote': lambda b, subvol, remote, args: _no_args('update_db_remote', args) or b.update_db_remote(remote, subvol),
+	'local_commit': lambda b, subvol, remote, args: b.local_commit(subvol, **args),
+	'commit_and_push': lambda b, subvol, remote, args: b.commit_and_push(subvol, remote, **args),
+	'remote_commit_and_pull': lambda b, subvol, remote, args: _no_args('remote_commit_and_pull', args) or b.remote_commit_and_pull(remote, subvol),
+	'prune_local': lambda b, subvol, remote, args: b.prune_local(subvol, **args),
+	'prune_remote': lambda b, subvol, remote, args: b.prune_remote(subvol, remote, **args),
+}
+# the short names that the daemon takes, besides MANIFEST_OPS. prune is prune_remote with a remote, prune_local without
+DAEMON_ALIASES = dict(commit='local_commit', push='commit_and_push', pull='remote_commit_and_pull')
+# default concurrency limits of run_manifest
+MANIFEST_LIMITS = dict(host=1, disk=1, jobs=4)
+
+
 def _prerr(*args, sep=' ', **kwargs):
 	message = sep.join(str(arg) for arg in args)
 	logging.info(message, **kwargs)
@@ -95,12 +151,13 @@ def _prerr(*args, sep=' ', **kwargs):
 
 class Res:
 	"""helper class for passing results of Fire-invoked functions around and making sure they're printed understandably and machine-readably"""
-	def __init__(s, value):
+	def __init__(s, value, **extra):
 		s.val = value
+		s.extra = extra
 	def __repr__(s):
-		return json.dumps({'result':s.val})
+		return json.dumps(dict({'result':s.val}, **s.extra))
 	def __str__(s):
-		return json.dumps({'result':s.val})
+		return json.dumps(dict({'result':s.val}, **s.extra))
 
 
 def prompt(question, dry_run=False):
@@ -142,17 +199,42 @@ def prompt(question, dry_run=False):
 
 class Bfg:
 
-	def __init__(s, sshstr='', YES=False):
+	def __init__(s, sshstr='', YES=False, LISTER='auto', SSH_MULTIPLEX=True, REMOTE_AGENT=True, PRIVILEGED_HELPER=False, LISTING_CACHE=True, DB=None, MRCS='sql', COMPRESS=None, RESUMABLE=False, TRACE=None, PRUNE_WITHOUT_REMOTES=False):
+		"""
+		:param LISTER: how to list subvolumes on the local filesystem: 'ioctl' reads the root tree directly, 'cli' parses `btrfs subvolume list`, 'auto' tries ioctl and falls back to cli.
+		:param SSH_MULTIPLEX: open one ssh master connection, on first use, and run all remote commands and transfers through it.
+		:param REMOTE_AGENT: start a python helper on the other machine, and ask it for metadata in batches, instead of running a command for each query.
+		:param PRIVILEGED_HELPER: sudo once, to start a python helper as root, and run local commands through it, instead of a sudo for each command.
+		:param LISTING_CACHE: keep local subvolume listings on disk (~/.cache/bfg/listings), and reuse them while the filesystem generation doesn't change.
+		:param DB: the snapshot catalog: a SQLAlchemy url, or 'local' for a SQLite catalog in .bfg of the local filesystem. By default, BFG_DB_URL from the environment, or the central postgres. Nobody else writes to a local catalog, so before pruning, bring in what the other machines have with update_db_remote.
+		:param MRCS: where to find the most recent common snapshots for pruning: 'sql' runs the lineage walk inside the database, 'python' loads the lineage and runs VolWalker over it.
+		:param COMPRESS: compress send streams of push and pull on the way: 'zstd', 'lz4', optionally with a level ('zstd:7'), or 'auto', to pick a level that keeps up with the link. Needs the tool on both machines.
+		:param RESUMABLE: spool push and pull streams in checksummed chunks on the receiving side (.bfg_spool next to the snapshots), and only feed btrfs receive once the stream is complete. An interrupted transfer, run again, only sends the chunks that are missing. Needs python3 on both machines, and room for the whole stream.
+		:param PRUNE_WITHOUT_REMOTES: with DB='local', prune even when the catalog knows no filesystem but the local one. Pruning can't see which snapshots the other machines have then, and deletes the common ones that incremental sends need.
+		:param TRACE: write a timeline of the run to this file, as Chrome trace events (chrome://tracing, ui.perfetto.dev): every command with its duration and exit code, listings, the common parent search, transfers with their bytes, db queries and deletes.
+		"""
+		# all the keyword options, before anything else is in locals(), to make an instance for another remote with, see _with_remote
+		options = {k: v for k, v in locals().items() if k not in ('s', 'sshstr')}
 
 		logbfg.debug(f'__init__...')
-
-		# in current implementation, this should only ever hold one value, for the local fs we're working with
-		s._local_fs_id5_mount_point = {}
-		s._remote_fs_id5_mount_point = {}
-		s._local_fs_uuid = {}
+		if TRACE:
+			trace.start(TRACE)
+
+		# path -> id5 mount point, and id5 mount point -> fs uuid, for any number of filesystems
+		s._local_fs_id5_mount_points = {}
+		s._remote_fs_id5_mount_points = {}
+		s._local_fs_uuids = {}
+		s._remote_fs_uuids = {}
+		# 'local'/'remote' -> mounts.MountTable
+		s._mounts = {}
+		s._remote_snapshot_parent_dirs = {}
+		s._prefetched_remote_subvolumes = None
+		# (src, local_uuid) -> path, of every subvol we've listed
+		s._subvol_paths = {}
 
 		s._yes_was_given_on_command_line = YES
 		s._sshstr = sshstr
+		s._ssh = SshConnection(sshstr, SSH_MULTIPLEX)
 		# s._shush_ssh_stderr = shush_ssh_stderr # todo  # , SHUSH_SSH_STDERR=True
 		if sshstr == '':
 			s._remote_str = '(here)'
@@ -160,7 +242,34 @@ class Bfg:
 			s._remote_str = '(on the other machine)'
 		s._local_str = '(here)'
 		s._sudo = ['sudo']
-		s.host = subprocess.check_output(['hostname'], text=True).strip()
+		s._lister = LISTER
+		s._use_agent = REMOTE_AGENT
+		s._agent = None
+		s._use_helper = PRIVILEGED_HELPER
+		s._helper = None
+		s._listing_cache = ListingCache() if LISTING_CACHE else None
+		s._db = DB
+		s._prune_without_remotes = PRUNE_WITHOUT_REMOTES
+		s._mrcs = MRCS
+		s._compress = compression.parse(COMPRESS)
+		s._auto_compress = {}
+		s._resumable = RESUMABLE
+		s._options = options
+		s.host = socket.gethostname()
+
+
+	def _with_remote(s, sshstr):
+		"""a Bfg with the same options, for the other machine at sshstr. The local side (mount points, privileged helper) is shared with us."""
+		b = Bfg(sshstr, **s._options)
+		b._local_fs_id5_mount_points = s._local_fs_id5_mount_points
+		b._local_fs_uuids = s._local_fs_uuids
+		if 'local' in s._mounts:
+			b._mounts['local'] = s._mounts['local']
+		b._helper = s._privileged_helper()
+		b._use_helper = s._use_helper
+		b.host = s.host
+		return b
+
 
 
 	def _yes(s, msg, dry_run=False):
@@ -186,8 +295,7 @@ class Bfg:
 		else:
 			cmd = [str(x) for x in cmd]
 		if s._sshstr != '':
-			ssh = shlex.split(s._sshstr)
-			cmd2 = ssh + s._sudo + cmd
+			cmd2 = s._ssh.argv() + s._sudo + cmd
 			logger.debug(shlex.join(cmd2))
 			return s._cmd(cmd2, die_on_error)
 		else:
@@ -199,14 +307,102 @@ class Bfg:
 			logger = logging.getLogger('btrfs')
 		if not isinstance(c, list):
 			c = shlex.split(c)
-		c = s._sudo + [str(x) for x in c]
-		logger.debug(shlex.join(c))
-		return s._cmd(c, die_on_error)
+		c = [str(x) for x in c]
+		helper = s._privileged_helper()
+		if helper:
+			logger.debug('(helper) ' + shlex.join(c))
+			r = s._helper_cmd(helper, c, die_on_error)
+		else:
+			logger.debug(shlex.join(s._sudo + c))
+			r = s._cmd(s._sudo + c, die_on_error)
+		if mutates_subvolumes(c):
+			s._local_fs_changed(c[-1])
+		return r
+
+
+	def _helper_cmd(s, helper, c, die_on_error):
+		try:
+			with trace.span('cmd', 'cmd', cmd=shlex.join(c), helper=True) as sp:
+				r = helper.call('run', cmd=c)
+				sp.update(exit_code=r['returncode'], bytes=len(r['stdout']))
+		except AgentError as e:
+			# the command didn't run at all, a missing executable for example
+			if die_on_error:
+				_prerr(e)
+				exit(1)
+			return -1
+		if r['returncode'] == 0:
+			return r['stdout']
+		if die_on_error:
+			_prerr(f'Command {c} returned non-zero exit status {r["returncode"]}.')
+			exit(1)
+		else:
+			return -1
+
+
+	def _start_agent(s, argv, what):
+		agent = AgentClient(argv)
+		try:
+			agent.start()
+		except AgentError as e:
+			logbfg.warning(f'could not start {what} ({e}), falling back to a command each time.')
+			return None
+		return agent
+
+
+	def _remote_agent(s):
+		"""the helper on the other machine, started on first use. None if there is no other machine, or the helper can't run there."""
+		if not s._use_agent or s._sshstr == '':
+			return None
+		if s._agent is None:
+			s._agent = s._start_agent(s._ssh.argv() + [shlex.join(s._sudo + ['python3', '-c', remote_agent.BOOTSTRAP])], 'remote agent')
+			s._use_agent = s._agent is not None
+		return s._agent
+
+
+	def _privileged_helper(s):
+		"""the same agent, started here with a single sudo, if PRIVILEGED_HELPER was asked for."""
+		if not s._use_helper:
+			return None
+		if s._helper is None:
+			s._helper = s._start_agent(s._sudo + [sys.executable, '-c', remote_agent.BOOTSTRAP], 'privileged helper')
+			s._use_helper = s._helper is not None
+		return s._helper
+
+
+	def _remote_prefetch(s, subvol, parent_dir=False):
+		"""
+		ask the agent for everything about the other side that the command will need, in one round trip: the mount table (unless we have it), subvolume listing, and optionally the snapshot parent dir for subvol.
+		"""
+		agent = s._remote_agent()
+		if agent is None:
+			return
+		subvol = str(subvol)
+		calls = [('list_subvolumes', dict(path=subvol))]
+		if parent_dir:
+			calls.append(('snapshot_parent_dir', dict(subvol=subvol)))
+		if 'remote' not in s._mounts:
+			calls.append(('run', dict(cmd=['sh', '-c', mounts.SCRIPT])))
+		with trace.span('agent prefetch', 'cmd', calls=[op for op, _ in calls]):
+			results = agent.batch(calls)
+		s._prefetched_remote_subvolumes = results[0]
+		if parent_dir:
+			s._remote_snapshot_parent_dirs[subvol] = results[1]
+		if 'remote' not in s._mounts:
+			s._mounts['remote'] = mounts.MountTable(**mounts.parse_script_output(results[-1]['stdout']))
+
 
 
 	def _cmd(s, c, die_on_error):
 		try:
-			return subprocess.check_output(c, text=True)
+			with trace.span('cmd', 'cmd', cmd=shlex.join(c)) as sp:
+				try:
+					r = subprocess.check_output(c, text=True)
+				except subprocess.CalledProcessError as e:
+					sp['exit_code'] = e.returncode
+					raise
+				sp.update(exit_code=0, bytes=len(r))
+				return r
 		except Exception as e:
 			if die_on_error:
 				_prerr(e)
@@ -220,51 +416,64 @@ class Bfg:
 	determine id5 mount point
 	"""
 
-	def local_fs_id5_mount_point(self, subvolume):
+	def local_fs_id5_mount_point(s, subvolume):
 		subvolume = str(subvolume)
-		# if subvolume not in self._local_fs_id5_mount_points:
-		# 	self._local_fs_id5_mount_points[subvolume] = self.find_local_fs_id5_mount_point(subvolume)
-		# return self._local_fs_id5_mount_points[subvolume]
-		if self._local_fs_id5_mount_point == {}:
-			self._local_fs_id5_mount_point = self.find_local_fs_id5_mount_point(subvolume)
-		return self._local_fs_id5_mount_point
+		if subvolume not in s._local_fs_id5_mount_points:
+			s._local_fs_id5_mount_points[subvolume] = s.find_local_fs_id5_mount_point(subvolume)
+		return s._local_fs_id5_mount_points[subvolume]
 
 
-	def remote_fs_id5_mount_point(self, subvolume):
+	def remote_fs_id5_mount_point(s, subvolume):
 		subvolume = str(subvolume)
-		# if subvolume not in self._remote_fs_id5_mount_points:
-		# 	self._remote_fs_id5_mount_points[subvolume] = self.find_remote_fs_id5_mount_point(subvolume)
-		# return self._remote_fs_id5_mount_points[subvolume]
-		if self._remote_fs_id5_mount_point == {}:
-			self._remote_fs_id5_mount_point = self.find_remote_fs_id5_mount_point(subvolume)
-		return self._remote_fs_id5_mount_point
+		if subvolume not in s._remote_fs_id5_mount_points:
+			s._remote_fs_id5_mount_points[subvolume] = s.find_remote_fs_id5_mount_point(subvolume)
+		return s._remote_fs_id5_mount_points[subvolume]
+
+
+	def _mount_table(s, machine):
+		""" mounts.MountTable of this or the other machine, read once """
+		if machine == 'remote' and s._sshstr == '':
+			machine = 'local'
+		if machine not in s._mounts:
+			if machine == 'local':
+				s._mounts[machine] = mounts.MountTable(**mounts.gather())
+			else:
+				# ssh joins the command into one string for the remote shell
+				s._mounts[machine] = mounts.MountTable(**mounts.parse_script_output(s._remote_cmd(['sh', '-c', shlex.quote(mounts.SCRIPT)])))
+		return s._mounts[machine]
 
 
 	def find_local_fs_id5_mount_point(s, subvolume):
-		dir = Path(subvolume)
+		""" from the nearest .bfg/id5 file up the tree, up to the mount point, if there is one, otherwise from the mount table """
+		table = s._mount_table('local')
+		dir = Path(subvolume).absolute()
+		mount = table.mount_of(dir)
+		# above the mount point is another filesystem, or another mount of this one, which the mount table knows about
+		top = Path(mount['mount_point']) if mount else Path('/')
 		while True:
 			try:
 				fn = dir / '.bfg' / 'id5'
-				logbfg.info(f'find_local_fs_id5_mount_point: {fn=}')
+				logbfg.debug(f'find_local_fs_id5_mount_point: {fn=}')
 				with open(fn, 'r') as f:
 					return Path(f.read().strip())
 			except FileNotFoundError:
-				new_dir = dir.parent
-				if new_dir == dir:
-					raise Exception(f'could not find id5 for local {subvolume}')
-				dir = new_dir
+				if dir == top or dir.parent == dir:
+					break
+				dir = dir.parent
+		id5 = table.resolve(Path(subvolume).absolute())['id5']
+		if id5 is None:
+			raise Exception(f'could not find id5 for local {subvolume}: the top level subvolume is not mounted, and there is no .bfg/id5 file')
+		return Path(id5)
 
 
 	def find_remote_fs_id5_mount_point(s, subvolume):
-		dir = Path(subvolume)
-		while True:
-			r = s._remote_cmd(['cat', dir / '.bfg' / 'id5'], die_on_error=False)
-			if r != -1:
-				return Path(r.strip())
-			new_dir = dir.parent
-			if new_dir == dir:
-				raise Exception(f'could not find id5 for remote {subvolume}, id5 file missing?')
-			dir = new_dir
+		""" from the mount table of the other machine, where .bfg/id5 files at mount points win. A filesystem mounted here is looked up like a local one """
+		if s._sshstr == '':
+			return s.find_local_fs_id5_mount_point(subvolume)
+		id5 = s._mount_table('remote').resolve(subvolume)['id5']
+		if id5 is None:
+			raise Exception(f'could not find id5 for remote {subvolume}: the top level subvolume is not mounted, and there is no .bfg/id5 file')
+		return Path(id5)
 
 
 
@@ -273,12 +482,12 @@ class Bfg:
 	"""
 
 
+	@trace.traced('list subvolumes')
 	def _get_subvolumes(s, command_runner, subvolume, src):
 		"""
 		:param subvolume: filesystem path to a subvolume on the filesystem that we want to get a list of subvolumes of
 		:return: list of records, one for each subvolume on the filesystem
 		"""
-		subvols = []
 		logger = logging.getLogger('_get_subvolumes')
 
 		if src == 'local':
@@ -286,11 +495,83 @@ class Bfg:
 		else:
 			fs = s.remote_fs_id5_mount_point(subvolume)
 
+		subvols = None
+		if src == 'local':
+			subvols = s._list_local_subvolumes(command_runner, fs, subvolume)
+		elif s._remote_agent():
+			subvols = s._list_subvolumes_agent(fs, subvolume)
+		if subvols is None:
+			subvols = s._list_subvolumes_cli(command_runner, fs, subvolume)
+
+		for i in subvols:
+			i['src'] = src + '_' + i['src']
+			logger.debug(i)
+			# we should not need this for remote subvolumes:
+			if src == 'local':
+				i['host'] = s.host
+				i['fs_uuid'] = s.local_fs_uuid(subvolume)
+			if '.bfg_snapshots' in i['path'].parts:
+				i['dt'] = s.snapshot_dt(i)
+
+		subvols.sort(key=lambda sv: -sv['subvol_id'])
+		for i in subvols:
+			s._subvol_paths[(src, i['local_uuid'])] = i['path']
+		trace.annotate(src=src, fs=str(fs), count=len(subvols))
+		logbfg.info(f'_get_subvolumes: {len(subvols)=}')
+		return subvols
+
+
+	def _list_local_subvolumes(s, command_runner, fs, subvolume):
+		"""
+		from the listing cache, if the filesystem generation hasn't moved since. Otherwise with the ioctl (reusing what it can of the cached listing) or the cli, and cache that.
+		"""
+		info = s._local_fs_info(subvolume)
+		cached = None
+		if info and s._listing_cache:
+			cached = s._listing_cache.load(info['fsid'])
+		if cached and not cached['stale'] and info['generation'] is not None and cached['generation'] == info['generation']:
+			logbtrfs.info(f'listing cache hit, generation {info["generation"]}')
+			subvols = cached['subvols']
+			for i in subvols:
+				i['path'] = fs / i['path']
+				i['src'] = 'cache'
+			return subvols
+
+		subvols = None
+		if s._lister != 'cli':
+			subvols = s._list_subvolumes_ioctl(fs, subvolume, cached)
+		if subvols is None:
+			subvols = s._list_subvolumes_cli(command_runner, fs, subvolume)
+		if info and s._listing_cache and info['generation'] is not None:
+			s._listing_cache.store(info['fsid'], info['generation'], [dict(i, path=str(i['path'].relative_to(fs))) for i in subvols])
+		return subvols
+
+
+	def _local_fs_info(s, path):
+		try:
+			return btrfs_ioctl.fs_info(str(path))
+		except OSError as e:
+			logbtrfs.debug(f'fs_info ioctl not available for {path}: {e}')
+			return None
+
+
+	def _local_fs_changed(s, path):
+		"""we've created/deleted/received a subvolume around path, so the cached listing of its filesystem can't be trusted, even if the generation didn't move yet."""
+		if not s._listing_cache:
+			return
+		path = Path(path)
+		while not path.exists() and path.parent != path:
+			path = path.parent
+		info = s._local_fs_info(path)
+		s._listing_cache.invalidate(info['fsid'] if info else None)
+
+
+	def _list_subvolumes_cli(s, command_runner, fs, subvolume):
+		subvols = []
 		cmd = ['btrfs', 'subvolume', 'list', '-q', '-t', '-R', '-u']
 		for line in command_runner(cmd + [subvolume], logger=logbtrfs).splitlines()[2:]:
 			subvol = s._make_snapshot_struct_from_sub_list_output_line(fs, line)
-			subvol['src'] = src + '_btrfs'
-			logger.debug(subvol)
+			subvol['src'] = 'btrfs'
 			subvols.append(subvol)
 
 		ro_subvols = set()
@@ -301,54 +582,63 @@ class Bfg:
 
 		for i in subvols:
 			i['ro'] = i['local_uuid'] in ro_subvols
-			# we should not need this for remote subvolumes:
-			if src == 'local':
-				i['host'] = s.host
-				i['fs_uuid'] = s.local_fs_uuid(subvolume)
-			if '.bfg_snapshots' in i['path'].parts:
-				i['dt'] = s.snapshot_dt(i)
+		return subvols
 
-		subvols.sort(key=lambda sv: -sv['subvol_id'])
-		logbfg.info(f'_get_subvolumes: {len(subvols)=}')
+
+	def _list_subvolumes_ioctl(s, fs, subvolume, cached=None):
+		"""
+		read the root tree directly, in one pass, without forking anything. Returns None if that's not possible here (not root, not btrfs..), unless LISTER='ioctl' was asked for explicitly.
+		"""
+		try:
+			with btrfs_ioctl.IoctlSource(str(subvolume)) as source:
+				if cached:
+					subvols = btrfs_ioctl.list_subvolumes(source, cached['subvols'], cached['generation'])
+				else:
+					subvols = btrfs_ioctl.list_subvolumes(source)
+		except OSError as e:
+			if s._lister == 'ioctl':
+				raise
+			logbtrfs.info(f'tree search ioctl not available ({e}), falling back to btrfs subvolume list')
+			return None
+		for i in subvols:
+			i['path'] = fs / i['path']
+			i['src'] = 'ioctl'
+		return subvols
+
+
+	def _list_subvolumes_agent(s, fs, subvolume):
+		subvols = s._prefetched_remote_subvolumes
+		# a prefetched listing is only good until we change something
+		s._prefetched_remote_subvolumes = None
+		if subvols is None:
+			subvols = s._remote_agent().call('list_subvolumes', path=str(subvolume))
+		for i in subvols:
+			i['path'] = fs / i['path']
+			i['src'] = 'agent'
 		return subvols
 
 
 	def _make_snapshot_struct_from_sub_list_output_line(s, fs, line):
 		#logging.debug('line:'+line)
-		items = line.split()
-		subvol_id = items[0]
-		parent_uuid = dash_is_none(items[3])
-		received_uuid = dash_is_none(items[4])
-		local_uuid = items[5]
-
-		snapshot = {}
-		snapshot['received_uuid'] = received_uuid
-		snapshot['parent_uuid'] = parent_uuid
-		snapshot['local_uuid'] = local_uuid
-		snapshot['subvol_id'] = int(subvol_id)
-		snapshot['path'] = fs / items[6]
+		snapshot = remote_agent.parse_sub_list_line(line)
+		snapshot['path'] = fs / snapshot['path']
 		logging.debug(snapshot)
 
 		return snapshot
 
 
-	def local_fs_uuid(self, subvol):
-		subvol = str(subvol)
-		# if subvol not in self._local_fs_uuid:
-		# 	self._local_fs_uuid[subvol] = self.get_fs_uuid(subvol)
-		# # check that all values are the same, because we should only be working with one local filesystem
-		# if not all([x == self._local_fs_uuid[subvol] for x in self._local_fs_uuid.values()]):
-		# 	raise Exception(f'weird, local_fs_uuids are not the same: {self._local_fs_uuid}')
-		# return self._local_fs_uuid[subvol]
-		if self._local_fs_uuid == {}:
-			self._local_fs_uuid = self.get_fs_uuid(subvol)
-		return self._local_fs_uuid
+	def local_fs_uuid(s, subvol):
+		mp = s.local_fs_id5_mount_point(subvol)
+		if str(mp) not in s._local_fs_uuids:
+			fs_uuid = s._mount_table('local').resolve(mp)['fs_uuid']
+			if fs_uuid is None:
+				fs_uuid = s.get_fs_uuid(subvol)
+			s._local_fs_uuids[str(mp)] = fs_uuid
+		return s._local_fs_uuids[str(mp)]
 
 
 	def fs_uuid_from_fs_show_output(self, output):
-		line = output.splitlines()[0]
-		r = r"Label:\s+.*\s+uuid:\s+([a-f0-9-]+)$"
-		fs_uuid = re.match(r, line).group(1)
+		fs_uuid = remote_agent.parse_fs_show(output)
 		logbfg.info(f'get_fs: {fs_uuid=}')
 		return fs_uuid
 
@@ -356,8 +646,16 @@ class Bfg:
 	def remote_fs_uuid(s, subvol):
 		logbfg.info(f'remote_fs_uuid {subvol=}')
 		mp = s.remote_fs_id5_mount_point(subvol)
-		uuid = s.fs_uuid_from_fs_show_output(s._remote_cmd(f'btrfs filesystem show ' + str(mp)))
-		return uuid, mp
+		if str(mp) not in s._remote_fs_uuids:
+			fs_uuid = s._mount_table('remote').resolve(mp)['fs_uuid']
+			if fs_uuid is None:
+				agent = s._remote_agent()
+				if agent:
+					fs_uuid = agent.call('fs_uuid', path=str(mp))
+				else:
+					fs_uuid = s.fs_uuid_from_fs_show_output(s._remote_cmd(f'btrfs filesystem show ' + str(mp)))
+			s._remote_fs_uuids[str(mp)] = fs_uuid
+		return s._remote_fs_uuids[str(mp)], mp
 
 
 	def get_fs_uuid(s, subvol):
@@ -366,15 +664,10 @@ class Bfg:
 
 
 	def get_subvol(s, runner, path):
-		out = runner(f'btrfs sub show {path}')
-		lines = out.splitlines()
-
-		sv = {}
-		sv['received_uuid'] = dash_is_none(lines[4].split()[2])
-		sv['parent_uuid'] = dash_is_none(lines[3].split()[2])
-		sv['local_uuid'] = lines[2].split()[1]
-		sv['subvol_id'] = int(lines[6].split()[2])
-		sv['ro'] = lines[11].split()[1] == 'readonly'
+		if runner == s._remote_cmd and s._remote_agent():
+			sv = s._remote_agent().call('sub_show', path=str(path))
+		else:
+			sv = remote_agent.parse_sub_show(runner(f'btrfs sub show {path}'))
 		sv['src'] = 'btrfs_sub_show'
 
 		r = Res(sv)
@@ -386,62 +679,95 @@ class Bfg:
 	db stuff
 	"""
 
+	def _configure_db(s, subvol):
+		if s._db == 'local':
+			db.configure(db.sqlite_url(s.local_fs_id5_mount_point(subvol) / '.bfg' / 'catalog.sqlite'))
+		elif s._db:
+			db.configure(s._db)
+
+
+	@trace.traced('update_db', 'db')
 	def update_db(s, FS):
 		"""
-		blast the db with all the subvols we can find on the filesystem.
+		sync the db with all the subvols we can find on the filesystem: insert new ones, update changed ones, and mark the ones that are gone as deleted, in one transaction.
+		"""
+		s._configure_db(FS)
+		s._sync_db(s.local_fs_uuid(FS), FS, s.get_all_subvols_on_filesystem(FS).val)
+
+
+	@trace.traced('update_db_remote', 'db')
+	def update_db_remote(s, REMOTE_FS, FS='/'):
+		"""
+		like update_db, for the filesystem at REMOTE_FS on the other machine. For a catalog that only this machine writes to (DB='local'), so that pruning here knows what the other side has.
+		:param FS: with DB='local', the local filesystem whose catalog it goes into
 		"""
-		snapshots = s.get_all_subvols_on_filesystem(FS).val
+		s._configure_db(FS)
+		s._remote_prefetch(REMOTE_FS)
+		fs_uuid, mp = s.remote_fs_uuid(REMOTE_FS)
+		host = s.host if s._sshstr == '' else s._remote_cmd(['hostname']).strip()
+		snapshots = s._get_subvolumes(s._remote_cmd, mp, 'remote')
+		for snapshot in snapshots:
+			snapshot['fs_uuid'] = fs_uuid
+			snapshot['id'] = fs_uuid + '_' + snapshot['local_uuid']
+			snapshot['host'] = host
+		s._sync_db(fs_uuid, REMOTE_FS, snapshots)
+
+
+	def _sync_db(s, fs_uuid, fs, snapshots):
+		for snapshot in snapshots:
+			snapshot['fs'] = str(fs)
+			snapshot['path'] = str(snapshot['path'])
 		logbfg.info(f'db.session()...')
 		session = db.session()
 		with session.begin():
 			logbfg.info(f'got db session...')
+			logbfg.info(f'sync snapshots with {fs_uuid=}...')
+			new, changed, vanished = db.sync_snapshots(session, fs_uuid, snapshots)
+			logbfg.info(f'{new} new, {changed} changed, {vanished} gone. commit...')
 
-			logbfg.info(f'purge db of all snapshots with fs_uuid={s.local_fs_uuid(FS)}...')
-			session.query(db.Snapshot).filter(db.Snapshot.fs_uuid == s.local_fs_uuid(FS)).delete()
-
-			logbfg.info(f'insert snapshots into db...')
-			for i,snapshot in enumerate(snapshots):
-				if i % 100 == 0:
-					logbfg.info(f'{i=}')
-				logbfg.debug(f'{snapshot=}')
-				db_snapshot = db.Snapshot(
-					id=snapshot['fs_uuid']+'_'+snapshot['local_uuid'],
-					local_uuid=snapshot['local_uuid'],
-					parent_uuid=snapshot['parent_uuid'],
-					received_uuid=snapshot['received_uuid'],
-					host=snapshot['host'],
-					fs=str(FS),
-					path=str(snapshot['path']),
-					fs_uuid=snapshot['fs_uuid'],
-					subvol_id=snapshot['subvol_id'],
-					ro=snapshot['ro'],
-				)
-				session.add(db_snapshot)
-			logbfg.info(f'commit...')
-
-
-	def all_subvols_from_db(s):
-		logbfg.info(f'all_snapshots_from_db...')
+
+	def _check_catalog_for_pruning(s, subvol):
+		""" a local catalog that has never seen the other machines would have pruning delete the common snapshots """
+		if s._db != 'local' or s._prune_without_remotes:
+			return
 		session = db.session()
 		with session.begin():
-			logbfg.info(f'got db session.')
-			logbfg.info(f'query all snapshots from db...')
-			all = list(session.query(db.Snapshot).options(undefer("*")).all())
+			others = db.fs_uuids(session) - {s.local_fs_uuid(subvol)}
+		if not others:
+			raise Exception(f'the local catalog knows no filesystem but the one of {subvol}, so pruning would delete the snapshots that the other machines have in common with it. Run update_db_remote for each of them first, or pass PRUNE_WITHOUT_REMOTES=True if there are none.')
 
-			r = [{
-				column.name: getattr(x, column.name)
-				for column in x.__table__.columns} for x in all]
-
-			for x in r:
-				x['path'] = Path(x['path'])
-				if '.bfg_snapshots' in x['path'].parts:
-					x['dt'] = s.snapshot_dt(x)
-				x['src'] = 'db'
 
+	@trace.traced('all_subvols_from_db', 'db')
+	def all_subvols_from_db(s, SUBVOL=None):
+		"""
+		the live snapshots in the db. With SUBVOL, only its lineage: the snapshots that are connected to it by parent/received uuids, on any filesystem, which is all that most_recent_common_snapshots and pruning need.
+		"""
+		logbfg.info(f'all_snapshots_from_db...')
+		session = db.session()
+		with session.begin():
+			logbfg.info(f'got db session.')
+			if SUBVOL is None:
+				logbfg.info(f'query all snapshots from db...')
+				rows = db.iter_snapshots(session)
+			else:
+				uuid = s.get_subvol(s._local_cmd, SUBVOL).val['local_uuid']
+				logbfg.info(f'query lineage of {uuid} from db...')
+				rows = db.lineage(session, uuid)
+			r = [s._snapshot_from_db(row) for row in rows]
+			trace.annotate(count=len(r))
 			logbfg.info(f'got {len(r)} snapshots from db.')
 			return r
 
 
+	def _snapshot_from_db(s, row):
+		x = row._asdict()
+		x['path'] = Path(x['path'])
+		if '.bfg_snapshots' in x['path'].parts:
+			x['dt'] = s.snapshot_dt(x)
+		x['src'] = 'db'
+		return x
+
+
 	def remote_fs_uuids(s, all, subvol):
 		""" remote fs uuids by db """
 		logbfg.info(f'remote_fs_uuids...')
@@ -451,7 +777,7 @@ class Bfg:
 			if snap_fs_uuid not in fss:
 				fss[snap_fs_uuid] = {'hosts': set()}
 			fss[snap_fs_uuid]['hosts'].add(snap['host'])
-		del fss[s.local_fs_uuid(subvol)]
+		fss.pop(s.local_fs_uuid(subvol), None)
 		return fss
 
 
@@ -556,7 +882,12 @@ class Bfg:
 		else:
 			runner = s._remote_cmd
 
-		if runner(['test', '-e', str(SUBVOL)], die_on_error=False, logger=logger) == -1:
+		if machine != 'local' and str(SUBVOL) in s._remote_snapshot_parent_dirs:
+			snapshot_parent_dir = s._remote_snapshot_parent_dirs[str(SUBVOL)]
+		elif machine != 'local' and s._remote_agent():
+			snapshot_parent_dir = s._remote_agent().call('snapshot_parent_dir', subvol=str(SUBVOL))
+			s._remote_snapshot_parent_dirs[str(SUBVOL)] = snapshot_parent_dir
+		elif runner(['test', '-e', str(SUBVOL)], die_on_error=False, logger=logger) == -1:
 			# we assume that if the target filesystem is mounted. This implies that if we're transferring the root subvol, the directory exists. This is the only case where the snapshot parent dir will be inside the subvol, rather than outside. Therefore, if the destination does not exist (as a directory or subvolume), it is safe to assume that it is not the root subvolume.
 			snapshot_parent_dir = parent
 		else:
@@ -593,7 +924,7 @@ class Bfg:
 
 			tss = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
 			# tss = subprocess.check_output(['date', '-u', "+%Y-%m-%d_%H-%M-%S"], text=True).strip()
-			ts = sanitize_filename(tss.replace(' ', '_'))
+			ts = pathvalidate.sanitize_filename(tss.replace(' ', '_'))
 
 			if TAG is None:
 				TAG = 'from_' + s.host
@@ -640,27 +971,124 @@ class Bfg:
 
 	def commit_and_generate_patch(s, SUBVOL='/', PATCH_FILE_DIR='/', PARENT: Optional[str]=None):
 		"""
-		store a `btrfs send` stream locally
+		snapshot SUBVOL, and keep a `btrfs send` stream of the snapshot in the patch store at PATCH_FILE_DIR (see patch_store.py), compressed with COMPRESS (by default zstd, if it's installed). Take the directory to another machine, and apply_patches there.
 
-		:param SUBVOL:
-		:param PATCH_FILE_DIR:
-		:param PARENTS:
-		:return:
+		:param PARENT: send against this snapshot. By default, the newest snapshot of SUBVOL that is in the store already, and still exists here, or nothing, for a full stream.
+		:return: the patch file
 		"""
+		store = PatchStore(PATCH_FILE_DIR)
+		os.makedirs(PATCH_FILE_DIR, exist_ok=True)
+		subvol_uuid = s.get_subvol(s._local_cmd, SUBVOL).val['local_uuid']
+		if PARENT is None:
+			PARENT = s._newest_stored_snapshot(store, SUBVOL, subvol_uuid)
+		parent_uuid = s.get_subvol(s._local_cmd, PARENT).val['local_uuid'] if PARENT else None
+
 		snapshot = s.local_commit(SUBVOL).val
-		# print(Path(snapshot).parts[-2:])
-		fn = PATCH_FILE_DIR + '/' + '__'.join(Path(snapshot).parts[-2:])
-		# print(fn)
-		s.local_send(snapshot, ' > ' + fn, PARENT)
-		_prerr(f'DONE, generated patch \n\tfrom {snapshot} \n\tinto {fn}\n.')
-		return Res(fn)
+		snapshot_uuid = s.get_subvol(s._local_cmd, snapshot).val['local_uuid']
+		codec = s._patch_codec()
+		fn = store.file_name(Path(snapshot).name, snapshot_uuid, parent_uuid, codec and codec[0])
+		path = os.path.join(PATCH_FILE_DIR, fn)
+		transfer = s.local_send(snapshot, None, PARENT, path=path + '.part', codec=codec)
+		os.replace(path + '.part', path)
+		patch = store.add(fn, snapshot_uuid, parent_uuid, subvol_uuid, Path(snapshot).name, codec and codec[0])
+		_prerr(f'DONE, generated patch \n\tfrom {snapshot} \n\tagainst {PARENT} \n\tinto {path}\n.')
+		return Res(path, patch=patch, transfer=transfer)
+
+
+	def _newest_stored_snapshot(s, store, SUBVOL, subvol_uuid):
+		""" path of the newest snapshot of subvol_uuid that has a patch in store, and still exists here """
+		stored = [p for p in store.load() if p['subvol_uuid'] == subvol_uuid]
+		if not stored:
+			return None
+		here = {r['local_uuid']: r for r in s._get_subvolumes(s._local_cmd, SUBVOL, 'local')}
+		for p in sorted(stored, key=lambda p: p['created'], reverse=True):
+			r = here.get(p['snapshot_uuid'])
+			if r is not None:
+				# the listing has absolute paths already
+				return str(r['path'])
+		return None
+
+
+	def _patch_codec(s):
+		if s._compress not in (None, 'auto'):
+			return s._compress
+		if shutil.which('zstd'):
+			return 'zstd', compression.CODECS['zstd']['default_level']
+		return None
+
+
+	def apply_patches(s, TARGET_DIR, PATCH_FILE_DIR, SNAPSHOT=None, DRY_RUN=False):
+		"""
+		receive into TARGET_DIR the cheapest chain of patches from the store at PATCH_FILE_DIR that recreates SNAPSHOT, starting from the snapshots that the filesystem of TARGET_DIR has already.
+
+		:param SNAPSHOT: uuid or name of the snapshot to bring TARGET_DIR up to. By default, the newest one in the store.
+		:return: the names of the snapshots received
+		"""
+		store = PatchStore(PATCH_FILE_DIR)
+		patches = store.load()
+		if SNAPSHOT is None:
+			goal = store.newest(patches=patches)
+		else:
+			goal = ([p for p in patches if SNAPSHOT in (p['snapshot_uuid'], p['name'])] or [None])[0]
+		if goal is None:
+			_prerr(f'no patch for {SNAPSHOT or "anything"} in {PATCH_FILE_DIR}')
+			return -1
+
+		s._local_cmd(['mkdir', '-p', str(TARGET_DIR)])
+		have = set()
+		for r in s._get_subvolumes(s._local_cmd, TARGET_DIR, 'local'):
+			if r['ro']:
+				have.add(r['local_uuid'])
+				if r['received_uuid']:
+					have.add(r['received_uuid'])
+		chain = store.chain(have, goal['snapshot_uuid'], patches)
+		if chain is None:
+			_prerr(f'no chain of patches leads to {goal["name"]} from what {TARGET_DIR} has')
+			return -1
+		_prerr(f'{len(chain)} patches, {pump.human_size(sum(p["size"] for p in chain))}: ' + ', '.join(p['file'] for p in chain))
+		if DRY_RUN:
+			return Res([p['name'] for p in chain])
+
+		for p in chain:
+			path = store.path(p)
+			if sha256_file(path) != p['sha256']:
+				raise Exception(f'{path} is damaged, checksum mismatch')
+			read = compression.decompress_cmd(p['codec']) + [path] if p['codec'] else ['cat', path]
+			pump.chain([read, s._sudo + ['btrfs', 'receive', str(TARGET_DIR)]])
+			_prerr(f'applied {p["file"]}')
+		s._local_fs_changed(TARGET_DIR)
+		return Res([p['name'] for p in chain])
+
+
+	def gc_patches(s, PATCH_FILE_DIR, DRY_RUN=False):
+		"""
+		delete the patches in the store at PATCH_FILE_DIR that no target needs anymore: those that are on no cheapest chain to the newest snapshot of their subvolume.
+		"""
+		store = PatchStore(PATCH_FILE_DIR)
+		superseded = store.superseded()
+		for p in superseded:
+			_prerr(f'superseded: {p["file"]} ({pump.human_size(p["size"])})')
+		if not superseded or DRY_RUN:
+			return Res([p['file'] for p in superseded])
+		if not s._yes(f'delete {len(superseded)} patches?'):
+			return Res([])
+		store.remove(superseded)
+		_prerr(f'deleted {len(superseded)} patches, {pump.human_size(sum(p["size"] for p in superseded))}.')
+		return Res([p['file'] for p in superseded])
 
 
 	def commit_and_push(s, SUBVOL, REMOTE_SUBVOL, SNAPSHOT_TAG=None, SNAPSHOT_PATH=None, SNAPSHOT_NAME=None,
 						PARENT=None, CLONESRCS: List[str] = []):
 		"""commit, and transfer the snapshot into .bfg_snapshots on the other machine"""
 		snapshot = s.local_commit(SUBVOL, SNAPSHOT_TAG, SNAPSHOT_PATH, SNAPSHOT_NAME).val
-		return Res(s.push(SUBVOL, snapshot, REMOTE_SUBVOL, PARENT, CLONESRCS).val)
+		return s.push(SUBVOL, snapshot, REMOTE_SUBVOL, PARENT, CLONESRCS)
+
+
+
+	def commit_and_push_many(s, SUBVOL, TARGETS, SNAPSHOT_TAG=None, SNAPSHOT_PATH=None, SNAPSHOT_NAME=None):
+		"""commit, and transfer the snapshot to each of TARGETS, see push_many"""
+		snapshot = s.local_commit(SUBVOL, SNAPSHOT_TAG, SNAPSHOT_PATH, SNAPSHOT_NAME).val
+		return s.push_many(SUBVOL, snapshot, TARGETS)
 
 
 
@@ -714,10 +1142,10 @@ class Bfg:
 		subvols = s._get_subvolumes(s._local_cmd, s.local_fs_id5_mount_point(subvol), 'local')
 		logger.debug(f'{subvols=}')
 
-		snapshots = []
+		fs_uuid = s.local_fs_uuid(subvol)
 		for subvol in subvols:
 			logger.debug(f'{subvol=}')
-			subvol['fs_uuid'] = s._local_fs_uuid
+			subvol['fs_uuid'] = fs_uuid
 			subvol['id'] = subvol['fs_uuid'] + '_' + subvol['local_uuid']
 			subvol['host'] = s.host
 
@@ -807,7 +1235,7 @@ class Bfg:
 
 
 
-	def prune_local(s, SUBVOL, DRY_RUN=False):
+	def prune_local(s, SUBVOL, DRY_RUN=False, COMMIT=None):
 		"""
 		Prune old snapshots under SUBVOL according to a time-based retention policy.
 
@@ -819,98 +1247,262 @@ class Bfg:
 		6) For snapshots < 1 month old (~30 days), keep one per day.
 		7) For snapshots >= 1 month old, keep one per month.
 		8) Delete everything else.
-		"""
 
-		logbfg.info(f"Pruning snapshots for {SUBVOL=}")
-		s._subvol_uuid = s.get_subvol(s._local_cmd, SUBVOL).val['local_uuid']
-		all = s.all_subvols_from_db()
-		mrcs = set([x['path'] for x in s.most_recent_common_snapshots(all, SUBVOL)])
-		logbfg.info(f"{mrcs=}")
-
-		local_snapshots = s.local_bfg_snapshots(all, SUBVOL)
-		local_snapshots = sorted(local_snapshots, key=lambda x: x['dt'])
-
-		if len(local_snapshots) == 0:
-			logbfg.info(f"No snapshots found for {SUBVOL}")
-			return
+		The whole delete set is shown and confirmed once, then deleted in batches.
+		:param COMMIT: wait for the deleted subvolumes to be cleaned up: 'after' the last batch, or after 'each' batch. By default, don't wait.
+		"""
+		return s._prune({'local': (s, 'local', s._plan_prune_local(SUBVOL))}, DRY_RUN, COMMIT)
 
-		newest = local_snapshots[-1]['path']
 
-		buckets = s.put_snapshots_into_buckets(local_snapshots)
+	def prune_remote(s, LOCAL_SUBVOL, REMOTE_SUBVOL, DRY_RUN=False, COMMIT=None):
+		"""prune snapshots of LOCAL_SUBVOL on the other machine, under REMOTE_SUBVOL, with the policy of prune_local"""
+		return s._prune({'remote': (s, 'remote', s._plan_prune_remote(LOCAL_SUBVOL, REMOTE_SUBVOL))}, DRY_RUN, COMMIT)
 
-		for bucket, snaplist in buckets.items():
-			logbfg.info(f"Bucket: {bucket}")
 
-			for i,snap in enumerate(snaplist):
-				path = snap['path']
+	def prune(s, SUBVOL, REMOTE_SUBVOL, DRY_RUN=False, COMMIT=None):
+		"""prune_local and prune_remote in one go: both delete sets are worked out first, confirmed together, and deleted concurrently"""
+		return s._prune({'local': (s, 'local', s._plan_prune_local(SUBVOL)), 'remote': (s, 'remote', s._plan_prune_remote(SUBVOL, REMOTE_SUBVOL))}, DRY_RUN, COMMIT)
 
-				is_newest = path == newest
-				is_mrc = path in mrcs
-				is_last = i == len(snaplist) - 1
-				is_prunable = not is_newest and not is_mrc and not is_last
 
-				flags = ''
-				if is_mrc:
-					flags += ' (mrc)'
-				if is_newest:
-					flags += ' (newest)'
-				if is_last:
-					flags += ' (last)'
-				if is_prunable:
-					flags += ' (prunable)'
-				logbfg.info(f"  {path}{flags}")
+	def prune_all(s, FS='/', REMOTES=[], DRY_RUN=False, COMMIT=None, PLAN_FILE=None):
+		"""
+		prune every subvolume on the filesystem FS that has bfg snapshots, here and on each of REMOTES, with the policy of prune_local. The catalog is loaded once, and the most recent common snapshots of all subvolumes come from one shared lineage index, so run update_db first, here and on the remotes (or update_db_remote from here, with DB='local').
+		The plan is returned (and written to PLAN_FILE, as json) before anything is deleted; it's confirmed once, and then each machine deletes its part concurrently.
+		:param REMOTES: the other machines, as 'SSHSTR:PATH', with PATH anywhere on the filesystem that has the snapshots
+		"""
+		remotes = {f'{sshstr}:{path}': (s._with_remote(sshstr), path) for sshstr, path in s._parse_targets(REMOTES)}
+		plan = s._plan_prune_all(FS, remotes)
+		if PLAN_FILE:
+			with open(PLAN_FILE, 'w') as f:
+				json.dump(plan, f, indent=1)
+		jobs = defaultdict(list)
+		for subvol in plan['subvolumes']:
+			jobs['local'].extend(subvol['local'])
+			for target, paths in subvol['remotes'].items():
+				jobs[target].extend(paths)
+		machines = dict(local=(s, 'local'), **{target: (b, 'remote') for target, (b, path) in remotes.items()})
+		r = s._prune({target: machines[target] + (paths,) for target, paths in jobs.items()}, DRY_RUN, COMMIT)
+		return Res(plan, deleted=r.val, **r.extra)
+
+
+	def _plan_prune_all(s, FS, remotes):
+		"""
+		:param remotes: {target: (bfg, path)}
+		:return: {fs, fs_uuid, subvolumes: [{subvol, uuid, mrcs: {fs_uuid: path}, local: [path], remotes: {target: [path]}}]}
+		"""
+		s._configure_db(FS)
+		s._check_catalog_for_pruning(FS)
+		fs_uuid = s.local_fs_uuid(FS)
+		all = s.all_subvols_from_db()
+		by_uuid = {x['local_uuid']: x for x in all}
+		index = LineageIndex(by_uuid)
+		walker = VolWalker(by_uuid, index=index)
+
+		snapshots_of = defaultdict(list)
+		for x in all:
+			if x['fs_uuid'] == fs_uuid and not x['deleted'] and '.bfg_snapshots' in x['path'].parts:
+				snapshots_of[x['parent_uuid']].append(x)
+		managed = [by_uuid[u] for u in snapshots_of if u in by_uuid and by_uuid[u]['fs_uuid'] == fs_uuid and not by_uuid[u]['deleted']]
+		logbfg.info(f'{len(managed)} subvolumes with snapshots on {fs_uuid}')
+
+		# what each remote has, listed once, by the local snapshot it was received from
+		received = {}
+		for target, (b, path) in remotes.items():
+			b._remote_prefetch(path)
+			_, mp = b.remote_fs_uuid(path)
+			by_received = defaultdict(list)
+			for x in b._get_subvolumes(b._remote_cmd, mp, 'remote'):
+				if x['received_uuid'] and '.bfg_snapshots' in x['path'].parts:
+					by_received[x['received_uuid']].append(x)
+			received[target] = by_received
+
+		subvolumes = []
+		for subvol in sorted(managed, key=lambda x: str(x['path'])):
+			uuid = subvol['local_uuid']
+			logbfg.info(f"planning {subvol['path']}")
+			mrcs = {remote_fs: candidates[0] for remote_fs, candidates in sorted(walker.walk_filesystems(uuid, fs_uuid).items())}
+			mrc_uuids = set(x['local_uuid'] for x in mrcs.values())
+			local = s._prunable(snapshots_of[uuid], set(x['path'] for x in mrcs.values()))
+			remote_plans = {}
+			for target, by_received in received.items():
+				theirs = [r for x in snapshots_of[uuid] for r in by_received.get(x['local_uuid'], ())]
+				their_mrcs = set(r['path'] for u in mrc_uuids for r in by_received.get(u, ()))
+				remote_plans[target] = s._prunable(theirs, their_mrcs)
+			subvolumes.append(dict(subvol=str(subvol['path']), uuid=uuid, mrcs={k: str(v['path']) for k, v in mrcs.items()}, local=local, remotes=remote_plans))
+		return dict(fs=str(FS), fs_uuid=fs_uuid, subvolumes=subvolumes)
+
+
+	def run_manifest(s, MANIFEST, PER_HOST=None, PER_DISK=None, JOBS=None, DRY_RUN=False):
+		"""
+		run the jobs listed in the json file MANIFEST, concurrently, in one process: jobs for the same machine share its ssh connection, and all of them share the local mount table, the privileged helper and the catalog connection. Each job lists the other machine itself.
+		{"limits": {"host": 1, "disk": 1, "jobs": 4}, "jobs": [{"op": "commit_and_push", "subvol": "/data", "remote": "nas:/backup/data", "args": {}}, ...]}
+		op is one of MANIFEST_OPS. remote is 'SSHSTR:PATH', as for push_many. host limits the jobs that talk to one other machine at once, disk the jobs that read one local filesystem at once, jobs all of them.
+		The job list is confirmed once, after that, nothing asks.
+		:param PER_HOST: override limits.host
+		:param PER_DISK: override limits.disk
+		:param JOBS: override limits.jobs
+		"""
+		with open(MANIFEST) as f:
+			manifest = json.load(f)
+		limits = dict(MANIFEST_LIMITS, **manifest.get('limits', {}))
+		for k, v in dict(host=PER_HOST, disk=PER_DISK, jobs=JOBS).items():
+			if v is not None:
+				limits[k] = v
+
+		jobs = []
+		for job in manifest['jobs']:
+			if job['op'] not in MANIFEST_OPS:
+				raise Exception(f"unknown op {job['op']!r}, try one of {list(MANIFEST_OPS)}")
+			sshstr, remote = s._parse_targets([job['remote']])[0] if job.get('remote') else ('', None)
+			resources = [('disk', s.local_fs_uuid(job['subvol']))]
+			if sshstr:
+				resources.append(('host', sshstr))
+			jobs.append((dict(job, sshstr=sshstr, remote_path=remote), resources))
+			_prerr(f"{job['op']} {job['subvol']}" + (f" {job['remote']}" if job.get('remote') else ''))
+		if DRY_RUN:
+			return Res([job['op'] for job, _ in jobs], dry_run=True)
+		if not s._yes(f'run {len(jobs)} jobs?'):
+			return Res([])
+
+		# started here, before the jobs share it
+		s._privileged_helper()
+		connections = {}
+		for job, resources in jobs:
+			if job['sshstr'] and job['sshstr'] not in connections:
+				connections[job['sshstr']] = SshConnection(job['sshstr'], s._options['SSH_MULTIPLEX'])
+				connections[job['sshstr']].open()
+
+		def run(job):
+			b = s._with_remote(job['sshstr'])
+			b._yes_was_given_on_command_line = True
+			if job['sshstr']:
+				b._ssh = connections[job['sshstr']]
+			try:
+				r = MANIFEST_OPS[job['op']](b, job['subvol'], job['remote_path'], job.get('args', {}))
+			finally:
+				if b._agent:
+					b._agent.close()
+			r = dict(r.extra, result=r.val) if isinstance(r, Res) else dict(result=r)
+			return json.loads(json.dumps(r, default=datetime_to_json))
 
-				if is_mrc:
-					logbfg.info(f"this is the most recent common snapshot as calculated from db, stopping here.")
-					return
+		results = Scheduler({k: v for k, v in limits.items() if k != 'jobs'}, limits['jobs']).run(jobs, run)
+		failed = [r for r in results if 'error' in r]
+		_prerr(f'{len(results) - len(failed)} jobs done, {len(failed)} failed.')
+		# each job's own result and extras, or its error
+		return Res([dict(op=job['op'], subvol=job['subvol'], remote=job.get('remote'), seconds=r['seconds'], **r.get('result', dict(error=r.get('error')))) for (job, _), r in zip(jobs, results)])
 
-				if is_prunable and not DRY_RUN:
-					cmd = ['btrfs', 'subvolume', 'delete', str(path)]
-					if not s._yes(shlex.join(cmd)):
-						continue
-					s._local_cmd(cmd)
-					_prerr(f"Deleted snapshot: {path}")
 
-		_prerr("No more buckets.")
+	def daemon(s, SOCKET=None, SCHEDULE=None):
+		"""
+		stay running, and take commands from bfgc over the unix socket SOCKET (BFG_SOCKET, or bfg-<uid>.sock in XDG_RUNTIME_DIR or /tmp), see daemon.py. Mount tables, listings, ssh connections and agents stay warm between commands; the local mount table is re-read when something gets mounted or unmounted.
+		:param SCHEDULE: json file with {"schedules": [{"every": 3600, "op": "push", "subvol": "/data", "remote": "nas:/backup/data"}, ...]}, run every so many seconds
+		"""
+		schedules = []
+		if SCHEDULE:
+			with open(SCHEDULE) as f:
+				schedules = json.load(f)['schedules']
+		s._yes_was_given_on_command_line = True
+		remotes = {'': s}
+		watch = daemon.MountWatch()
+
+		def run_job(job):
+			if watch.changed():
+				logbfg.info('mounts changed, forgetting the local mount table')
+				s._mounts.pop('local', None)
+				s._local_fs_id5_mount_points.clear()
+				s._local_fs_uuids.clear()
+				for b in remotes.values():
+					b._mounts.pop('local', None)
+			op = DAEMON_ALIASES.get(job['op'], job['op'])
+			if op == 'prune':
+				op = 'prune_remote' if job.get('remote') else 'prune_local'
+			if op not in MANIFEST_OPS:
+				raise Exception(f"unknown op {job['op']!r}, try one of {list(DAEMON_ALIASES) + ['prune', 'status', 'stop'] + list(MANIFEST_OPS)}")
+			sshstr, remote = s._parse_targets([job['remote']])[0] if job.get('remote') else ('', None)
+			if sshstr not in remotes:
+				remotes[sshstr] = s._with_remote(sshstr)
+				remotes[sshstr]._yes_was_given_on_command_line = True
+			b = remotes[sshstr]
+			# listings of the other side only hold for one command
+			b._prefetched_remote_subvolumes = None
+			try:
+				r = MANIFEST_OPS[op](b, job.get('subvol'), remote, job.get('args', {}))
+			except (Exception, SystemExit):
+				# maybe the other machine changed under us, start over with it next time
+				b._mounts.pop('remote', None)
+				b._remote_fs_id5_mount_points.clear()
+				b._remote_fs_uuids.clear()
+				raise
+			r = dict(r.extra, result=r.val) if isinstance(r, Res) else dict(result=r)
+			return json.loads(json.dumps(r, default=datetime_to_json))
+
+		s._privileged_helper()
+		d = daemon.Daemon(run_job, SOCKET, schedules)
+		d.serve_forever()
+
+
+	def _plan_prune_local(s, SUBVOL):
+		""" the snapshots of SUBVOL that prune_local would delete """
+		logbfg.info(f"Pruning snapshots for {SUBVOL=}")
+		s._configure_db(SUBVOL)
+		s._check_catalog_for_pruning(SUBVOL)
+		s._subvol_uuid = s.get_subvol(s._local_cmd, SUBVOL).val['local_uuid']
+		all = s.all_subvols_from_db(SUBVOL)
+		mrcs = set([x['path'] for x in s.most_recent_common_snapshots(all, SUBVOL)])
+		logbfg.info(f"{mrcs=}")
 
+		local_snapshots = s.local_bfg_snapshots(all, SUBVOL)
+		if len(local_snapshots) == 0:
+			logbfg.info(f"No snapshots found for {SUBVOL}")
+		return s._prunable(local_snapshots, mrcs)
 
-	def prune_remote(s, LOCAL_SUBVOL, REMOTE_SUBVOL, DRY_RUN=False):
 
-		# prepare_prune
+	def _plan_prune_remote(s, LOCAL_SUBVOL, REMOTE_SUBVOL):
+		""" the snapshots of LOCAL_SUBVOL under REMOTE_SUBVOL that prune_remote would delete """
 
 		logbfg.info(f"Pruning remote snapshots of {LOCAL_SUBVOL=}")
+		s._configure_db(LOCAL_SUBVOL)
+		s._check_catalog_for_pruning(LOCAL_SUBVOL)
 		s._subvol_uuid = s.get_subvol(s._local_cmd, LOCAL_SUBVOL).val['local_uuid']
+		s._remote_prefetch(REMOTE_SUBVOL)
 
 
-		all = s.all_subvols_from_db()
+		all = s.all_subvols_from_db(LOCAL_SUBVOL)
 
-		local_mrcs = s.most_recent_common_snapshots(all, LOCAL_SUBVOL)
+		by_uuid = {x['local_uuid']: x for x in all}
+		index = LineageIndex(by_uuid)
+		local_mrcs = s.most_recent_common_snapshots(all, LOCAL_SUBVOL, index)
 		# local_mrcs is a list with one snapshot entry for each "remote" filesystem
-		remote_mrcs = []
 
 		remote_fs_uuid, remote_fs_mp = s.remote_fs_uuid(REMOTE_SUBVOL)
 
+		# their counterparts on this remote filesystem
+		remote_mrcs = []
 		for snap in local_mrcs:
-			for snap2 in all:
-				if snap2['fs_uuid'] == remote_fs_uuid:
-					if snap['local_uuid'] == snap2['received_uuid']:
-						remote_mrcs.append(snap2)
+			for uuid in index.by_received_uuid.get(snap['local_uuid'], ()):
+				if by_uuid[uuid]['fs_uuid'] == remote_fs_uuid:
+					remote_mrcs.append(by_uuid[uuid])
 
 		mrcs = set([x['path'] for x in remote_mrcs])
 
 		logbfg.info(f"{mrcs=}")
 
-
 		remote_snapshots = s.remote_bfg_snapshots(remote_fs_mp, remote_fs_uuid)
-		remote_snapshots = sorted(remote_snapshots, key=lambda x: x['dt'])
-
 		if len(remote_snapshots) == 0:
 			logbfg.info(f"No snapshots found for {REMOTE_SUBVOL}")
-			return
+		return s._prunable(remote_snapshots, mrcs)
+
 
-		newest = remote_snapshots[-1]['path']
-		buckets = s.put_snapshots_into_buckets(remote_snapshots)
+	@trace.traced('prune plan')
+	def _prunable(s, snapshots, mrcs):
+		""" walk the buckets, oldest first, up to the first most recent common snapshot, and collect what the policy doesn't keep """
+		snapshots = sorted(snapshots, key=lambda x: x['dt'])
+		if len(snapshots) == 0:
+			return []
 
+		newest = snapshots[-1]['path']
+		buckets = s.put_snapshots_into_buckets(snapshots)
+		prunable = []
 
 		for bucket, snaplist in buckets.items():
 			logbfg.info(f"Bucket: {bucket}")
@@ -936,18 +1528,69 @@ class Bfg:
 
 				if is_mrc:
 					logbfg.info(f"this is the most recent common snapshot as calculated from db, stopping here.")
-					return
+					return prunable
 
-				if is_prunable and not DRY_RUN:
-					cmd = ['btrfs', 'subvolume', 'delete', str(path)]
-					if not s._yes(shlex.join(cmd)):
-						continue
-					s._remote_cmd(cmd)
-					_prerr(f"Deleted snapshot: {path}")
+				if is_prunable:
+					prunable.append(str(path))
 
-		_prerr("No more buckets.")
+		logbfg.info("No more buckets.")
+		return prunable
 
 
+	def _prune(s, plan, DRY_RUN, COMMIT):
+		"""
+		show the whole delete set, ask once, and delete, each machine in its own thread
+		:param plan: {name: (bfg, 'local' or 'remote', [path, ...])}
+		"""
+		plan = {name: job for name, job in plan.items() if job[2]}
+		if not plan:
+			_prerr('nothing to prune.')
+			return Res([])
+		for name, (b, machine, paths) in plan.items():
+			_prerr(f'{name}:\n\t' + '\n\t'.join(paths))
+		total = sum(len(job[2]) for job in plan.values())
+		if DRY_RUN:
+			return Res([p for job in plan.values() for p in job[2]], dry_run=True)
+		if not s._yes(f'delete {total} snapshots?'):
+			return Res([])
+
+		# everything on this machine goes in one thread, the privileged helper takes one request at a time
+		here = [name for name, (b, machine, paths) in plan.items() if machine == 'local' or b._sshstr == '']
+		threads = [here] + [[name] for name in plan if name not in here]
+		def delete(names):
+			return {name: plan[name][0]._delete_subvolumes(plan[name][1], plan[name][2], COMMIT) for name in names}
+		results = {}
+		with ThreadPoolExecutor(len(threads)) as pool:
+			for r in pool.map(delete, [names for names in threads if names]):
+				results.update(r)
+		summary = {name: {k: v for k, v in r.items() if k != 'deleted'} for name, r in results.items()}
+		for name, r in summary.items():
+			_prerr(f"{name}: deleted {r['count']} snapshots in {r['batches']} batches, {r['seconds']}s.")
+		return Res([p for r in results.values() for p in r['deleted']], summary=summary)
+
+
+	@trace.traced('delete subvolumes')
+	def _delete_subvolumes(s, machine, paths, COMMIT=None, batch=DELETE_BATCH):
+		"""
+		btrfs subvolume delete, with up to batch paths per command
+		:return: {deleted, count, batches, seconds}
+		"""
+		run = s._local_cmd if machine == 'local' else s._remote_cmd
+		commit = {None: [], 'after': ['--commit-after'], 'each': ['--commit-each']}[COMMIT]
+		t = time.perf_counter()
+		batches = [paths[i:i + batch] for i in range(0, len(paths), batch)]
+		for i, b in enumerate(batches):
+			# the commit flag waits for the transaction, which is only worth it once, for 'after'
+			flags = commit if COMMIT != 'after' or i == len(batches) - 1 else []
+			run(['btrfs', 'subvolume', 'delete'] + flags + b)
+			logbfg.info(f'{machine}: deleted {len(b)} snapshots')
+		trace.annotate(machine=machine, count=len(paths), batches=len(batches))
+		if machine == 'local' or s._sshstr == '':
+			s._local_fs_changed(paths[0])
+		else:
+			s._prefetched_remote_subvolumes = None
+		return dict(deleted=paths, count=len(paths), batches=len(batches), seconds=round(time.perf_counter() - t, 3))
+
 
 	def local_bfg_snapshots(s, all, SUBVOL):
 		result = []
@@ -978,45 +1621,55 @@ class Bfg:
 
 
 
-	def most_recent_common_snapshots(s, all, SUBVOL):
+	def most_recent_common_snapshots(s, all, SUBVOL, index=None):
 		"""
 		Find the most recent common snapshots between the local and each remote filesystem.
 		"""
-		result = []
-
 		s._subvol_uuid = s.get_subvol(s._local_cmd, SUBVOL).val['local_uuid']
-		fss = s.remote_fs_uuids(all, SUBVOL)
-		logbfg.info(f"{fss=}")
-
-		for fs_uuid, fs in fss.items():
-			hosts = fs['hosts']
+		if s._mrcs == 'sql':
+			result = s._most_recent_common_snapshots_sql(SUBVOL)
+			if result is not None:
+				return result
+		return s._most_recent_common_snapshots_python(all, SUBVOL, index)
 
-			logbfg.info(f"most_recent_common_snapshots for {fs_uuid=} (hosts:{hosts})....")
 
-			all2 = []
-			for snap in all:
-				x = dict(snap)
-				if x['fs_uuid'] == s.local_fs_uuid(SUBVOL):
-					x['machine'] = 'local'
-				elif x['fs_uuid'] == fs_uuid:
-					x['machine'] = 'remote'
-				else:
-					x['machine'] = 'other'
-				all2.append(x)
-				#logbfg.info(f"all2: {x=}")
-
-			logbfg.info(f"all2: {len(all2)}")
-			logbfg.info(f"_parent_candidates2...")
-			candidates = list(s._parent_candidates2(all2, SUBVOL, s._subvol_uuid , ('local', 'remote')))
-
-			logbfg.info(f"shared parents: {len(candidates)}")
+	@trace.traced('most_recent_common_snapshots (sql)', 'db')
+	def _most_recent_common_snapshots_sql(s, SUBVOL):
+		""" None if the db doesn't know SUBVOL, the python walker can still start from the subvol itself """
+		session = db.session()
+		with session.begin():
+			row = session.get(db.Snapshot, s._subvol_uuid)
+			if row is None or row.deleted:
+				logbfg.info(f"{s._subvol_uuid} not in db, walking in python.")
+				return None
+			rows = db.most_recent_common_snapshots(session, s._subvol_uuid, s.local_fs_uuid(SUBVOL))
+		result = []
+		for row in rows:
+			x = s._snapshot_from_db(row)
+			logbfg.info(f"most recent common snapshot with {x.pop('remote_fs_uuid')}: {x['local_uuid']}")
+			result.append(x)
+		return result
 
-			for candidate in candidates:
-				logbfg.info(f"  {candidate['local_uuid']}")
 
-			if len(candidates) > 0:
-				result.append(candidates[0])
+	@trace.traced('most_recent_common_snapshots (python)')
+	def _most_recent_common_snapshots_python(s, all, SUBVOL, index=None):
+		"""
+		one walk over all the filesystems at once, on the records as they are
+		:param index: a LineageIndex of all, if the caller has one already
+		"""
+		fs_uuid = s.local_fs_uuid(SUBVOL)
+		by_uuid = {x['local_uuid']: x for x in all}
+		if index is None:
+			index = LineageIndex(by_uuid)
+		if s._subvol_uuid not in by_uuid:
+			me = s.get_local_subvol(SUBVOL)
+			me['fs_uuid'] = fs_uuid
+			by_uuid[s._subvol_uuid] = me
 
+		result = []
+		for remote_fs_uuid, candidates in sorted(VolWalker(by_uuid, index=index).walk_filesystems(s._subvol_uuid, fs_uuid).items()):
+			logbfg.info(f"most recent common snapshot with {remote_fs_uuid}: {candidates[0]['local_uuid']} (of {len(candidates)} shared parents)")
+			result.append(candidates[0])
 		return result
 
 
@@ -1046,6 +1699,7 @@ class Bfg:
 		"""
 		Try to figure out shared parents, if not provided, and send SNAPSHOT to the other side.
 		"""
+		s._remote_prefetch(REMOTE_SUBVOL, parent_dir=True)
 		snapshot_parent_dir = s.calculate_default_snapshot_parent_dir('remote', Path(REMOTE_SUBVOL)).val
 		logbfg.info(f'mkdir -p {snapshot_parent_dir}')
 		s._remote_cmd(['mkdir', '-p', str(snapshot_parent_dir)])
@@ -1058,10 +1712,78 @@ class Bfg:
 			if PARENT is not None:
 				PARENT = PARENT['abspath']
 
-		s.local_send(SNAPSHOT, ' | ' + s._sshstr + ' ' + s._sudo[0] + " btrfs receive " + str(snapshot_parent_dir), PARENT,
-					 CLONESRCS)
+		receive = s._sudo + ['btrfs', 'receive', str(snapshot_parent_dir)]
+		codec = s._compression('push')
+		if s._resumable:
+			transfer = s._resumable_send('push', s._send_cmd(SNAPSHOT, PARENT, CLONESRCS), snapshot_parent_dir, Path(SNAPSHOT).name, PARENT, codec)
+		elif codec:
+			transfer = s.local_send(SNAPSHOT, s._remote_pipeline([compression.decompress_cmd(codec[0]), receive]), PARENT, CLONESRCS, codec=codec)
+		else:
+			transfer = s.local_send(SNAPSHOT, s._ssh.argv() + receive, PARENT, CLONESRCS)
+		s._prefetched_remote_subvolumes = None
+		if s._sshstr == '':
+			s._local_fs_changed(snapshot_parent_dir)
 		_prerr(f'DONE, \n\tpushed {SNAPSHOT} \n\tinto {snapshot_parent_dir}\n.')
-		return Res(str(snapshot_parent_dir) + '/' + Path(SNAPSHOT).parts[-1])
+		return Res(str(snapshot_parent_dir) + '/' + Path(SNAPSHOT).parts[-1], transfer=transfer)
+
+
+
+	def push_many(s, SUBVOL, SNAPSHOT, TARGETS):
+		"""
+		push SNAPSHOT to several machines at once. The common parent is figured out for each target, and targets that share a parent get the same `btrfs send` stream, read from disk once and fed to all their receivers concurrently. Targets with different parents get their own stream.
+		A target that fails doesn't stop the others.
+		:param TARGETS: list of 'SSHSTR:REMOTE_SUBVOL' (':REMOTE_SUBVOL' for a filesystem mounted here), or of [SSHSTR, REMOTE_SUBVOL] pairs
+		:return: {target: snapshot path on the target, with transfer stats, or the error}
+		"""
+		targets = s._parse_targets(TARGETS)
+		my_uuid = s.get_subvol(s._local_cmd, SUBVOL).val['local_uuid']
+
+		results = {}
+		groups = defaultdict(list)
+		for sshstr, remote_subvol in targets:
+			name = f'{sshstr}:{remote_subvol}'
+			try:
+				b = s._with_remote(sshstr)
+				b._remote_prefetch(remote_subvol, parent_dir=True)
+				snapshot_parent_dir = b.calculate_default_snapshot_parent_dir('remote', Path(remote_subvol)).val
+				b._remote_cmd(['mkdir', '-p', str(snapshot_parent_dir)])
+				parent = b.find_common_parent(SUBVOL, str(snapshot_parent_dir), my_uuid, ('local', 'remote')).val
+			# _remote_cmd exits on errors
+			except (Exception, SystemExit) as e:
+				_prerr(f'FAILED to prepare pushing {SNAPSHOT} into {name}: {e!r}')
+				results[name] = dict(error=repr(e))
+				continue
+			parent = parent['abspath'] if parent is not None else None
+			groups[parent].append((name, b, snapshot_parent_dir))
+
+		for parent, group in groups.items():
+			send = s._send_cmd(SNAPSHOT, parent, [])
+			receivers = [b._ssh.argv() + b._sudo + ['btrfs', 'receive', str(d)] for _, b, d in group]
+			_prerr(shlex.join(send) + ' >>|>> ' + ', '.join(shlex.join(r) for r in receivers) + ' #...')
+			with trace.span('send', 'transfer', cmd=shlex.join(send), targets=[name for name, _, _ in group]) as sp:
+				try:
+					transfers = pump.tee(send, receivers, names=[name for name, _, _ in group])
+					sp['bytes'] = [t['bytes'] if isinstance(t, dict) else None for t in transfers]
+				except subprocess.CalledProcessError as e:
+					sp['exit_code'] = e.returncode
+					transfers = [e] * len(group)
+			for (name, b, snapshot_parent_dir), transfer in zip(group, transfers):
+				b._prefetched_remote_subvolumes = None
+				if b._sshstr == '':
+					s._local_fs_changed(snapshot_parent_dir)
+				if isinstance(transfer, Exception):
+					_prerr(f'FAILED to push {SNAPSHOT} into {name}: {transfer}')
+					results[name] = dict(error=str(transfer))
+				else:
+					_prerr(f'DONE, \n\tpushed {SNAPSHOT} \n\tinto {name} ({snapshot_parent_dir})\n.')
+					results[name] = dict(path=str(snapshot_parent_dir) + '/' + Path(SNAPSHOT).parts[-1], parent=parent, transfer=transfer)
+		return Res(results)
+
+
+
+	def _parse_targets(s, TARGETS):
+		""" 'SSHSTR:PATH' strings or [SSHSTR, PATH] pairs -> [(sshstr, path)] """
+		return [tuple(t.rsplit(':', 1)) if isinstance(t, str) else tuple(t) for t in TARGETS]
 
 
 
@@ -1070,17 +1792,23 @@ class Bfg:
 		s._local_cmd(['mkdir', '-p', str(local_snapshot_parent_dir)])
 
 		if PARENT is None:
+			s._remote_prefetch(REMOTE_SNAPSHOT)
 			my_uuid = s.get_subvol(s._remote_cmd, REMOTE_SNAPSHOT).val['local_uuid']
 			PARENT = s.find_common_parent(local_snapshot_parent_dir, REMOTE_SNAPSHOT, my_uuid, ('remote', 'local')).val
 			if PARENT is not None:
 				PARENT = PARENT['abspath']
 
-		s.remote_send(REMOTE_SNAPSHOT, local_snapshot_parent_dir, PARENT, CLONESRCS)
+		if s._resumable:
+			transfer = s._resumable_send('pull', s._send_cmd(REMOTE_SNAPSHOT, PARENT, CLONESRCS), local_snapshot_parent_dir, Path(REMOTE_SNAPSHOT).name, PARENT, s._compression('pull'))
+		else:
+			transfer = s.remote_send(REMOTE_SNAPSHOT, local_snapshot_parent_dir, PARENT, CLONESRCS)
+		s._prefetched_remote_subvolumes = None
+		s._local_fs_changed(local_snapshot_parent_dir)
 
 		local_snapshot = str(local_snapshot_parent_dir) + '/' + Path(REMOTE_SNAPSHOT).parts[-1]
 
 		_prerr(f'DONE, \n\tpulled {REMOTE_SNAPSHOT} \n\tinto {local_snapshot}\n.')
-		return Res(local_snapshot)
+		return Res(local_snapshot, transfer=transfer)
 
 
 
@@ -1123,36 +1851,137 @@ class Bfg:
 
 
 
-	def local_send(s, SNAPSHOT, target, PARENT, CLONESRCS=[]):
-		parents_args = s._parent_args(PARENT, CLONESRCS)
-
-		# _prerr((str(parents_args)) + ' #...')
-		cmd = shlex.join(s._sudo + ['btrfs', 'send'] + parents_args + [SNAPSHOT]) + target
-		_prerr((cmd) + ' #...')
-		subprocess.check_call(cmd, shell=True)
+	@trace.traced('send', 'transfer')
+	def local_send(s, SNAPSHOT, target, PARENT, CLONESRCS=[], path=None, codec=None):
+		"""
+		btrfs send SNAPSHOT into the target command, or into the file at path, through pump.
+		:param codec: (codec, level) to compress with on the way, target decompresses
+		:return: transfer stats, see pump.Meter.summary
+		"""
+		cmd = s._send_cmd(SNAPSHOT, PARENT, CLONESRCS)
+		_prerr(shlex.join(cmd) + (' | ' + shlex.join(target) if target else ' > ' + str(path)) + ' #...')
+		trace.annotate(cmd=shlex.join(cmd), target=shlex.join(target) if target else str(path))
+		if not codec:
+			r = pump.run(cmd, target, path)
+			trace.annotate(bytes=r['bytes'])
+			return r
+		raw, wire = pump.chain([cmd, compression.compress_cmd(*codec)] + ([target] if target else []), path, names=['send', 'wire'])
+		trace.annotate(bytes=raw['bytes'], wire_bytes=wire['bytes'])
+		return dict(raw, compression=compression.summary(*codec, raw, wire))
 
 
 
+	@trace.traced('receive', 'transfer')
 	def remote_send(s, REMOTE_SNAPSHOT, LOCAL_DIR, PARENT, CLONESRCS):
-		parents_args = s._parent_args(PARENT, CLONESRCS)
-
-		cmd1 = shlex.split(s._sshstr) + s._sudo + ['btrfs', 'send'] + parents_args + [REMOTE_SNAPSHOT]
-		cmd2 = s._sudo + ['btrfs', 'receive', LOCAL_DIR]
-		_prerr(shlex.join(cmd1) + ' >>|>> ' + shlex.join(cmd2))
-		p1 = subprocess.Popen(
-			cmd1,
-			stdout=subprocess.PIPE)
-		p2 = subprocess.Popen(
-			cmd2,
-			stdin=p1.stdout)
-		p1.stdout.close()  # https://www.titanwolf.org/Network/q/91c3c5dd-aa49-4bf4-911d-1bfe5ac304da/y
-		p2.communicate()
-		if p2.returncode != 0:
-			_prerr('exit code ' + str(p2.returncode))
+		send = s._send_cmd(REMOTE_SNAPSHOT, PARENT, CLONESRCS)
+		cmd2 = s._sudo + ['btrfs', 'receive', str(LOCAL_DIR)]
+		codec = s._compression('pull')
+		try:
+			if codec:
+				cmd1 = s._remote_pipeline([send, compression.compress_cmd(*codec)])
+				_prerr(shlex.join(cmd1) + ' >>|>> ' + shlex.join(compression.decompress_cmd(codec[0])) + ' >>|>> ' + shlex.join(cmd2))
+				wire, raw = pump.chain([cmd1, compression.decompress_cmd(codec[0]), cmd2], names=['wire', 'receive'])
+				trace.annotate(cmd=shlex.join(cmd1), bytes=raw['bytes'], wire_bytes=wire['bytes'])
+				return dict(raw, compression=compression.summary(*codec, raw, wire))
+			cmd1 = s._ssh.argv() + send
+			_prerr(shlex.join(cmd1) + ' >>|>> ' + shlex.join(cmd2))
+			r = pump.run(cmd1, cmd2)
+			trace.annotate(cmd=shlex.join(cmd1), bytes=r['bytes'])
+			return r
+		except subprocess.CalledProcessError as e:
+			trace.annotate(exit_code=e.returncode)
+			_prerr('exit code ' + str(e.returncode))
 			exit(1)
 
 
 
+	def _send_cmd(s, SNAPSHOT, PARENT, CLONESRCS):
+		return s._sudo + ['btrfs', 'send'] + s._parent_args(PARENT, CLONESRCS) + [str(SNAPSHOT)]
+
+
+
+	def _pipeline(s, machine, cmds, prefix=''):
+		""" a pipeline of commands, to run on machine, as one command. With pipefail, where the shell has it, so that a failing btrfs send isn't hidden by the compressor after it """
+		pipeline = '(set -o pipefail) 2>/dev/null && set -o pipefail; ' + prefix + ' | '.join(shlex.join([str(x) for x in c]) for c in cmds)
+		if machine == 'remote' and s._sshstr != '':
+			return s._ssh.argv() + [pipeline]
+		return ['sh', '-c', pipeline]
+
+
+
+	def _remote_pipeline(s, cmds):
+		return s._pipeline('remote', cmds)
+
+
+
+	@trace.traced('resumable send', 'transfer')
+	def _resumable_send(s, direction, send, receive_dir, snapshot_name, PARENT, codec=None):
+		"""
+		send into receive_dir on the receiving side, through a spool there, see spool.py. If the spool is complete already, only feed it to btrfs receive. If that fails, the partial subvolume is deleted, and the spool is kept for the next try.
+		:param direction: 'push' or 'pull'
+		:return: transfer stats, see pump.Meter.summary, with 'resume' info
+		"""
+		sender, receiver = ('local', 'remote') if direction == 'push' else ('remote', 'local')
+		trace.annotate(direction=direction, cmd=shlex.join(send), target=str(receive_dir))
+		spool_name = snapshot_name + ('__from__' + Path(PARENT).name if PARENT else '')
+		spool_dir = str(Path(receive_dir) / '.bfg_spool' / pathvalidate.sanitize_filename(spool_name))
+		# feed runs it, as root already
+		receive = ['btrfs', 'receive', str(receive_dir)]
+
+		status = json.loads(subprocess.check_output(s._pipeline(receiver, [s._sudo + spool.command('status', spool_dir)])))
+		chunk_size = status['chunk_size'] if status['sums'] else spool.CHUNK_SIZE
+		transfer = dict(bytes=0, resume=dict(spool=spool_dir, chunk_size=chunk_size, chunks_already_there=len(status['sums'])))
+		if status['complete']:
+			logbfg.info(f'{spool_dir} is complete already, {len(status["sums"])} chunks.')
+		else:
+			logbfg.info(f'{spool_dir}: {len(status["sums"])} chunks there already.')
+			sender_cmds = [spool.command('skip', 3, *send)]
+			receiver_cmds = [s._sudo + spool.command('write', spool_dir, chunk_size)]
+			if codec:
+				sender_cmds.append(compression.compress_cmd(*codec))
+				receiver_cmds.insert(0, compression.decompress_cmd(codec[0]))
+				transfer['compression'] = dict(codec=codec[0], level=codec[1])
+			# the sums go to the sender's stdin, and from there to fd 3 of skip
+			sums = json.dumps(dict(chunk_size=chunk_size, sums=status['sums'])).encode()
+			stats = pump.chain([s._pipeline(sender, sender_cmds, prefix='exec 3<&0; '), s._pipeline(receiver, receiver_cmds)], names=['wire'], input=sums)[0]
+			transfer.update(stats)
+		trace.annotate(wire_bytes=transfer['bytes'], chunks_already_there=len(status['sums']))
+
+		_prerr(f'{spool_dir} >>|>> {shlex.join(receive)}')
+		r = subprocess.run(s._pipeline(receiver, [s._sudo + spool.command('feed', spool_dir, *receive)]))
+		if r.returncode != 0:
+			partial = shlex.quote(str(Path(receive_dir) / snapshot_name))
+			logbfg.warning(f'btrfs receive failed, deleting partial {partial}, keeping {spool_dir}')
+			subprocess.run(s._pipeline(receiver, [s._sudo + ['btrfs', 'subvolume', 'delete', str(Path(receive_dir) / snapshot_name)]], prefix=f'test -e {partial} || exit 0; '))
+			raise subprocess.CalledProcessError(r.returncode, receive)
+		subprocess.check_call(s._pipeline(receiver, [s._sudo + ['rm', '-rf', spool_dir]]))
+		return transfer
+
+
+
+	def _compression(s, direction):
+		""" (codec, level) or None, for a push or a pull. auto decides once per direction """
+		if s._compress != 'auto':
+			return s._compress
+		if s._sshstr == '':
+			return None
+		if direction not in s._auto_compress:
+			s._auto_compress[direction] = compression.choose(s._measure_link(direction))
+		return s._auto_compress[direction]
+
+
+
+	def _measure_link(s, direction, size=LINK_PROBE_SIZE):
+		""" bytes per second, over ssh, by pushing or pulling size random bytes """
+		if direction == 'push':
+			stats = pump.run(['head', '-c', str(size), '/dev/urandom'], s._ssh.argv() + ['cat > /dev/null'])
+		else:
+			stats = pump.run(s._ssh.argv() + [f'head -c {size} /dev/urandom'], path=os.devnull)
+		logbfg.info(f'link: {pump.human_size(stats["average_bytes_per_second"])}/s')
+		return stats['average_bytes_per_second']
+
+
+
 	def find_common_parent(s, subvolume, remote_subvolume, my_uuid, direction):
 		logbfg.info(f'parent_candidates...')
 		candidates = s.parent_candidates(subvolume, remote_subvolume, my_uuid, direction).val
@@ -1168,24 +1997,55 @@ class Bfg:
 
 
 	def _add_abspath(s, subvol_record):
-		if subvol_record['machine'] == 'remote':
-			s._remote_add_abspath(subvol_record)
-		else:
-			s._local_add_abspath(subvol_record)
+		s._add_abspaths([subvol_record])
 
 
 
-	def _local_add_abspath(s, subvol_record):
-		id5_mp = s.local_fs_id5_mount_point(subvol_record['path'])
-		subvol_record['abspath'] = str(id5_mp) + '/' + s._local_cmd(
-			['btrfs', 'ins', 'sub', str(subvol_record['subvol_id']), id5_mp]).strip()
+	def _add_abspaths(s, subvol_records):
+		"""
+		fill in 'abspath' of any number of records. Subvols that we have listed resolve from memory, the rest (records from the db) with one batch per machine.
+		"""
+		unresolved = defaultdict(list)
+		for r in subvol_records:
+			machine = 'remote' if r['machine'] == 'remote' else 'local'
+			path = s._subvol_paths.get((machine, r['local_uuid']))
+			if path is not None:
+				r['abspath'] = str(path)
+			else:
+				unresolved[machine].append(r)
+		if unresolved['local']:
+			s._local_add_abspaths(unresolved['local'])
+		if unresolved['remote']:
+			s._remote_add_abspaths(unresolved['remote'])
 
 
 
-	def _remote_add_abspath(s, subvol_record):
-		id5_mp = s.remote_fs_id5_mount_point(subvol_record['path'])
-		subvol_record['abspath'] = str(id5_mp) + '/' + s._remote_cmd(
-			['btrfs', 'ins', 'sub', str(subvol_record['subvol_id']), id5_mp]).strip()
+	def _local_add_abspaths(s, subvol_records):
+		id5_mp = s.local_fs_id5_mount_point(subvol_records[0]['path'])
+		helper = s._privileged_helper()
+		if helper:
+			paths = helper.batch([('ins_sub', dict(subvol_id=r['subvol_id'], path=str(id5_mp))) for r in subvol_records])
+		else:
+			# one sudo for the lot, and it fails if any lookup does
+			script = 'for i; do btrfs ins sub "$i" "$0" || exit 1; done'
+			paths = s._local_cmd(['sh', '-c', script, id5_mp] + [r['subvol_id'] for r in subvol_records]).splitlines()
+		if len(paths) != len(subvol_records):
+			# one line per subvol, or the paths would go to the wrong records
+			raise Exception(f'looked up {len(subvol_records)} subvolume paths in {id5_mp}, got {len(paths)}')
+		for r, path in zip(subvol_records, paths):
+			r['abspath'] = str(id5_mp) + '/' + path.strip()
+
+
+
+	def _remote_add_abspaths(s, subvol_records):
+		id5_mp = s.remote_fs_id5_mount_point(subvol_records[0]['path'])
+		agent = s._remote_agent()
+		if agent:
+			paths = agent.batch([('ins_sub', dict(subvol_id=r['subvol_id'], path=str(id5_mp))) for r in subvol_records])
+		else:
+			paths = [s._remote_cmd(['btrfs', 'ins', 'sub', str(r['subvol_id']), id5_mp]) for r in subvol_records]
+		for r, path in zip(subvol_records, paths):
+			r['abspath'] = str(id5_mp) + '/' + path.strip()
 
 
 
@@ -1252,11 +2112,20 @@ class Bfg:
 			logging.debug('_parent_candidates2:' + json.dumps(i, indent=2, default=datetime_to_json, sort_keys=True))
 
 		logging.info(f'_parent_candidates2 all_subvols: {len(all_subvols)}')
-		yield from VolWalker(all_subvols2, direction).walk(my_uuid)
+		with trace.span('lineage index', records=len(all_subvols2)):
+			index = LineageIndex(all_subvols2)
+		with trace.span('volwalker', direction=direction) as sp:
+			candidates = list(VolWalker(all_subvols2, direction, index).walk(my_uuid))
+			sp['candidates'] = len(candidates)
+		yield from candidates
 
 
 
 def main():
+	# here rather than at import time, so that importing btrfsgit (tests, the daemon client) stays cheap
+	import fire
+	from btrfsgit.bfg_logging import configure_logging
+	configure_logging()
 	fire.Fire(Bfg)
 
 
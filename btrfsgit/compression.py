@@ -0,0 +1,111 @@
+"""
+compressing send streams on the way, with the zstd or lz4 command line tools, which need to be installed on both machines.
+
+A setting is 'zstd', 'lz4', with an optional level ('zstd:7'), 'auto', or None for no compression. 'auto' measures how fast the link is and how fast each level compresses here, and picks the strongest level that still keeps up with the link, or none at all, on a link that is faster than any of them.
+"""
+
+import logging
+import random
+import shutil
+import subprocess
+import time
+
+
+log = logging.getLogger('compression')
+
+
+CODECS = {
+	'zstd': dict(
+		default_level=3,
+		levels=range(1, 20),
+		compress=lambda level: ['zstd', '-q', '-c', '-T0', f'-{level}'],
+		decompress=['zstd', '-q', '-d', '-c']),
+	'lz4': dict(
+		default_level=1,
+		levels=range(1, 13),
+		compress=lambda level: ['lz4', '-q', '-c', f'-{level}'],
+		decompress=['lz4', '-q', '-d', '-c']),
+}
+
+# what auto tries, strongest first
+AUTO_CANDIDATES = [('zstd', 9), ('zstd', 6), ('zstd', 3), ('zstd', 1), ('lz4', 1)]
+SAMPLE_SIZE = 8 << 20
+
+
+def parse(setting):
+	"""
+	:return: (codec, level), or None
+	"""
+	if setting in (None, False, '', 'none'):
+		return None
+	if setting == 'auto':
+		return 'auto'
+	codec, _, level = str(setting).partition(':')
+	if codec not in CODECS:
+		raise Exception(f'unknown compression {setting!r}, try one of {list(CODECS)}, auto, or none')
+	level = int(level) if level else CODECS[codec]['default_level']
+	if level not in CODECS[codec]['levels']:
+		raise Exception(f'{codec} levels go from {CODECS[codec]["levels"][0]} to {CODECS[codec]["levels"][-1]}')
+	return codec, level
+
+
+def compress_cmd(codec, level):
+	return CODECS[codec]['compress'](level)
+
+
+def decompress_cmd(codec):
+	return CODECS[codec]['decompress']
+
+
+def _randbytes(rnd, n):
+	""" Random.randbytes is 3.9+ """
+	return rnd.getrandbits(8 * n).to_bytes(n, 'little')
+
+
+def sample(size=SAMPLE_SIZE, seed=0):
+	"""something to calibrate on: a mix of incompressible runs and repetitive runs, roughly like a subvolume delta with some already compressed files in it"""
+	rnd = random.Random(seed)
+	words = [_randbytes(rnd, rnd.randint(2, 12)) for _ in range(512)]
+	parts = []
+	n = 0
+	while n < size:
+		if rnd.random() < 0.3:
+			part = _randbytes(rnd, 64 << 10)
+		else:
+			part = b' '.join(rnd.choices(words, k=8 << 10))[:64 << 10]
+		parts.append(part)
+		n += len(part)
+	return b''.join(parts)[:size]
+
+
+def measure(codec, level, data):
+	"""
+	:return: (input bytes per second, ratio)
+	"""
+	t = time.perf_counter()
+	out = subprocess.run(compress_cmd(codec, level), input=data, stdout=subprocess.PIPE, check=True).stdout
+	seconds = max(time.perf_counter() - t, 1e-6)
+	return len(data) / seconds, len(data) / max(len(out), 1)
+
+
+def choose(link_bytes_per_second, data=None, candidates=AUTO_CANDIDATES):
+	"""
+	the strongest (codec, level) that compresses the stream at least as fast as the link can carry it compressed, or None.
+	"""
+	if data is None:
+		data = sample()
+	for codec, level in candidates:
+		if not shutil.which(codec):
+			continue
+		speed, ratio = measure(codec, level, data)
+		log.debug(f'{codec}:{level}: {speed / 2**20:.0f} MiB/s, ratio {ratio:.2f}')
+		if speed >= link_bytes_per_second * ratio:
+			log.info(f'auto compression: {codec}:{level}, compresses {speed / 2**20:.0f} MiB/s, link takes {link_bytes_per_second / 2**20:.0f} MiB/s')
+			return codec, level
+	log.info(f'auto compression: none, the link ({link_bytes_per_second / 2**20:.0f} MiB/s) is faster than compressing')
+	return None
+
+
+def summary(codec, level, raw, wire):
+	""" what goes into the transfer stats """
+	return dict(codec=codec, level=level, raw_bytes=raw['bytes'], wire_bytes=wire['bytes'], ratio=round(raw['bytes'] / wire['bytes'], 3) if wire['bytes'] else None)
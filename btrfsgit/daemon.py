@@ -0,0 +1,211 @@
+"""
+bfg as a long running process (see Bfg.daemon), that keeps what it learned between commands: mount tables, listings, ssh master connections and remote agents. Commands come over a unix socket, as json lines, from the thin client at the bottom of this file (bfgc), or from its own schedule.
+
+A request is a job, like in a run_manifest manifest: {"op": ..., "subvol": ..., "remote": "SSHSTR:PATH", "args": {...}}, and the answer is {"result": ...} or {"error": ...}. Besides the job ops, there's "status". Jobs run one at a time, nothing asks for confirmation.
+
+This file doesn't import the rest of bfg, so that the client starts fast.
+"""
+
+import argparse
+import json
+import logging
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+
+log = logging.getLogger('daemon')
+
+
+def default_socket():
+	return os.environ.get('BFG_SOCKET') or os.path.join(os.environ.get('XDG_RUNTIME_DIR') or '/tmp', f'bfg-{os.getuid()}.sock')
+
+
+class MountWatch:
+	""" tells when the mount table of this machine changed: the kernel flags /proc/self/mountinfo for poll() on every mount and umount """
+
+	def __init__(s, path='/proc/self/mountinfo'):
+		s._f = open(path)
+		s._f.read()
+		s._poll = select.poll()
+		s._poll.register(s._f, select.POLLPRI | select.POLLERR)
+
+
+	def changed(s):
+		if not s._poll.poll(0):
+			return False
+		s._f.seek(0)
+		s._f.read()
+		return True
+
+
+class Daemon:
+
+	def __init__(s, run_job, socket_path=None, schedules=[], clock=time.monotonic):
+		"""
+		:param run_job: runs a job dict, returns {"result": ..., and whatever else}, raises on failure
+		:param schedules: jobs with 'every' (seconds), run that often, the first time right away
+		"""
+		s._run_job = run_job
+		s.socket_path = socket_path or default_socket()
+		s._clock = clock
+		s._lock = threading.Lock()
+		s._stop = threading.Event()
+		s.started = clock()
+		s.served = 0
+		s.current = None
+		s.schedules = [dict(job=dict(job), every=job['every'], next=s.started, runs=0, last=None) for job in schedules]
+
+
+	def run(s, job):
+		""" one job at a time: they share one Bfg """
+		with s._lock:
+			s.current = job
+			t = s._clock()
+			try:
+				return dict(s._run_job(job), seconds=round(s._clock() - t, 3))
+			except (Exception, SystemExit) as e:
+				log.warning(f'{job}: {e!r}')
+				return dict(error=repr(e), seconds=round(s._clock() - t, 3))
+			finally:
+				s.current = None
+				s.served += 1
+
+
+	def status(s):
+		now = s._clock()
+		return dict(
+			pid=os.getpid(),
+			uptime=round(now - s.started),
+			served=s.served,
+			current=s.current,
+			schedules=[dict(sch['job'], runs=sch['runs'], last=sch['last'], next_in=round(max(sch['next'] - now, 0))) for sch in s.schedules])
+
+
+	def handle(s, request):
+		if request.get('op') == 'status':
+			return dict(result=s.status())
+		if request.get('op') == 'stop':
+			s.stop()
+			return dict(result='stopping')
+		return s.run(request)
+
+
+	def _connection(s, conn):
+		with conn, conn.makefile('rw') as f:
+			for line in f:
+				try:
+					answer = s.handle(json.loads(line))
+				except ValueError as e:
+					answer = dict(error=f'bad request: {e}')
+				f.write(json.dumps(answer, default=str) + '\n')
+				f.flush()
+
+
+	def due(s):
+		""" the schedules that are due now, with their next time moved on """
+		now = s._clock()
+		r = []
+		for sch in s.schedules:
+			if sch['next'] <= now:
+				sch['next'] = now + sch['every']
+				r.append(sch)
+		return r
+
+
+	def _scheduler(s):
+		while not s._stop.is_set():
+			for sch in s.due():
+				job = {k: v for k, v in sch['job'].items() if k != 'every'}
+				sch['last'] = s.run(job)
+				sch['runs'] += 1
+			wait = min([sch['next'] for sch in s.schedules], default=s._clock() + 60) - s._clock()
+			s._stop.wait(max(wait, 0.1))
+
+
+	def stop(s):
+		s._stop.set()
+
+
+	def serve_forever(s):
+		try:
+			os.unlink(s.socket_path)
+		except FileNotFoundError:
+			pass
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		old_umask = os.umask(0o077)
+		try:
+			server.bind(s.socket_path)
+		finally:
+			os.umask(old_umask)
+		server.listen()
+		server.settimeout(1)
+		log.info(f'listening on {s.socket_path}')
+		threading.Thread(target=s._scheduler, daemon=True).start()
+		try:
+			while not s._stop.is_set():
+				try:
+					conn, _ = server.accept()
+				except socket.timeout:
+					continue
+				threading.Thread(target=s._connection, args=(conn,), daemon=True).start()
+		finally:
+			server.close()
+			try:
+				os.unlink(s.socket_path)
+			except FileNotFoundError:
+				pass
+
+
+"""
+the client
+"""
+
+
+def request(job, socket_path=None):
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as c:
+		c.connect(socket_path or default_socket())
+		with c.makefile('rw') as f:
+			f.write(json.dumps(job) + '\n')
+			f.flush()
+			return json.loads(f.readline())
+
+
+def _value(v):
+	try:
+		return json.loads(v)
+	except ValueError:
+		return v
+
+
+def client_main(argv=None):
+	p = argparse.ArgumentParser(prog='bfgc', description='send a command to a running bfg daemon')
+	p.add_argument('--socket', default=None)
+	p.add_argument('op', help='commit, push, pull, prune, status, stop, or any run_manifest op')
+	p.add_argument('subvol', nargs='?')
+	p.add_argument('remote', nargs='?', help='SSHSTR:PATH')
+	p.add_argument('args', nargs='*', metavar='KEY=VALUE', help='more arguments for the op, values are json if they parse')
+	a = p.parse_args(argv)
+	# positionals are filled in order, so KEY=VALUE can land in subvol or remote
+	for name in ('remote', 'subvol'):
+		v = getattr(a, name)
+		if v and '=' in v and not v.startswith('/') and ':' not in v:
+			a.args.insert(0, v)
+			setattr(a, name, None)
+	job = dict(op=a.op)
+	if a.subvol:
+		job['subvol'] = a.subvol
+	if a.remote:
+		job['remote'] = a.remote
+	if a.args:
+		job['args'] = {k: _value(v) for k, v in (x.split('=', 1) for x in a.args)}
+	answer = request(job, a.socket)
+	print(json.dumps(answer, indent=1))
+	return 1 if 'error' in answer else 0
+
+
+if __name__ == '__main__':
+	sys.exit(client_main())
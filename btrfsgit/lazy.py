@@ -0,0 +1,26 @@
+"""
+modules that are only imported when something in them is first used, so that commands that don't need them (most don't need the database) don't pay for importing them.
+"""
+
+import importlib
+
+
+class LazyModule:
+
+	def __init__(s, name):
+		s._name = name
+		s._module = None
+
+
+	def __getattr__(s, attr):
+		if s._module is None:
+			s._module = importlib.import_module(s._name)
+		return getattr(s._module, attr)
+
+
+	def __repr__(s):
+		return f'<lazy module {s._name}' + (' (loaded)>' if s._module else '>')
+
+
+def module(name):
+	return LazyModule(name)
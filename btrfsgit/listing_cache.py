@@ -0,0 +1,62 @@
+"""
+on-disk cache of local subvolume listings, one json file per filesystem uuid, keyed by the filesystem generation.
+
+A listing is reused as is while the generation stays the same. When the generation moves, the cached listing still helps: btrfs_ioctl.list_subvolumes only looks up paths of subvolumes that changed since. BFG's own snapshot/delete/receive operations mark the cached listing stale, because btrfs doesn't necessarily commit a transaction (and bump the generation) right away.
+"""
+
+import json
+import logging
+import os
+
+
+log = logging.getLogger('listing_cache')
+
+
+def default_dir():
+	return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'bfg', 'listings')
+
+
+class ListingCache:
+
+	def __init__(s, directory=None):
+		s.dir = directory or default_dir()
+
+
+	def _file(s, fs_uuid):
+		return os.path.join(s.dir, fs_uuid + '.json')
+
+
+	def load(s, fs_uuid):
+		"""{'generation':..., 'subvols': [...], 'stale': bool}, or None"""
+		try:
+			with open(s._file(fs_uuid)) as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return None
+
+
+	def store(s, fs_uuid, generation, subvols, stale=False):
+		os.makedirs(s.dir, exist_ok=True)
+		fn = s._file(fs_uuid)
+		tmp = fn + '.tmp' + str(os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump({'generation': generation, 'subvols': subvols, 'stale': stale}, f)
+		os.replace(tmp, fn)
+		log.debug(f'stored {len(subvols)} subvols of {fs_uuid} at generation {generation}')
+
+
+	def invalidate(s, fs_uuid=None):
+		"""mark the listing of fs_uuid (or of every filesystem) stale. It's kept around, with its generation, for path reuse."""
+		if fs_uuid is None:
+			try:
+				names = os.listdir(s.dir)
+			except FileNotFoundError:
+				return
+			uuids = [n[:-len('.json')] for n in names if n.endswith('.json')]
+		else:
+			uuids = [fs_uuid]
+		for u in uuids:
+			cached = s.load(u)
+			if cached is not None and not cached.get('stale'):
+				s.store(u, cached['generation'], cached['subvols'], stale=True)
+				log.debug(f'invalidated {u}')
@@ -0,0 +1,169 @@
+"""
+which filesystem a path is on, and where its top level subvolume (id5) is mounted, from /proc/self/mountinfo, instead of looking for .bfg/id5 files up the tree and running `btrfs filesystem show`.
+
+The filesystem uuid comes from /sys/fs/btrfs/<uuid>/devices, matched against the device that mountinfo has for the mount. For the other machine, SCRIPT gathers all of that (and the .bfg/id5 files at the mount points, which still win over mountinfo) in one command.
+"""
+
+import glob
+import logging
+import os
+import re
+
+
+log = logging.getLogger('mounts')
+
+
+SCRIPT = r'''cat /proc/self/mountinfo
+echo '#devices'
+for d in /sys/fs/btrfs/*/devices/*; do [ -e "$d" ] && echo "$d"; done
+echo '#realpaths'
+sed -n 's/.* - btrfs \([^ ]*\) .*/\1/p' /proc/self/mountinfo | sort -u | while read -r d; do echo "$d $(readlink -f "$d")"; done
+echo '#overrides'
+{ echo /; cut -d' ' -f5 /proc/self/mountinfo; } | sort -u | while read -r m; do m=$(printf '%b' "$m"); [ -f "$m/.bfg/id5" ] && echo "$m $(cat "$m/.bfg/id5")"; done
+true
+'''
+
+
+def _unescape(field):
+	""" mountinfo escapes space, tab, newline and backslash as \\ooo """
+	return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(text):
+	"""
+	:return: list of {dev, root, mount_point, fstype, source, super_options}
+	"""
+	mounts = []
+	for line in text.splitlines():
+		if not line.strip():
+			continue
+		left, _, right = line.partition(' - ')
+		left = left.split()
+		right = right.split()
+		mounts.append(dict(
+			dev=left[2],
+			root=_unescape(left[3]),
+			mount_point=_unescape(left[4]),
+			fstype=right[0],
+			source=_unescape(right[1]) if len(right) > 1 else None,
+			super_options=right[2].split(',') if len(right) > 2 else []))
+	return mounts
+
+
+def uuids_by_device(device_paths):
+	""" /sys/fs/btrfs/<uuid>/devices/<name> paths -> {name: uuid} """
+	r = {}
+	for p in device_paths:
+		parts = p.rstrip('/').split('/')
+		if len(parts) >= 3 and parts[-2] == 'devices':
+			r[parts[-1]] = parts[-3]
+	return r
+
+
+def gather():
+	""" what SCRIPT prints, but for this machine, read directly """
+	with open('/proc/self/mountinfo') as f:
+		mountinfo = f.read()
+	mounts = parse_mountinfo(mountinfo)
+	realpaths = {m['source']: os.path.realpath(m['source']) for m in mounts if m['fstype'] == 'btrfs' and m['source']}
+	overrides = {}
+	for mp in set(['/'] + [m['mount_point'] for m in mounts]):
+		try:
+			with open(os.path.join(mp, '.bfg', 'id5')) as f:
+				overrides[mp] = f.read().strip()
+		except (FileNotFoundError, NotADirectoryError, PermissionError):
+			pass
+	return dict(mounts=mounts, devices=uuids_by_device(glob.glob('/sys/fs/btrfs/*/devices/*')), realpaths=realpaths, overrides=overrides)
+
+
+def parse_script_output(text):
+	sections = {'': []}
+	current = ''
+	for line in text.splitlines():
+		if line.startswith('#') and line[1:] in ('devices', 'realpaths', 'overrides'):
+			current = line[1:]
+			sections[current] = []
+		else:
+			sections[current].append(line)
+	pairs = lambda lines: dict(l.split(' ', 1) for l in lines if ' ' in l)
+	return dict(
+		mounts=parse_mountinfo('\n'.join(sections[''])),
+		devices=uuids_by_device(sections.get('devices', [])),
+		realpaths=pairs(sections.get('realpaths', [])),
+		overrides=pairs(sections.get('overrides', [])))
+
+
+class MountTable:
+	"""
+	resolves paths to {mount_point, fs_uuid, id5}, by the mount that the path is under. Results are cached per mount point, so every path under one resolves without looking again.
+	"""
+
+	def __init__(s, mounts, devices={}, realpaths={}, overrides={}):
+		s.mounts = mounts
+		s._devices = devices
+		s._realpaths = realpaths
+		s._overrides = overrides
+		s._cache = {}
+
+
+	def mount_of(s, path):
+		""" the mount that path is under: the one with the longest mount point that is a prefix of path. Of mounts over the same point, the last one """
+		path = os.path.normpath(str(path))
+		best = None
+		for m in s.mounts:
+			mp = m['mount_point']
+			if path == mp or path.startswith(mp.rstrip('/') + '/'):
+				if best is None or len(mp) >= len(best['mount_point']):
+					best = m
+		return best
+
+
+	def fs_uuid(s, mount):
+		if mount['fstype'] != 'btrfs' or not mount['source']:
+			return None
+		real = s._realpaths.get(mount['source'], mount['source'])
+		return s._devices.get(os.path.basename(real))
+
+
+	def id5_mount_point(s, mount):
+		""" where the top level subvolume of the filesystem of mount is mounted, or None """
+		if mount['fstype'] != 'btrfs':
+			return None
+		same_fs = [m for m in s.mounts if m['dev'] == mount['dev'] and m['fstype'] == 'btrfs']
+		for m in same_fs:
+			if 'subvolid=5' in m['super_options']:
+				return m['mount_point']
+		for m in same_fs:
+			if m['root'] == '/' and not any(o.startswith('subvolid=') for o in m['super_options']):
+				return m['mount_point']
+		return None
+
+
+	def override(s, path):
+		""" the .bfg/id5 file at the nearest mount point above path, of the same filesystem. An id5 file at / says nothing about a disk mounted under /media """
+		path = os.path.normpath(str(path))
+		mount = s.mount_of(path)
+		for mp in sorted(s._overrides, key=len, reverse=True):
+			if path == mp or path.startswith(mp.rstrip('/') + '/'):
+				if mount is None or s.mount_of(mp)['dev'] == mount['dev']:
+					return s._overrides[mp]
+		return None
+
+
+	def resolve(s, path):
+		"""
+		:return: {mount_point, fs_uuid, id5}, with None for what can't be told
+		"""
+		mount = s.mount_of(path)
+		if mount is None:
+			return dict(mount_point=None, fs_uuid=None, id5=s.override(path))
+		key = mount['mount_point']
+		if key not in s._cache:
+			id5 = s.override(key) or s.id5_mount_point(mount)
+			fs_uuid = s.fs_uuid(mount)
+			# the id5 file can point to another filesystem than the one that path is on
+			if id5 and s.mount_of(id5) is not None and s.mount_of(id5)['dev'] != mount['dev']:
+				fs_uuid = s.fs_uuid(s.mount_of(id5))
+			s._cache[key] = dict(mount_point=key, fs_uuid=fs_uuid, id5=id5)
+			log.debug(f'{key}: {s._cache[key]}')
+		return s._cache[key]
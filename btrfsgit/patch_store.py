@@ -0,0 +1,137 @@
+"""
+a directory of send streams ("patches"), for moving snapshots around on a disk instead of over the network: each stream is stored compressed, and index.json records which snapshot it recreates, against which parent, and its size and checksum. With that, apply_patches can work out the cheapest chain of patches that brings a target from what it has to the snapshot we want, and gc can drop the patches that no target would ever need anymore.
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+from datetime import datetime
+
+
+log = logging.getLogger('patch_store')
+
+
+INDEX = 'index.json'
+
+
+def sha256_file(path, chunk=1 << 20):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		while True:
+			data = f.read(chunk)
+			if not data:
+				return h.hexdigest()
+			h.update(data)
+
+
+class PatchStore:
+
+	def __init__(s, directory):
+		s.dir = str(directory)
+
+
+	def path(s, patch):
+		return os.path.join(s.dir, patch['file'])
+
+
+	def load(s):
+		"""the index: a list of {file, snapshot_uuid, parent_uuid, subvol_uuid, name, codec, size, sha256, created}, oldest first"""
+		try:
+			with open(os.path.join(s.dir, INDEX)) as f:
+				return json.load(f)['patches']
+		except FileNotFoundError:
+			return []
+
+
+	def _save(s, patches):
+		fn = os.path.join(s.dir, INDEX)
+		tmp = fn + '.tmp' + str(os.getpid())
+		with open(tmp, 'w') as f:
+			json.dump({'patches': patches}, f, indent=1)
+		os.replace(tmp, fn)
+
+
+	def file_name(s, name, snapshot_uuid, parent_uuid, codec):
+		return f'{name}__{snapshot_uuid}__{parent_uuid or "full"}.btrfs' + (f'.{codec}' if codec else '')
+
+
+	def add(s, file, snapshot_uuid, parent_uuid, subvol_uuid, name, codec):
+		"""record file, which is in the store directory already"""
+		patch = dict(
+			file=file,
+			snapshot_uuid=snapshot_uuid,
+			parent_uuid=parent_uuid,
+			subvol_uuid=subvol_uuid,
+			name=name,
+			codec=codec,
+			size=os.path.getsize(os.path.join(s.dir, file)),
+			sha256=sha256_file(os.path.join(s.dir, file)),
+			created=datetime.now().isoformat(timespec='seconds'))
+		s._save([p for p in s.load() if p['file'] != file] + [patch])
+		return patch
+
+
+	def remove(s, patches):
+		files = set(p['file'] for p in patches)
+		s._save([p for p in s.load() if p['file'] not in files])
+		for f in files:
+			try:
+				os.unlink(os.path.join(s.dir, f))
+			except FileNotFoundError:
+				pass
+
+
+	def newest(s, subvol_uuid=None, patches=None):
+		"""the newest patch, of subvol_uuid if given"""
+		patches = s.load() if patches is None else patches
+		candidates = [p for p in patches if subvol_uuid is None or p['subvol_uuid'] == subvol_uuid]
+		if not candidates:
+			return None
+		return max(enumerate(candidates), key=lambda x: (x[1]['created'], x[0]))[1]
+
+
+	def chain(s, have, goal, patches=None):
+		"""
+		the cheapest list of patches (fewest bytes, then fewest patches) that recreates snapshot goal, starting from any of the snapshot uuids in have, or from nothing, with a full stream. None if there is no way.
+		"""
+		patches = s.load() if patches is None else patches
+		by_parent = {}
+		for p in patches:
+			by_parent.setdefault(p['parent_uuid'], []).append(p)
+		starts = set(have) | {None}
+		if goal in starts:
+			return []
+		best = {}
+		todo = [((0, 0), i, u, []) for i, u in enumerate(sorted(starts, key=str))]
+		heapq.heapify(todo)
+		n = len(todo)
+		while todo:
+			cost, _, uuid, path = heapq.heappop(todo)
+			if uuid in best:
+				continue
+			best[uuid] = cost
+			if uuid == goal:
+				return path
+			for p in by_parent.get(uuid, []):
+				if p['snapshot_uuid'] not in best:
+					n += 1
+					heapq.heappush(todo, ((cost[0] + p['size'], cost[1] + 1), n, p['snapshot_uuid'], path + [p]))
+		return None
+
+
+	def superseded(s, patches=None):
+		"""
+		the patches that are on no cheapest chain to the newest snapshot of their subvolume, from any starting point that the store knows of: whatever a target has, there's a better way to bring it up to date.
+		"""
+		patches = s.load() if patches is None else patches
+		keep = set()
+		for subvol_uuid in set(p['subvol_uuid'] for p in patches):
+			group = [p for p in patches if p['subvol_uuid'] == subvol_uuid]
+			goal = s.newest(patches=group)['snapshot_uuid']
+			starts = set(p['parent_uuid'] for p in group) | set(p['snapshot_uuid'] for p in group)
+			for start in starts:
+				for p in s.chain({start}, goal, group) or []:
+					keep.add(p['file'])
+		return [p for p in patches if p['file'] not in keep]
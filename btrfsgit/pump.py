@@ -0,0 +1,262 @@
+"""
+moving a send stream from `btrfs send` (or ssh) to `btrfs receive` (or ssh) ourselves, instead of through a shell pipe, so that we can see how it goes: bytes, throughput, and which side we were waiting for.
+
+Between two pipes, the bytes go through splice(), so they never get copied into python. Where that doesn't work, through a large buffer.
+"""
+
+import errno
+import logging
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+
+
+log = logging.getLogger('pump')
+
+
+CHUNK = 1 << 20
+PROGRESS_INTERVAL = 10
+
+
+def human_size(n):
+	for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+		if abs(n) < 1024 or unit == 'TiB':
+			return f'{n:.1f} {unit}'
+		n /= 1024
+
+
+class Meter:
+	"""
+	counts the bytes, and the time spent waiting for the source to produce them (source stall) and for the sink to take them (sink stall). Logs progress every interval seconds.
+	"""
+
+	def __init__(s, interval=PROGRESS_INTERVAL, clock=time.perf_counter, name=''):
+		s.name = name
+		s._interval = interval
+		s._clock = clock
+		s.started = clock()
+		s.bytes = 0
+		s.source_stall = 0.
+		s.sink_stall = 0.
+		s.current = 0.
+		s._window_start = s.started
+		s._window_bytes = 0
+
+
+	def add(s, n):
+		s.bytes += n
+		now = s._clock()
+		if now - s._window_start >= s._interval:
+			s.current = (s.bytes - s._window_bytes) / (now - s._window_start)
+			s._window_start = now
+			s._window_bytes = s.bytes
+			log.info(s.name + s.line())
+
+
+	def summary(s):
+		now = s._clock()
+		seconds = now - s.started
+		if now > s._window_start and s.bytes > s._window_bytes:
+			s.current = (s.bytes - s._window_bytes) / (now - s._window_start)
+		return dict(
+			bytes=s.bytes,
+			seconds=round(seconds, 3),
+			average_bytes_per_second=round(s.bytes / seconds) if seconds else 0,
+			current_bytes_per_second=round(s.current),
+			source_stall_seconds=round(s.source_stall, 3),
+			sink_stall_seconds=round(s.sink_stall, 3))
+
+
+	def line(s):
+		seconds = s._clock() - s.started
+		average = s.bytes / seconds if seconds else 0
+		return f'{human_size(s.bytes)} in {seconds:.0f}s, {human_size(s.current)}/s now, {human_size(average)}/s average, waited {s.source_stall:.1f}s for the sender, {s.sink_stall:.1f}s for the receiver'
+
+
+
+def _wait(fd, event, clock):
+	poll = select.poll()
+	poll.register(fd, event)
+	t = clock()
+	poll.poll()
+	return clock() - t
+
+
+def _write_all(fd, data):
+	view = memoryview(data)
+	while view:
+		view = view[os.write(fd, view):]
+
+
+def copy(fd_in, fd_out, meter, chunk=CHUNK):
+	"""move everything from fd_in to fd_out, until fd_in is at EOF"""
+	clock = meter._clock
+	splice = getattr(os, 'splice', None)
+	while True:
+		meter.source_stall += _wait(fd_in, select.POLLIN, clock)
+		meter.sink_stall += _wait(fd_out, select.POLLOUT, clock)
+		if splice:
+			try:
+				n = splice(fd_in, fd_out, chunk)
+			except OSError as e:
+				if e.errno not in (errno.EINVAL, errno.ENOSYS):
+					raise
+				log.debug(f'splice: {e}, copying through a buffer')
+				splice = None
+				continue
+		else:
+			data = os.read(fd_in, chunk)
+			n = len(data)
+			t = clock()
+			_write_all(fd_out, data)
+			meter.sink_stall += clock() - t
+		if n == 0:
+			return
+		meter.add(n)
+
+
+
+def _hop(source, sink, meter):
+	try:
+		copy(source.fileno(), sink.fileno(), meter)
+	except BrokenPipeError:
+		# the consumer is gone, its exit code will tell why
+		log.debug(meter.name + 'consumer closed its end')
+	finally:
+		# the producer gets a SIGPIPE if it's not done yet
+		source.close()
+		sink.close()
+
+
+def _feed(f, data):
+	try:
+		f.write(data)
+	except BrokenPipeError:
+		pass
+	finally:
+		try:
+			f.close()
+		except BrokenPipeError:
+			pass
+
+
+def chain(commands, path=None, names=None, interval=PROGRESS_INTERVAL, input=None):
+	"""
+	commands[0] | commands[1] | ... (> path), with a pump between each pair, each hop in its own thread. Raises subprocess.CalledProcessError if a process fails.
+	:param names: a label for each hop, for the progress log
+	:param input: bytes for the stdin of commands[0]
+	:return: Meter.summary() of each hop
+	"""
+	log.info(' >>|>> '.join(str(c) for c in commands) + (f' > {path}' if path else ''))
+	procs = []
+	for i, cmd in enumerate(commands):
+		last = i == len(commands) - 1
+		procs.append(subprocess.Popen(cmd, stdin=subprocess.PIPE if i or input is not None else None, stdout=subprocess.PIPE if not last or path else None))
+	hops = [(procs[i].stdout, procs[i + 1].stdin) for i in range(len(procs) - 1)]
+	if path:
+		hops.append((procs[-1].stdout, open(path, 'wb')))
+	meters = [Meter(interval, name=names[i] + ': ' if names else '') for i in range(len(hops))]
+	threads = [threading.Thread(target=_hop, args=hop + (meter,), daemon=True) for hop, meter in zip(hops[:-1], meters)]
+	if input is not None:
+		threads.append(threading.Thread(target=_feed, args=(procs[0].stdin, input), daemon=True))
+	for thread in threads:
+		thread.start()
+	try:
+		_hop(*hops[-1], meters[-1])
+	finally:
+		for thread in threads:
+			thread.join()
+		for p in procs:
+			p.wait()
+	for p, cmd in reversed(list(zip(procs, commands))):
+		if p.returncode != 0:
+			raise subprocess.CalledProcessError(p.returncode, cmd)
+	for meter in meters:
+		log.info('transferred ' + meter.name + meter.line())
+	return [meter.summary() for meter in meters]
+
+
+# chunks that a fast consumer of tee can be ahead of a slow one
+TEE_QUEUE = 8
+
+
+def _drain(q, f, meter):
+	"""write what comes through q into f, until None. If f's reader goes away, keep emptying q, so that tee doesn't block on us"""
+	clock = meter._clock
+	broken = False
+	while True:
+		data = q.get()
+		if data is None:
+			break
+		if broken:
+			continue
+		t = clock()
+		try:
+			_write_all(f.fileno(), data)
+		except BrokenPipeError:
+			log.debug(meter.name + 'consumer closed its end')
+			broken = True
+			continue
+		meter.sink_stall += clock() - t
+		meter.add(len(data))
+	try:
+		f.close()
+	except BrokenPipeError:
+		pass
+
+
+def tee(producer, consumers, names=None, interval=PROGRESS_INTERVAL, chunk=CHUNK):
+	"""
+	one producer into each of consumers, reading the stream once. Every consumer has its own writer thread, so they receive concurrently. A consumer that fails is left behind, the others go on. Raises subprocess.CalledProcessError if the producer fails.
+	:return: for each consumer, Meter.summary(), or the subprocess.CalledProcessError it failed with
+	"""
+	log.info(f'{producer} >>|>> ' + ', '.join(str(c) for c in consumers))
+	p1 = subprocess.Popen(producer, stdout=subprocess.PIPE)
+	procs = [subprocess.Popen(c, stdin=subprocess.PIPE) for c in consumers]
+	meters = [Meter(interval, name=(names[i] if names else str(i)) + ': ') for i in range(len(consumers))]
+	queues = [queue.Queue(TEE_QUEUE) for _ in consumers]
+	threads = [threading.Thread(target=_drain, args=(q, p.stdin, m), daemon=True) for q, p, m in zip(queues, procs, meters)]
+	for thread in threads:
+		thread.start()
+	clock = meters[0]._clock if meters else time.perf_counter
+	fd = p1.stdout.fileno()
+	try:
+		while True:
+			t = clock()
+			data = os.read(fd, chunk)
+			for m in meters:
+				m.source_stall += clock() - t
+			if not data:
+				break
+			for q in queues:
+				q.put(data)
+	finally:
+		for q in queues:
+			q.put(None)
+		for thread in threads:
+			thread.join()
+		p1.stdout.close()
+		p1.wait()
+		for p in procs:
+			p.wait()
+	if p1.returncode != 0:
+		raise subprocess.CalledProcessError(p1.returncode, producer)
+	results = []
+	for p, cmd, meter in zip(procs, consumers, meters):
+		if p.returncode != 0:
+			results.append(subprocess.CalledProcessError(p.returncode, cmd))
+		else:
+			log.info('transferred ' + meter.name + meter.line())
+			results.append(meter.summary())
+	return results
+
+
+def run(producer, consumer=None, path=None, interval=PROGRESS_INTERVAL):
+	"""
+	producer | consumer, or producer > path, with the bytes going through us. Raises subprocess.CalledProcessError if a process fails.
+	:return: Meter.summary()
+	"""
+	return chain([producer] + ([consumer] if consumer is not None else []), path, interval=interval)[0]
@@ -0,0 +1,232 @@
+"""
+a small helper that runs on the other machine (or as root on this one, see Bfg._privileged_helper), started over the ssh connection, and answers batches of metadata queries with JSON, so that preparing a push/pull/prune_remote takes a round trip or two instead of a ssh command per query.
+
+The other machine only needs python3. This file is sent over as source, so it must only use the standard library.
+
+protocol: the first line on stdin is this source, json-encoded. After that, each line is a json list of [op, kwargs] calls, and each answer is a json list of {"result": ...} or {"error": "..."}, one per call.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+
+BOOTSTRAP = 'import sys,json;exec(json.loads(sys.stdin.readline()));serve()'
+
+
+class AgentError(Exception):
+	pass
+
+
+"""
+the agent side
+"""
+
+
+def _run(cmd):
+	return subprocess.check_output(cmd, text=True, stdin=subprocess.DEVNULL)
+
+
+def _ok(cmd):
+	return subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def _dash_is_none(string):
+	if string == '-':
+		return None
+	return string
+
+
+def _existing(path):
+	while not os.path.exists(path) and os.path.dirname(path) != path:
+		path = os.path.dirname(path)
+	return path
+
+
+def parse_sub_list_line(line):
+	""" a line of `btrfs subvolume list -q -t -R -u` """
+	items = line.split()
+	return dict(
+		subvol_id=int(items[0]),
+		generation=int(items[1]),
+		parent_uuid=_dash_is_none(items[3]),
+		received_uuid=_dash_is_none(items[4]),
+		local_uuid=items[5],
+		path=items[6])
+
+
+def parse_sub_show(out):
+	lines = out.splitlines()
+	return dict(
+		received_uuid=_dash_is_none(lines[4].split()[2]),
+		parent_uuid=_dash_is_none(lines[3].split()[2]),
+		local_uuid=lines[2].split()[1],
+		subvol_id=int(lines[6].split()[2]),
+		ro=lines[11].split()[1] == 'readonly')
+
+
+def parse_fs_show(out):
+	line = out.splitlines()[0]
+	return re.match(r"Label:\s+.*\s+uuid:\s+([a-f0-9-]+)$", line).group(1)
+
+
+def op_ping():
+	return 'pong'
+
+
+def op_run(cmd):
+	""" run a command as whoever the agent runs as; stderr goes straight through. stdin is ours, the command can't have it """
+	p = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, text=True)
+	return dict(returncode=p.returncode, stdout=p.stdout)
+
+
+def op_test(path):
+	return os.path.exists(path)
+
+
+def op_mkdir(path):
+	os.makedirs(path, exist_ok=True)
+
+
+def op_id5(path):
+	""" the id5 mount point, from the nearest .bfg/id5 file up the tree, or None """
+	while True:
+		try:
+			with open(os.path.join(path, '.bfg', 'id5')) as f:
+				return f.read().strip()
+		except FileNotFoundError:
+			new = os.path.dirname(path)
+			if new == path:
+				return None
+			path = new
+
+
+def op_fs_uuid(path):
+	mp = op_id5(path)
+	if mp is None:
+		raise Exception(f'could not find id5 for {path}, id5 file missing?')
+	return parse_fs_show(_run(['btrfs', 'filesystem', 'show', mp]))
+
+
+def op_list_subvolumes(path):
+	""" all subvolumes on the filesystem of path (or of its nearest existing ancestor), with paths relative to id5 """
+	path = _existing(path)
+	cmd = ['btrfs', 'subvolume', 'list', '-q', '-t', '-R', '-u']
+	subvols = [parse_sub_list_line(line) for line in _run(cmd + [path]).splitlines()[2:]]
+	ro = set(parse_sub_list_line(line)['local_uuid'] for line in _run(cmd + ['-r', path]).splitlines()[2:])
+	for i in subvols:
+		i['ro'] = i['local_uuid'] in ro
+	return subvols
+
+
+def op_sub_show(path):
+	return parse_sub_show(_run(['btrfs', 'sub', 'show', path]))
+
+
+def op_ins_sub(subvol_id, path):
+	return _run(['btrfs', 'ins', 'sub', str(subvol_id), path]).strip()
+
+
+def op_snapshot_parent_dir(subvol):
+	"""
+	the directory that .bfg_snapshots goes into for subvol: next to it, if that's the same filesystem, otherwise inside it. See Bfg.calculate_default_snapshot_parent_dir.
+	"""
+	parent = os.path.dirname(subvol)
+	if not os.path.exists(subvol):
+		return parent
+	os.makedirs(subvol, exist_ok=True)
+	f1 = os.path.join(subvol, str(time.time()))
+	f2 = os.path.join(parent, os.path.basename(f1) + '_dest')
+	open(f1, 'w').close()
+	try:
+		same_fs = _ok(['cp', '--reflink', f1, f2])
+	finally:
+		for f in (f1, f2):
+			try:
+				os.unlink(f)
+			except FileNotFoundError:
+				pass
+	if same_fs:
+		return parent
+	return subvol
+
+
+OPS = dict((k[3:], v) for k, v in list(globals().items()) if k.startswith('op_'))
+
+
+def handle(calls):
+	results = []
+	for op, kwargs in calls:
+		try:
+			results.append({'result': OPS[op](**kwargs)})
+		except Exception as e:
+			results.append({'error': f'{op}: {e!r}'})
+	return results
+
+
+def serve(inp=None, out=None):
+	inp = inp or sys.stdin
+	out = out or sys.stdout
+	for line in inp:
+		out.write(json.dumps(handle(json.loads(line))) + '\n')
+		out.flush()
+
+
+"""
+the bfg side
+"""
+
+
+class AgentClient:
+
+	def __init__(s, argv):
+		"""
+		:param argv: command that runs BOOTSTRAP with python3, for example through ssh and sudo
+		"""
+		s._argv = argv
+		s._p = None
+		s.round_trips = 0
+		# one batch at a time, the privileged helper is shared by the jobs of run_manifest
+		s._lock = threading.Lock()
+
+	def start(s):
+		s._p = subprocess.Popen(s._argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+		with open(__file__) as f:
+			s._p.stdin.write(json.dumps(f.read()) + '\n')
+		s.call('ping')
+
+	def batch(s, calls):
+		"""
+		:param calls: list of (op, kwargs)
+		:return: list of results, in the same order. Raises AgentError if any of the calls failed.
+		"""
+		try:
+			with s._lock:
+				s._p.stdin.write(json.dumps([[op, kwargs] for op, kwargs in calls]) + '\n')
+				s._p.stdin.flush()
+				line = s._p.stdout.readline()
+		except (BrokenPipeError, OSError) as e:
+			raise AgentError(f'agent died: {e}')
+		if not line:
+			raise AgentError(f'agent died, exit code {s._p.poll()}')
+		s.round_trips += 1
+		results = []
+		for r in json.loads(line):
+			if 'error' in r:
+				raise AgentError(r['error'])
+			results.append(r['result'])
+		return results
+
+	def call(s, op, **kwargs):
+		return s.batch([(op, kwargs)])[0]
+
+	def close(s):
+		if s._p is None:
+			return
+		s._p.stdin.close()
+		s._p.wait()
+		s._p = None
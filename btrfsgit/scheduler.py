@@ -0,0 +1,79 @@
+"""
+running jobs concurrently, with limits on how many run at once on each resource, so that two transfers don't fight over one link or one disk.
+
+A job names the resources it uses, as (kind, key) pairs, for example ('host', 'nas') and ('disk', <fs uuid>); limits says how many jobs can hold each key of a kind at once. Jobs start in the order they're given, except that a job that has to wait doesn't hold up the ones behind it that don't.
+"""
+
+import logging
+import threading
+import time
+from collections import Counter
+
+
+log = logging.getLogger('scheduler')
+
+
+class Scheduler:
+
+	def __init__(s, limits, max_jobs=None):
+		"""
+		:param limits: {kind: jobs per key}, kinds that aren't there are unlimited
+		:param max_jobs: jobs at once, overall
+		"""
+		s.limits = limits
+		s.max_jobs = max_jobs
+		s._held = Counter()
+		s._running = 0
+		s._cond = threading.Condition()
+
+
+	def _fits(s, resources):
+		if s.max_jobs is not None and s._running >= s.max_jobs:
+			return False
+		return all(s._held[r] < s.limits[r[0]] for r in set(resources) if r[0] in s.limits)
+
+
+	def run(s, jobs, fn):
+		"""
+		:param jobs: list of (job, resources)
+		:param fn: called with each job, in a thread of its own
+		:return: for each job, {result} or {error}, with seconds
+		"""
+		results = [None] * len(jobs)
+		pending = list(range(len(jobs)))
+
+		def work(i):
+			job, resources = jobs[i]
+			t = time.perf_counter()
+			try:
+				r = dict(result=fn(job))
+			except (Exception, SystemExit) as e:
+				log.warning(f'job {i} failed: {e!r}')
+				r = dict(error=repr(e))
+			r['seconds'] = round(time.perf_counter() - t, 3)
+			with s._cond:
+				results[i] = r
+				s._running -= 1
+				for res in set(resources):
+					s._held[res] -= 1
+				s._cond.notify_all()
+
+		threads = []
+		with s._cond:
+			while pending:
+				for i in list(pending):
+					resources = jobs[i][1]
+					if s._fits(resources):
+						pending.remove(i)
+						s._running += 1
+						for res in set(resources):
+							s._held[res] += 1
+						log.info(f'starting job {i}: {jobs[i][0]}')
+						thread = threading.Thread(target=work, args=(i,), daemon=True)
+						threads.append(thread)
+						thread.start()
+				if pending:
+					s._cond.wait()
+		for thread in threads:
+			thread.join()
+		return results
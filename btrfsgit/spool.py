@@ -0,0 +1,198 @@
+"""
+resumable transfers: the receiving side spools the send stream into checksummed chunks, and only feeds `btrfs receive` once the whole stream is there. When a transfer dies halfway, the next try regenerates the stream, skips the chunks that the other side already has, and sends only the rest.
+
+This file runs as a script on both machines (see command()), so it must only use the standard library.
+
+	status SPOOL                 print {"chunk_size", "sums", "complete"} of what is spooled
+	skip FD CMD...               run CMD (btrfs send), and frame its output, leaving out the leading chunks whose sums match the ones read from FD
+	write SPOOL CHUNK_SIZE       frames from skip into SPOOL
+	feed SPOOL CMD...            run CMD (btrfs receive), with the spooled stream as stdin, verifying each chunk
+
+Between skip and write, the stream is: the index of the first chunk sent, then (length, data) frames, one per chunk, and an empty frame at the end, which skip only sends if CMD succeeded. So a stream that was cut short, for whatever reason, never counts as complete.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import struct
+import subprocess
+import sys
+import zlib
+
+
+CHUNK_SIZE = 64 << 20
+HEADER = struct.Struct('>Q')
+MANIFEST = 'manifest.json'
+BOOTSTRAP = "import sys,zlib,base64;g={'__name__':'spool'};exec(zlib.decompress(base64.b64decode(sys.argv[1])),g);g['main'](sys.argv[2:])"
+
+
+def _chunk_path(spool, i):
+	return os.path.join(spool, f'{i:08}.chunk')
+
+
+def _read_exactly(f, n):
+	parts = []
+	while n:
+		data = f.read(n)
+		if not data:
+			break
+		parts.append(data)
+		n -= len(data)
+	return b''.join(parts)
+
+
+def _sha256(data):
+	return hashlib.sha256(data).hexdigest()
+
+
+def load_manifest(spool):
+	try:
+		with open(os.path.join(spool, MANIFEST)) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return dict(chunk_size=CHUNK_SIZE, sums=[], sizes=[], complete=False)
+
+
+def save_manifest(spool, manifest):
+	path = os.path.join(spool, MANIFEST)
+	with open(path + '.tmp', 'w') as f:
+		json.dump(manifest, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(path + '.tmp', path)
+
+
+def status(spool):
+	"""
+	the chunks that are still there, with the right size. The last one is also checksummed, as the one most likely to be torn, the rest are checked by feed.
+	"""
+	manifest = load_manifest(spool)
+	good = 0
+	for i, size in enumerate(manifest['sizes']):
+		try:
+			if os.path.getsize(_chunk_path(spool, i)) != size:
+				break
+		except FileNotFoundError:
+			break
+		good = i + 1
+	if good and good == len(manifest['sums']):
+		with open(_chunk_path(spool, good - 1), 'rb') as f:
+			if _sha256(f.read()) != manifest['sums'][good - 1]:
+				good -= 1
+	complete = manifest['complete'] and good == len(manifest['sums'])
+	return dict(chunk_size=manifest['chunk_size'], sums=manifest['sums'][:good], complete=complete)
+
+
+def skip(sums, chunk_size, inp, out):
+	"""
+	:return: the index of the first chunk sent
+	"""
+	start = None
+	i = 0
+	while True:
+		data = _read_exactly(inp, chunk_size)
+		if start is None:
+			if i < len(sums) and data and _sha256(data) == sums[i]:
+				i += 1
+				continue
+			start = i
+			out.write(HEADER.pack(start))
+		if not data:
+			return start
+		out.write(HEADER.pack(len(data)))
+		out.write(data)
+
+
+def write(spool, chunk_size, inp):
+	"""
+	:return: number of chunks written. Raises if the stream ends before the end frame.
+	"""
+	header = _read_exactly(inp, HEADER.size)
+	if len(header) != HEADER.size:
+		raise Exception('no header, sender died?')
+	start, = HEADER.unpack(header)
+	os.makedirs(spool, exist_ok=True)
+	manifest = load_manifest(spool)
+	if start > len(manifest['sums']) or (manifest['sums'] and manifest['chunk_size'] != chunk_size):
+		raise Exception(f'sender resumes at chunk {start}, but we have {len(manifest["sums"])} of {manifest["chunk_size"]} bytes')
+	manifest = dict(chunk_size=chunk_size, sums=manifest['sums'][:start], sizes=manifest['sizes'][:start], complete=False)
+	save_manifest(spool, manifest)
+	i = start
+	while True:
+		frame = _read_exactly(inp, HEADER.size)
+		if len(frame) != HEADER.size:
+			raise Exception(f'stream cut short after chunk {i}')
+		length, = HEADER.unpack(frame)
+		if length == 0:
+			manifest['complete'] = True
+			save_manifest(spool, manifest)
+			return i - start
+		data = _read_exactly(inp, length)
+		if len(data) != length:
+			raise Exception(f'stream cut short in chunk {i}')
+		path = _chunk_path(spool, i)
+		with open(path + '.tmp', 'wb') as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(path + '.tmp', path)
+		manifest['sums'].append(_sha256(data))
+		manifest['sizes'].append(length)
+		save_manifest(spool, manifest)
+		i += 1
+
+
+def feed(spool, out):
+	manifest = load_manifest(spool)
+	if not manifest['complete']:
+		raise Exception(f'{spool} is not complete')
+	for i, sum in enumerate(manifest['sums']):
+		with open(_chunk_path(spool, i), 'rb') as f:
+			data = f.read()
+		if _sha256(data) != sum:
+			# so that the next try sends it again
+			save_manifest(spool, dict(manifest, sums=manifest['sums'][:i], sizes=manifest['sizes'][:i], complete=False))
+			raise Exception(f'chunk {i} of {spool} is damaged')
+		out.write(data)
+	out.flush()
+
+
+def main(argv):
+	command = argv[0]
+	if command == 'status':
+		print(json.dumps(status(argv[1])))
+	elif command == 'skip':
+		with os.fdopen(int(argv[1])) as f:
+			sums = json.load(f)
+		p = subprocess.Popen(argv[2:], stdout=subprocess.PIPE)
+		skip(sums['sums'], sums['chunk_size'], p.stdout, sys.stdout.buffer)
+		if p.wait() != 0:
+			sys.exit(f'{argv[2:]} failed with {p.returncode}')
+		sys.stdout.buffer.write(HEADER.pack(0))
+		sys.stdout.buffer.flush()
+	elif command == 'write':
+		write(argv[1], int(argv[2]), sys.stdin.buffer)
+	elif command == 'feed':
+		p = subprocess.Popen(argv[2:], stdin=subprocess.PIPE)
+		try:
+			feed(argv[1], p.stdin)
+		except Exception:
+			p.kill()
+			raise
+		finally:
+			p.stdin.close()
+		sys.exit(p.wait())
+	else:
+		raise Exception(f'unknown command {command}')
+
+
+def command(*args):
+	""" the command line that runs this file with args, on a machine with python3 """
+	with open(__file__, 'rb') as f:
+		packed = base64.b64encode(zlib.compress(f.read(), 9)).decode()
+	return ['python3', '-c', BOOTSTRAP, packed] + [str(a) for a in args]
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
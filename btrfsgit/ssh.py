@@ -0,0 +1,79 @@
+"""
+one ssh master connection per Bfg instance, that every remote command and send/receive pipe goes through (OpenSSH ControlMaster), instead of a new handshake for each command.
+"""
+
+import atexit
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+from btrfsgit import trace
+
+
+log = logging.getLogger('ssh')
+
+
+class SshConnection:
+
+	def __init__(s, sshstr, multiplex=True):
+		s._argv = shlex.split(sshstr)
+		s._multiplex = multiplex
+		s._dir = None
+		s._control_opts = []
+		s._opened = False
+		s.setup_seconds = None
+		s.commands = 0
+
+
+	def _with_opts(s, opts):
+		# options go right after the ssh executable, before the destination
+		return s._argv[:1] + opts + s._argv[1:]
+
+
+	def open(s):
+		"""start the master, if it's not running yet. If that doesn't work out, we carry on with a connection per command."""
+		if s._opened:
+			return
+		s._opened = True
+		if not s._multiplex or not s._argv:
+			return
+		s._dir = tempfile.mkdtemp(prefix='bfg_ssh_')
+		control_opts = ['-o', 'ControlPath=' + os.path.join(s._dir, 'master')]
+		cmd = s._with_opts(control_opts + ['-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-f', '-N'])
+		log.debug(shlex.join(cmd))
+		t = time.perf_counter()
+		with trace.span('ssh master', 'ssh', cmd=shlex.join(cmd)) as sp:
+			r = subprocess.run(cmd, stdin=subprocess.DEVNULL)
+			sp['exit_code'] = r.returncode
+		s.setup_seconds = time.perf_counter() - t
+		if r.returncode != 0:
+			log.warning(f'could not start ssh master connection (exit code {r.returncode}), going to connect for each command.')
+			shutil.rmtree(s._dir, ignore_errors=True)
+			s._dir = None
+			return
+		log.info(f'ssh master connection up in {s.setup_seconds:.2f}s')
+		s._control_opts = control_opts + ['-o', 'ControlMaster=no']
+		atexit.register(s.close)
+
+
+	def argv(s):
+		"""the ssh command to prefix a remote command with"""
+		s.open()
+		s.commands += 1
+		return s._with_opts(s._control_opts)
+
+
+	def close(s):
+		if s._dir is None:
+			return
+		cmd = s._with_opts(s._control_opts + ['-O', 'exit'])
+		log.debug(shlex.join(cmd))
+		subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		shutil.rmtree(s._dir, ignore_errors=True)
+		s._dir = None
+		if s.commands > 1:
+			log.info(f'ssh: {s.commands} remote commands over one connection, saved ~{(s.commands - 1) * s.setup_seconds:.2f}s of handshakes')
@@ -0,0 +1,118 @@
+"""
+timed spans of what a run spends its time on: commands, listings, the lineage walk, transfers, db queries, deletes. With tracing on (Bfg TRACE=FILE), they're written at exit as a Chrome trace-event file (chrome://tracing, ui.perfetto.dev), which is also plain json. With tracing off, a span costs next to nothing.
+"""
+
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+log = logging.getLogger('trace')
+
+
+_events = None
+_path = None
+_lock = threading.Lock()
+# tid -> name, taken when the span ends, since the thread may be gone by the time the file is written
+_threads = {}
+_t0 = time.perf_counter()
+# the args of the open spans, innermost last, per thread, for annotate
+_open = threading.local()
+
+
+def start(path):
+	""" record spans from now on, and write them to path when the process exits """
+	global _events, _path
+	if _events is None:
+		_events = []
+		atexit.register(write)
+	_path = path
+
+
+def enabled():
+	return _events is not None
+
+
+def _us(t):
+	return round((t - _t0) * 1e6, 1)
+
+
+@contextmanager
+def span(name, cat='bfg', **args):
+	"""
+	time the block. The yielded dict ends up in the event's args, for what's only known at the end (exit code, bytes).
+	"""
+	if _events is None:
+		yield {}
+		return
+	args = dict(args)
+	stack = _open.__dict__.setdefault('stack', [])
+	stack.append(args)
+	t = time.perf_counter()
+	try:
+		yield args
+	except BaseException as e:
+		args['error'] = repr(e)
+		raise
+	finally:
+		stack.pop()
+		event = dict(name=name, cat=cat, ph='X', ts=_us(t), dur=_us(time.perf_counter()) - _us(t), pid=os.getpid(), tid=threading.get_ident(), args={k: _jsonable(v) for k, v in args.items()})
+		with _lock:
+			_events.append(event)
+			_threads[event['tid']] = threading.current_thread().name
+
+
+def annotate(**args):
+	""" add to the args of the innermost open span of this thread """
+	stack = getattr(_open, 'stack', None)
+	if stack:
+		stack[-1].update(args)
+
+
+def traced(name=None, cat='bfg'):
+	""" a span around each call of the decorated function """
+	def decorator(f):
+		@functools.wraps(f)
+		def wrapper(*a, **kw):
+			if _events is None:
+				return f(*a, **kw)
+			with span(name or f.__name__, cat):
+				return f(*a, **kw)
+		return wrapper
+	return decorator
+
+
+def _jsonable(v):
+	if isinstance(v, (str, int, float, bool)) or v is None:
+		return v
+	if isinstance(v, (list, tuple)):
+		return [_jsonable(x) for x in v]
+	if isinstance(v, dict):
+		return {str(k): _jsonable(x) for k, x in v.items()}
+	return str(v)
+
+
+def events():
+	""" the recorded spans, plus the thread names """
+	with _lock:
+		r = list(_events or [])
+	r.append(dict(name='run', cat='bfg', ph='X', ts=0, dur=_us(time.perf_counter()), pid=os.getpid(), tid=threading.main_thread().ident, args=dict(argv=sys.argv)))
+	threads = {**_threads, **{t.ident: t.name for t in threading.enumerate()}}
+	for tid in sorted(set(e['tid'] for e in r)):
+		r.append(dict(name='thread_name', ph='M', pid=os.getpid(), tid=tid, args=dict(name=threads.get(tid, str(tid)))))
+	return r
+
+
+def write(path=None):
+	path = path or _path
+	if not path:
+		return
+	with open(path, 'w') as f:
+		json.dump(dict(traceEvents=events(), displayTimeUnit='ms'), f)
+	log.info(f'trace written to {path}')
@@ -1,5 +1,29 @@
 import logging
 import json
+from collections import defaultdict
+
+
+
+class LineageIndex:
+	""" children of each subvolume, by parent_uuid and by received_uuid, built once from a uuid->record dict.
+	"""
+
+	def __init__(s, subvols_by_local_uuid):
+		s.by_parent_uuid = defaultdict(list)
+		s.by_received_uuid = defaultdict(list)
+		# both kinds of children together, in table order, the way VolWalker used to find them by scanning the whole table:
+		s._children = defaultdict(list)
+		for k,v in subvols_by_local_uuid.items():
+			if v['received_uuid']:
+				s.by_received_uuid[v['received_uuid']].append(k)
+				s._children[v['received_uuid']].append(k)
+			if v['parent_uuid']:
+				s.by_parent_uuid[v['parent_uuid']].append(k)
+				s._children[v['parent_uuid']].append(k)
+
+	def children(s, uuid):
+		""" local_uuids of all subvols created from uuid, through send/receive or snapshotting """
+		return s._children.get(uuid, ())
 
 
 
@@ -7,7 +31,8 @@ class VolWalker:
 	""" walks subvolume records to find common parents
 	"""
 
-	def __init__(s, subvols_by_local_uuid, direction):
+	def __init__(s, subvols_by_local_uuid, direction=('local', 'remote'), index=None):
+		""" direction is (source machine, target machine), by the records' 'machine'. walk_filesystems doesn't need it """
 
 		s.source = direction[0]
 		s.target = direction[1]
@@ -16,6 +41,9 @@ class VolWalker:
 		#	logging.debug((k,v))
 		#logging.debug('/subvols_by_local_uuid')
 		s.by_uuid = subvols_by_local_uuid
+		if index is None:
+			index = LineageIndex(subvols_by_local_uuid)
+		s.index = index
 
 	def parent(s, uuid):
 		v = s.by_uuid[uuid]
@@ -26,85 +54,174 @@ class VolWalker:
 			return v['parent_uuid']
 
 
-	def walk(s, my_uuid):
-		logging.debug('walk ' + repr(my_uuid))
-
-		if my_uuid not in s.by_uuid:
-			# the show almost stops here, but only almost. We could still look up all subvols that have this uuid as a parent/received uuid, and pursue those. It wouldn't be known if the missing subvol was ro or rw, so, these could be presented as only the last case options to try.
-			logging.info('my_uuid not in s.by_uuid')
-			return #fixme
+	def ancestors(s, my_uuid):
+		""" my_uuid, its parent, grandparent.. as far as the records go """
+		result = []
+		seen = set()
+		uuid = my_uuid
+		while uuid and uuid in s.by_uuid and uuid not in seen:
+			seen.add(uuid)
+			result.append(uuid)
+			uuid = s.parent(uuid)
+			logging.debug('parent is ' + repr(uuid))
+		return result
 
-		for i in s.ro_chain(my_uuid):
-			# ^ grab my_uuid if it's ro, otherwise grab it's ro children, and then their children recursively. What this accomplishes is that we'll be looking at a direct ro snapshot (or at the ro subvol itself), so that we can now check if it made it to the other side:
-
-			logging.debug(f'i: {i}.')
-
-			for remote_snapshot in s.ro_descendants_chain(i, s.target):
-				remote_snapshot_local_uuid = remote_snapshot['local_uuid']
-				logging.debug(f'{remote_snapshot_local_uuid} is on remote.')
-				for x in s.ro_descendants_chain(i, s.source):
-					x_local_uuid = x['local_uuid']
-					logging.debug(f'local counterpart: {x_local_uuid}.')
-					yield x
-				# we only care that a 'remote' snapshot exists, not how many there are:
-				break
-
-		p = s.parent(my_uuid)
-		logging.debug('parent is ' + repr(p))
-		if p:
-			yield from s.walk(p)
-
-
-	def ro_chain(s, uuid):
-		v = s.by_uuid.get(uuid)
-		if not v:
-			return
-		if v['ro']:
-			yield uuid
-		for k,v in s.by_uuid.items():
-			if v['received_uuid'] == uuid:
-				yield from s.ro_chain2(v['local_uuid'])
-			if v['parent_uuid'] == uuid:
-				yield from s.ro_chain2(v['local_uuid'])
-
-
-	def ro_chain2(s, uuid):
-		v = s.by_uuid.get(uuid)
-		if not v:
-			return
-		if not v['ro']:
-			return
-		yield from s.ro_chain(uuid)
-
-
-	def ro_descendants_chain0(s, my_uuid, machine):
-		# find all descendants created through send/receive or snapshotting
-		for k,v in s.by_uuid.items():
-			if v['received_uuid'] == my_uuid:
-				yield from s.ro_descendants_chain(v['local_uuid'], machine)
-			if v['parent_uuid'] == my_uuid:
-				yield from s.ro_descendants_chain(v['local_uuid'], machine)
-
-
-	def ro_descendants_chain(s, my_uuid, machine):
-		v = s.by_uuid.get(my_uuid)
-		if not v:
-			return
 
+	def ro_children(s, uuid):
 		# at any case, if the read-only-ness chain is broken,
 		# the subvol or its descendants are of no use.
 		# idk how btrfs looks at this, maybe if there were actually no modifications, it'd keep a constant gen id, and a ro child snapshot of it could be used? # nope, see tests/negative/test2.sh
+		for child in s.index.children(uuid):
+			v = s.by_uuid.get(child)
+			if v and v['ro']:
+				yield child
+
+
+	def distances(s, ancestors):
+		"""
+		lineage distance of every subvol reachable from the ancestors through ro snapshots/receives. The nth ancestor is n steps away, and every ro descendant one step further than its nearest relative.
+		"""
+		dist = {}
+		level = []
+		d = 0
+		while level or d < len(ancestors):
+			if d < len(ancestors) and ancestors[d] not in dist:
+				dist[ancestors[d]] = d
+				level.append(ancestors[d])
+			next_level = []
+			for uuid in level:
+				for child in s.ro_children(uuid):
+					if child not in dist:
+						dist[child] = d + 1
+						next_level.append(child)
+			level = next_level
+			d += 1
+		return dist
+
+
+	def reaching_target(s, dist):
+		"""
+		ro subvols (among those in dist) that have a ro descendant on the target machine, or are on it themselves. Propagated upwards from the target subvols.
+		"""
+		result = set()
+		todo = [k for k in dist if s.by_uuid[k]['ro'] and s.by_uuid[k]['machine'] == s.target]
+		while todo:
+			uuid = todo.pop()
+			if uuid in result:
+				continue
+			result.add(uuid)
+			v = s.by_uuid[uuid]
+			for p in (v['received_uuid'], v['parent_uuid']):
+				if p in dist and p not in result and s.by_uuid[p]['ro']:
+					todo.append(p)
+		return result
+
+
+	def reaching_filesystems(s, dist, source_fs):
+		"""
+		reaching_target for every filesystem but source_fs at once: for each ro subvol in dist, the set of fs_uuids that it, or a ro descendant, is on.
+		"""
+		result = defaultdict(set)
+		todo = [(k, s.by_uuid[k]['fs_uuid']) for k in dist if s.by_uuid[k]['ro'] and s.by_uuid[k]['fs_uuid'] != source_fs]
+		while todo:
+			uuid, fs = todo.pop()
+			if fs in result[uuid]:
+				continue
+			result[uuid].add(fs)
+			v = s.by_uuid[uuid]
+			for p in (v['received_uuid'], v['parent_uuid']):
+				if p in dist and fs not in result.get(p, ()) and s.by_uuid[p]['ro']:
+					todo.append((p, fs))
+		return result
+
+
+	def roots(s, ancestors):
+		""" the ro ancestors, and the ro children of the rw ones """
+		result = []
+		for a in ancestors:
+			if s.by_uuid[a]['ro']:
+				result.append(a)
+			else:
+				result.extend(s.ro_children(a))
+		return result
+
+
+	def nearest_first(s, candidates, dist):
+		# subvol id is only a crude approximation of age, but within one distance and one filesystem, it's the best we have
+		candidates.sort(key=lambda v: (dist[v['local_uuid']], -(v.get('subvol_id') or 0), v['local_uuid']))
 
-		if v['ro'] == False:
-			return
-		else:
-			# if this item of the chain happens to be on the remote machine,
-			# the chain is a good candidate for -p
-			if v['machine'] == machine:
-				yield v
-
-		yield from s.ro_descendants_chain0(my_uuid, machine)
 
+	def walk(s, my_uuid):
+		"""
+		yield each source subvol that is a good candidate for -p, nearest to my_uuid first.
 
+		For my_uuid and each of its ancestors, we look at the ancestor if it's ro, otherwise at its ro children, and at their ro children, and so on. What this accomplishes is that we'll be looking at a direct ro snapshot (or at the ro subvol itself), so that we can check if it made it to the other side: if any of the chain is on the target machine, all of the chain that is on the source machine is a candidate.
+		"""
+		logging.debug('walk ' + repr(my_uuid))
 
+		if my_uuid not in s.by_uuid:
+			# the show almost stops here, but only almost. We could still look up all subvols that have this uuid as a parent/received uuid, and pursue those. It wouldn't be known if the missing subvol was ro or rw, so, these could be presented as only the last case options to try.
+			logging.info('my_uuid not in s.by_uuid')
+			return #fixme
 
+		ancestors = s.ancestors(my_uuid)
+		dist = s.distances(ancestors)
+		reaching = s.reaching_target(dist)
+
+		candidates = []
+		seen = set()
+		for root in s.roots(ancestors):
+			if root not in reaching or root in seen:
+				continue
+			logging.debug(f'{root} made it to {s.target}.')
+			seen.add(root)
+			todo = [root]
+			while todo:
+				uuid = todo.pop()
+				v = s.by_uuid[uuid]
+				if v['machine'] == s.source:
+					logging.debug(f'{s.source} counterpart: {uuid}.')
+					candidates.append(v)
+				for child in s.ro_children(uuid):
+					if child not in seen:
+						seen.add(child)
+						todo.append(child)
+
+		s.nearest_first(candidates, dist)
+		yield from candidates
+
+
+	def walk_filesystems(s, my_uuid, source_fs):
+		"""
+		walk towards every other filesystem in one go, telling machines apart by 'fs_uuid' instead of 'machine': the ancestors and distances are shared, and the filesystems that each chain made it to are pushed down the chain together.
+
+		:return: {fs_uuid: candidates on source_fs, nearest first}, for the filesystems that have any
+		"""
+		if my_uuid not in s.by_uuid:
+			logging.info('my_uuid not in s.by_uuid')
+			return {}
+
+		ancestors = s.ancestors(my_uuid)
+		dist = s.distances(ancestors)
+		reaching = s.reaching_filesystems(dist, source_fs)
+
+		chains = defaultdict(set)
+		todo = [(root, fs) for root in s.roots(ancestors) for fs in reaching.get(root, ())]
+		while todo:
+			uuid, fs = todo.pop()
+			if fs in chains[uuid]:
+				continue
+			chains[uuid].add(fs)
+			for child in s.ro_children(uuid):
+				if fs not in chains.get(child, ()):
+					todo.append((child, fs))
+
+		result = defaultdict(list)
+		for uuid, fss in chains.items():
+			v = s.by_uuid[uuid]
+			if v['fs_uuid'] == source_fs:
+				for fs in fss:
+					result[fs].append(v)
+		for candidates in result.values():
+			s.nearest_first(candidates, dist)
+		return dict(result)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+startup benchmark: how long `bfg --help` and `bfg local_commit` take, and how much of that is importing. local_commit runs against a scratch directory, with `sudo` and `btrfs` replaced by stubs, so it measures bfg itself and not the snapshot.
+
+for each command: best wall time of the runs, import time of btrfsgit.btrfsgit and of everything (from python -X importtime), and which of the heavy modules got imported at all.
+
+usage: PYTHONPATH=. misc/bench_startup.py [RUNS]
+"""
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+
+HEAVY = ['sqlalchemy', 'psycopg', 'fire', 'pathvalidate', 'logging.config']
+RUNNER = 'import sys; sys.argv = ["bfg"] + sys.argv[1:]; from btrfsgit.btrfsgit import main; main()'
+
+
+def stubs(dir):
+	for name, body in [('sudo', 'exec "$@"'), ('btrfs', 'exit 0')]:
+		path = os.path.join(dir, name)
+		with open(path, 'w') as f:
+			f.write('#!/bin/sh\n' + body + '\n')
+		os.chmod(path, 0o755)
+
+
+def run(args, env):
+	t = time.perf_counter()
+	p = subprocess.run([sys.executable, '-X', 'importtime', '-c', RUNNER] + args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+	wall = time.perf_counter() - t
+	if p.returncode != 0:
+		raise Exception(f'{args} failed with {p.returncode}')
+	imports = {}
+	total = 0
+	for line in p.stderr.splitlines():
+		m = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)', line)
+		if m:
+			imports[m.group(4)] = int(m.group(2))
+			if not m.group(3):
+				total += int(m.group(2))
+	return wall, imports.get('btrfsgit.btrfsgit', 0) / 1e6, total / 1e6, [h for h in HEAVY if h in imports]
+
+
+def main():
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+	with tempfile.TemporaryDirectory() as tmp:
+		stubs(tmp)
+		os.makedirs(os.path.join(tmp, 'data'))
+		env = dict(os.environ, PATH=tmp + os.pathsep + os.environ['PATH'], BFG_LOGGING_ROOT='WARNING')
+		for name, args in [('--help', ['--help']), ('local_commit', ['local_commit', '--SUBVOL=' + os.path.join(tmp, 'data')])]:
+			results = [run(args, env) for _ in range(runs)]
+			wall, mod, total, heavy = min(results)
+			print(f'bfg {name:<13} {wall:6.3f}s wall, importing btrfsgit {mod:6.3f}s, all imports {total:6.3f}s, heavy: {", ".join(heavy) or "-"}')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""
+synthetic benchmark of the common parent search.
+
+builds a fake listing of N subvolume records: one rw subvol, its ro snapshots, half of them received on the "remote" filesystem, plus unrelated subvols of other hosts (as fed in from the db), and times building the LineageIndex and walking it.
+
+usage: PYTHONPATH=. misc/bench_volwalker.py [N ...]
+"""
+
+import sys
+import time
+import logging
+from btrfsgit.volwalker import LineageIndex, VolWalker
+
+
+def fake_records(n):
+	by_uuid = {}
+
+	def add(local_uuid, parent_uuid, received_uuid, ro, machine):
+		by_uuid[local_uuid] = dict(local_uuid=local_uuid, parent_uuid=parent_uuid, received_uuid=received_uuid, ro=ro, machine=machine)
+
+	add('subvol', None, None, False, 'local')
+	i = 0
+	while len(by_uuid) < n:
+		snap = f'snap{i}'
+		add(snap, 'subvol', None, True, 'local')
+		if i % 2 == 0:
+			add(f'recv{i}', None, snap, True, 'remote')
+		add(f'other{i}', f'othersubvol{i % 100}', None, True, 'other')
+		i += 1
+	return by_uuid
+
+
+def bench(n):
+	by_uuid = fake_records(n)
+	t0 = time.perf_counter()
+	index = LineageIndex(by_uuid)
+	t1 = time.perf_counter()
+	candidates = sum(1 for _ in VolWalker(by_uuid, ('local', 'remote'), index).walk('subvol'))
+	t2 = time.perf_counter()
+	print(f'{len(by_uuid):>9} records: index {t1 - t0:8.3f}s, walk {t2 - t1:8.3f}s, {candidates} candidates')
+
+
+def main():
+	logging.getLogger().setLevel(logging.WARNING)
+	sizes = [int(x) for x in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+	for n in sizes:
+		bench(n)
+
+
+if __name__ == '__main__':
+	main()
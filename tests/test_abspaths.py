@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from btrfsgit.btrfsgit import Bfg
+
+
+@pytest.fixture
+def bfg(tmp_path, monkeypatch):
+	""" a Bfg whose btrfs answers `ins sub ID PATH` from a table: prints nothing for 258, fails for ids it doesn't know """
+	btrfs = tmp_path / 'btrfs'
+	btrfs.write_text('#!/bin/sh\ncase "$3" in 256) echo a;; 257) echo b/c;; 258) ;; *) exit 1;; esac\n')
+	btrfs.chmod(0o755)
+	monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+	b = Bfg(YES=True, LISTING_CACHE=False, PRIVILEGED_HELPER=False)
+	b._sudo = []
+	monkeypatch.setattr(b, 'local_fs_id5_mount_point', lambda path: '/mnt')
+	return b
+
+
+def records(*ids):
+	return [dict(subvol_id=i, local_uuid=str(i), path='/mnt/x', machine='local') for i in ids]
+
+
+def test_batch(bfg):
+	rs = records(256, 257)
+	bfg._add_abspaths(rs)
+	assert [r['abspath'] for r in rs] == ['/mnt/a', '/mnt/b/c']
+
+
+def test_failing_lookup_fails_the_batch(bfg):
+	with pytest.raises(SystemExit):
+		bfg._add_abspaths(records(256, 999, 257))
+
+
+def test_missing_path_doesnt_shift_the_rest(bfg):
+	rs = records(256, 258, 257)
+	with pytest.raises(Exception, match='got 2'):
+		bfg._add_abspaths(rs)
+	assert 'abspath' not in rs[2]
@@ -0,0 +1,122 @@
+"""Tests for `btrfsgit.btrfs_ioctl`, against a fake root tree."""
+
+import struct
+import uuid
+
+from btrfsgit import btrfs_ioctl as bi
+
+
+U1 = '11111111-1111-1111-1111-111111111111'
+U2 = '22222222-2222-2222-2222-222222222222'
+U3 = '33333333-3333-3333-3333-333333333333'
+
+
+def root_item(generation, ro=False, local_uuid=None, parent_uuid=None, received_uuid=None):
+	data = bytearray(439)
+	struct.pack_into('<Q', data, bi.ROOT_ITEM_GENERATION, generation)
+	struct.pack_into('<Q', data, bi.ROOT_ITEM_FLAGS, bi.BTRFS_ROOT_SUBVOL_RDONLY if ro else 0)
+	for offset, u in [(bi.ROOT_ITEM_UUID, local_uuid), (bi.ROOT_ITEM_PARENT_UUID, parent_uuid), (bi.ROOT_ITEM_RECEIVED_UUID, received_uuid)]:
+		if u:
+			data[offset:offset + 16] = uuid.UUID(u).bytes
+	return bytes(data)
+
+
+def root_ref(dirid, name):
+	return bi.ROOT_REF.pack(dirid, 0, len(name)) + name.encode()
+
+
+# (objectid, type, offset) -> data, like in the root tree
+TREE = {
+	(5, bi.BTRFS_ROOT_ITEM_KEY, 0): root_item(10),
+	(256, bi.BTRFS_ROOT_ITEM_KEY, 0): root_item(20, local_uuid=U1),
+	(256, bi.BTRFS_ROOT_BACKREF_KEY, 5): root_ref(256, 'data'),
+	(256, 156, 257): b'root ref, not interesting',
+	(257, bi.BTRFS_ROOT_ITEM_KEY, 15): root_item(21, ro=True, local_uuid=U2, parent_uuid=U1),
+	(257, bi.BTRFS_ROOT_BACKREF_KEY, 256): root_ref(300, 'snap1'),
+	(258, bi.BTRFS_ROOT_ITEM_KEY, 0): root_item(22, ro=True, local_uuid=U3, received_uuid=U2),
+	(258, bi.BTRFS_ROOT_BACKREF_KEY, 5): root_ref(256, 'received'),
+	# deleted, but not cleaned up yet
+	(259, bi.BTRFS_ROOT_ITEM_KEY, 0): root_item(23, local_uuid=U3),
+}
+
+# (tree, dirid) -> path
+DIRS = {
+	(5, 256): '',
+	(256, 300): '.bfg_snapshots/data/',
+}
+
+
+class FakeSource:
+	def __init__(s):
+		s.lookups = []
+
+	def tree_search(s, tree_id, min_objectid, max_objectid, min_type, max_type):
+		assert tree_id == bi.BTRFS_ROOT_TREE_OBJECTID
+		for (objectid, type, offset), data in sorted(TREE.items()):
+			if (min_objectid, min_type) <= (objectid, type) <= (max_objectid, max_type):
+				yield objectid, type, offset, 0, data
+
+	def ino_lookup(s, tree_id, objectid):
+		s.lookups.append((tree_id, objectid))
+		return DIRS[(tree_id, objectid)]
+
+
+def test_list_subvolumes():
+	result = sorted(bi.list_subvolumes(FakeSource()), key=lambda r: r['subvol_id'])
+	assert result == [
+		dict(subvol_id=256, generation=20, ro=False, local_uuid=U1, parent_uuid=None, received_uuid=None, path='data', backref=[5, 256, 'data']),
+		dict(subvol_id=257, generation=21, ro=True, local_uuid=U2, parent_uuid=U1, received_uuid=None, path='data/.bfg_snapshots/data/snap1', backref=[256, 300, 'snap1']),
+		dict(subvol_id=258, generation=22, ro=True, local_uuid=U3, parent_uuid=None, received_uuid=U2, path='received', backref=[5, 256, 'received']),
+	]
+
+
+def test_paths_are_resolved_once():
+	source = FakeSource()
+	bi.list_subvolumes(source)
+	assert sorted(source.lookups) == [(5, 256), (5, 256), (256, 300)]
+
+
+def test_cached_paths_are_reused():
+	cached = bi.list_subvolumes(FakeSource())
+	cached[2]['path'] = 'from cache'
+	source = FakeSource()
+	result = {r['subvol_id']: r['path'] for r in bi.list_subvolumes(source, cached, 19)}
+	# 257 lives in 256, which was modified after generation 19, so it's looked up again. id5 wasn't modified.
+	assert source.lookups == [(256, 300)]
+	assert result[258] == 'from cache'
+
+
+def test_cached_paths_of_moved_subvolumes_are_not_reused():
+	cached = bi.list_subvolumes(FakeSource())
+	for r in cached:
+		r['backref'][2] = 'old name'
+	source = FakeSource()
+	bi.list_subvolumes(source, cached, 30)
+	assert len(source.lookups) == 3
+
+
+def test_tree_search_pages_through_results(tmp_path, monkeypatch):
+	calls = []
+
+	def fake_ioctl(fd, request, buf, mutate):
+		""" a kernel that returns at most two items per call, from keys between min and max """
+		assert request == bi.BTRFS_IOC_TREE_SEARCH
+		key = bi.SEARCH_KEY.unpack_from(buf, 0)
+		tree_id, min_objectid, max_objectid, min_offset, max_offset, min_transid, max_transid, min_type, max_type = key[:9]
+		calls.append((min_objectid, min_type, min_offset))
+		found = [k for k in sorted(TREE) if (min_objectid, min_type, min_offset) <= k <= (max_objectid, max_type, max_offset)][:2]
+		pos = bi.SEARCH_KEY.size
+		for objectid, type, offset in found:
+			data = TREE[(objectid, type, offset)]
+			bi.SEARCH_HEADER.pack_into(buf, pos, 0, objectid, offset, type, len(data))
+			pos += bi.SEARCH_HEADER.size
+			buf[pos:pos + len(data)] = data
+			pos += len(data)
+		struct.pack_into('<I', buf, 64, len(found))
+		return 0
+
+	monkeypatch.setattr(bi.fcntl, 'ioctl', fake_ioctl)
+	with bi.IoctlSource(str(tmp_path)) as source:
+		keys = [(objectid, type, offset) for objectid, type, offset, _, _ in source.tree_search(1, 256, 2**64 - 256, bi.BTRFS_ROOT_ITEM_KEY, bi.BTRFS_ROOT_BACKREF_KEY)]
+	assert keys == [k for k in sorted(TREE) if k[0] >= 256]
+	assert calls[:3] == [(256, 132, 0), (256, 144, 6), (257, 132, 16)]
@@ -0,0 +1,51 @@
+"""Tests for `btrfsgit.compression`."""
+
+import random
+import shutil
+
+import pytest
+
+from btrfsgit import compression, pump
+
+
+needs_zstd = pytest.mark.skipif(not shutil.which('zstd'), reason='no zstd')
+
+
+def test_parse():
+	assert compression.parse(None) is None
+	assert compression.parse('none') is None
+	assert compression.parse('auto') == 'auto'
+	assert compression.parse('zstd') == ('zstd', 3)
+	assert compression.parse('lz4:9') == ('lz4', 9)
+	with pytest.raises(Exception):
+		compression.parse('zstd:30')
+	with pytest.raises(Exception):
+		compression.parse('gzip')
+
+
+def test_sample_without_randbytes(monkeypatch):
+	# python 3.8 has no Random.randbytes
+	monkeypatch.delattr(random.Random, 'randbytes', raising=False)
+	data = compression.sample(300 << 10)
+	assert len(data) == 300 << 10
+	assert data == compression.sample(300 << 10)
+
+
+@needs_zstd
+def test_choose():
+	data = compression.sample(1 << 20)
+	candidates = [('zstd', 6), ('zstd', 1)]
+	assert compression.choose(1, data, candidates) == ('zstd', 6)
+	assert compression.choose(1e15, data, candidates) is None
+
+
+@needs_zstd
+def test_roundtrip_through_a_chain(tmp_path):
+	stream = tmp_path / 'stream'
+	stream.write_bytes(compression.sample(1 << 20))
+	out = tmp_path / 'out'
+	raw, wire, _ = pump.chain([['cat', str(stream)], compression.compress_cmd('zstd', 3), compression.decompress_cmd('zstd'), ['sh', '-c', f'cat > {out}']])
+	assert out.read_bytes() == stream.read_bytes()
+	summary = compression.summary('zstd', 3, raw, wire)
+	assert summary['raw_bytes'] == 1 << 20
+	assert summary['ratio'] > 1
@@ -0,0 +1,49 @@
+"""Tests for `btrfsgit.daemon`, with a fake job runner."""
+
+import threading
+
+import pytest
+
+from btrfsgit import daemon
+
+
+@pytest.fixture
+def running(tmp_path):
+	jobs = []
+
+	def run_job(job):
+		jobs.append(job)
+		if job['op'] == 'fail':
+			raise Exception('nope')
+		return dict(result=job.get('subvol'), transfer=dict(bytes=1))
+
+	d = daemon.Daemon(run_job, str(tmp_path / 'bfg.sock'), schedules=[dict(every=3600, op='push', subvol='/s')])
+	thread = threading.Thread(target=d.serve_forever, daemon=True)
+	thread.start()
+	while not (tmp_path / 'bfg.sock').exists():
+		pass
+	yield d, jobs
+	d.stop()
+	thread.join()
+
+
+def test_requests(running, capsys):
+	d, jobs = running
+	sock = d.socket_path
+	r = daemon.request(dict(op='push', subvol='/data', remote='nas:/b'), sock)
+	assert r['result'] == '/data' and r['transfer'] == dict(bytes=1)
+	assert 'nope' in daemon.request(dict(op='fail'), sock)['error']
+	assert daemon.client_main(['--socket', sock, 'commit', '/data', 'TAG=x', 'N=3']) == 0
+	assert jobs[-1] == dict(op='commit', subvol='/data', args=dict(TAG='x', N=3))
+	# the schedule runs right away, once
+	status = daemon.request(dict(op='status'), sock)['result']
+	while status['schedules'][0]['runs'] == 0:
+		status = daemon.request(dict(op='status'), sock)['result']
+	assert status['schedules'][0]['runs'] == 1
+	assert status['served'] == 4
+	assert dict(op='push', subvol='/s') in jobs
+
+
+def test_mount_watch():
+	w = daemon.MountWatch()
+	assert w.changed() is False
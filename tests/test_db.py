@@ -0,0 +1,128 @@
+"""Tests for `btrfsgit.db`, on an in-memory SQLite database."""
+
+import random
+
+import pytest
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+
+from btrfsgit import db
+from btrfsgit.volwalker import VolWalker
+
+
+@pytest.fixture
+def session():
+	engine = create_engine('sqlite://')
+	db.Base.metadata.create_all(engine)
+	return Session(engine)
+
+
+def snap(local_uuid, path, ro=True, parent_uuid=None):
+	return dict(id='fs1_' + local_uuid, fs_uuid='fs1', local_uuid=local_uuid, parent_uuid=parent_uuid, received_uuid=None, host='a', fs='/mnt', path=path, subvol_id=256, ro=ro)
+
+
+def rows(session):
+	with session.begin():
+		return {r.local_uuid: (r.path, r.ro, r.deleted) for r in session.scalars(select(db.Snapshot))}
+
+
+def test_sync_snapshots(session):
+	with session.begin():
+		assert db.sync_snapshots(session, 'fs1', [snap('u1', '/mnt/a'), snap('u2', '/mnt/b')]) == (2, 0, 0)
+	with session.begin():
+		assert db.sync_snapshots(session, 'fs1', [snap('u1', '/mnt/a'), snap('u2', '/mnt/b')]) == (0, 0, 0)
+	with session.begin():
+		assert db.sync_snapshots(session, 'fs1', [snap('u1', '/mnt/a', ro=False), snap('u3', '/mnt/c')]) == (1, 1, 1)
+	assert rows(session) == {
+		'u1': ('/mnt/a', False, False),
+		'u2': ('/mnt/b', True, True),
+		'u3': ('/mnt/c', True, False),
+	}
+	# a deleted row stays deleted, until the subvol shows up again
+	with session.begin():
+		assert db.sync_snapshots(session, 'fs1', [snap('u1', '/mnt/a', ro=False), snap('u3', '/mnt/c')]) == (0, 0, 0)
+	with session.begin():
+		assert db.sync_snapshots(session, 'fs1', [snap('u1', '/mnt/a', ro=False), snap('u2', '/mnt/b'), snap('u3', '/mnt/c')]) == (0, 1, 0)
+	assert rows(session)['u2'] == ('/mnt/b', True, False)
+
+
+def test_sync_leaves_other_filesystems_alone(session):
+	other = dict(snap('x1', '/other'), fs_uuid='fs2', id='fs2_x1')
+	with session.begin():
+		db.sync_snapshots(session, 'fs2', [other])
+		db.sync_snapshots(session, 'fs1', [snap('u1', '/mnt/a')])
+	with session.begin():
+		db.sync_snapshots(session, 'fs1', [])
+	assert rows(session) == {'x1': ('/other', True, False), 'u1': ('/mnt/a', True, True)}
+
+
+def test_sqlite_catalog(tmp_path, monkeypatch):
+	monkeypatch.setattr(db, '_engine', None)
+	monkeypatch.setattr(db, '_url', None)
+	path = tmp_path / '.bfg' / 'catalog.sqlite'
+	db.configure(db.sqlite_url(path))
+	with db.session() as session, session.begin():
+		assert session.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+		db.sync_snapshots(session, 'fs1', [snap('u1', '/mnt/a')])
+	assert path.exists()
+	db.get_engine().dispose()
+
+
+def test_lineage(session):
+	with session.begin():
+		db.sync_snapshots(session, 'fs1', [
+			snap('rw', '/mnt/rw', ro=False),
+			snap('s1', '/mnt/s1', parent_uuid='rw'),
+			snap('s2', '/mnt/s2', parent_uuid='rw'),
+			snap('unrelated', '/mnt/x', parent_uuid='other'),
+		])
+		db.sync_snapshots(session, 'fs2', [
+			dict(snap('r1', '/b/s1'), fs_uuid='fs2', id='fs2_r1', received_uuid='s1'),
+			dict(snap('r1rw', '/b/rw', ro=False, parent_uuid='r1'), fs_uuid='fs2', id='fs2_r1rw'),
+		])
+	with session.begin():
+		assert sorted(r.local_uuid for r in db.lineage(session, 'rw')) == ['r1', 'r1rw', 'rw', 's1', 's2']
+		assert sorted(r.local_uuid for r in db.iter_snapshots(session, db.Snapshot.fs_uuid == 'fs2', columns=['local_uuid'])) == ['r1', 'r1rw']
+
+
+def python_mrcs(records, my_uuid, fs_uuid):
+	""" the reference: VolWalker, once for each other filesystem, like Bfg.most_recent_common_snapshots does it """
+	result = {}
+	for remote in sorted(set(r['fs_uuid'] for r in records) - {fs_uuid}):
+		by_uuid = {}
+		for r in records:
+			machine = 'local' if r['fs_uuid'] == fs_uuid else 'remote' if r['fs_uuid'] == remote else 'other'
+			by_uuid[r['local_uuid']] = dict(r, machine=machine)
+		candidates = list(VolWalker(by_uuid, ('local', 'remote')).walk(my_uuid))
+		if candidates:
+			result[remote] = candidates[0]['local_uuid']
+	return result
+
+
+def random_records(rnd, n):
+	records = []
+	for i in range(n):
+		fs = rnd.choice(['fs1', 'fs1', 'fs2', 'fs3'])
+		parent_uuid = received_uuid = None
+		if i and rnd.random() < 0.9:
+			parent_uuid = rnd.choice(records)['local_uuid']
+		if i and rnd.random() < 0.4:
+			received_uuid = rnd.choice(records)['local_uuid']
+		records.append(dict(id=f'{fs}_u{i}', fs_uuid=fs, local_uuid=f'u{i:03}', parent_uuid=parent_uuid, received_uuid=received_uuid, host=fs, fs='/' + fs, path=f'/{fs}/u{i}', subvol_id=rnd.randint(256, 300), ro=rnd.random() < 0.7))
+	return records
+
+
+def test_sql_mrcs_matches_volwalker():
+	rnd = random.Random(1)
+	for _ in range(150):
+		records = random_records(rnd, rnd.randint(1, 40))
+		engine = create_engine('sqlite://')
+		db.Base.metadata.create_all(engine)
+		with Session(engine) as session, session.begin():
+			for fs in ('fs1', 'fs2', 'fs3'):
+				db.sync_snapshots(session, fs, [r for r in records if r['fs_uuid'] == fs])
+			for r in records:
+				if r['fs_uuid'] != 'fs1':
+					continue
+				sql = {row.remote_fs_uuid: row.local_uuid for row in db.most_recent_common_snapshots(session, r['local_uuid'], 'fs1')}
+				assert sql == python_mrcs(records, r['local_uuid'], 'fs1'), (records, r['local_uuid'])
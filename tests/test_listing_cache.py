@@ -0,0 +1,83 @@
+"""Tests for `btrfsgit.listing_cache`, and for how Bfg uses it for local listings."""
+
+from pathlib import Path
+
+import pytest
+
+from btrfsgit.btrfsgit import Bfg, mutates_subvolumes
+from btrfsgit.listing_cache import ListingCache
+
+
+def test_store_load_invalidate(tmp_path):
+	cache = ListingCache(tmp_path)
+	assert cache.load('fs1') is None
+	cache.store('fs1', 7, [dict(local_uuid='a', path='data')])
+	cache.store('fs2', 3, [])
+	assert cache.load('fs1') == dict(generation=7, subvols=[dict(local_uuid='a', path='data')], stale=False)
+	cache.invalidate('fs1')
+	assert cache.load('fs1')['stale'] and not cache.load('fs2')['stale']
+	cache.invalidate()
+	assert cache.load('fs2') == dict(generation=3, subvols=[], stale=True)
+
+
+@pytest.fixture
+def bfg(tmp_path, monkeypatch):
+	""" a Bfg with the listing cache in tmp_path, a filesystem whose generation is fs['generation'], and the ioctl lister counting its calls in fs['listed'] """
+	b = Bfg(YES=True)
+	b._listing_cache = ListingCache(tmp_path)
+	fs = dict(generation=10, listed=0)
+
+	def list_ioctl(mount, subvolume, cached):
+		fs['listed'] += 1
+		return [dict(local_uuid='a', path=mount / 'data'), dict(local_uuid='b', path=mount / '.bfg_snapshots/data_1')]
+
+	monkeypatch.setattr(b, '_local_fs_info', lambda path: dict(fsid='fs1', generation=fs['generation']))
+	monkeypatch.setattr(b, '_list_subvolumes_ioctl', list_ioctl)
+	b.fs = fs
+	return b
+
+
+def listing(b):
+	return b._list_local_subvolumes(None, Path('/mnt'), '/mnt/data')
+
+
+def test_hit_at_the_same_generation(bfg):
+	assert [r['path'] for r in listing(bfg)] == [Path('/mnt/data'), Path('/mnt/.bfg_snapshots/data_1')]
+	again = listing(bfg)
+	assert bfg.fs['listed'] == 1
+	assert [(r['path'], r['src']) for r in again] == [(Path('/mnt/data'), 'cache'), (Path('/mnt/.bfg_snapshots/data_1'), 'cache')]
+
+
+def test_miss_when_the_generation_moves(bfg):
+	listing(bfg)
+	bfg.fs['generation'] = 11
+	listing(bfg)
+	assert bfg.fs['listed'] == 2
+	assert bfg._listing_cache.load('fs1')['generation'] == 11
+
+
+def test_miss_when_stale(bfg, tmp_path):
+	listing(bfg)
+	bfg._local_fs_changed(tmp_path)
+	assert bfg._listing_cache.load('fs1')['stale']
+	listing(bfg)
+	assert bfg.fs['listed'] == 2
+	assert not bfg._listing_cache.load('fs1')['stale']
+
+
+@pytest.mark.parametrize('cmd, mutates', [
+	('btrfs subvolume snapshot -r /a /b', True),
+	('btrfs sub delete /b', True),
+	('btrfs su create /c', True),
+	('btrfs receive /d', True),
+	('btrfs property set -ts /b ro false', True),
+	('btrfs prop set /b ro true', True),
+	('btrfs subvolume set-default 256 /', False),
+	('btrfs subvolume list /', False),
+	('btrfs subvolume show /a', False),
+	('btrfs property get /b ro', False),
+	('btrfs send /b', False),
+	('rm -rf /b', False),
+])
+def test_mutates_subvolumes(cmd, mutates):
+	assert mutates_subvolumes(cmd.split()) == mutates
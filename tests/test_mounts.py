@@ -0,0 +1,67 @@
+"""Tests for `btrfsgit.mounts`, on a made-up mount table with two btrfs filesystems."""
+
+import subprocess
+
+from btrfsgit import mounts
+
+
+MOUNTINFO = r"""22 1 0:21 /@ / rw,relatime shared:1 - btrfs /dev/mapper/root rw,ssd,space_cache=v2,subvolid=256,subvol=/@
+23 22 0:21 /@home /home rw,relatime shared:2 - btrfs /dev/mapper/root rw,ssd,space_cache=v2,subvolid=257,subvol=/@home
+24 22 0:21 / /mnt/root\040top rw,relatime shared:3 - btrfs /dev/mapper/root rw,ssd,space_cache=v2,subvolid=5,subvol=/
+25 22 0:30 /data /srv/data rw,relatime shared:4 - btrfs /dev/sdb1 rw,subvolid=300,subvol=/data
+26 22 0:5 / /proc rw,nosuid shared:5 - proc proc rw
+"""
+
+DEVICES = ['/sys/fs/btrfs/aaaa-1111/devices/dm-0', '/sys/fs/btrfs/bbbb-2222/devices/sdb1']
+
+
+def table(overrides={}):
+	return mounts.MountTable(mounts.parse_mountinfo(MOUNTINFO), mounts.uuids_by_device(DEVICES), {'/dev/mapper/root': '/dev/dm-0', '/dev/sdb1': '/dev/sdb1'}, overrides)
+
+
+def test_resolve():
+	t = table()
+	assert t.resolve('/home/me/x') == dict(mount_point='/home', fs_uuid='aaaa-1111', id5='/mnt/root top')
+	assert t.resolve('/etc') == dict(mount_point='/', fs_uuid='aaaa-1111', id5='/mnt/root top')
+	# the top level of the second filesystem isn't mounted anywhere
+	assert t.resolve('/srv/data/a') == dict(mount_point='/srv/data', fs_uuid='bbbb-2222', id5=None)
+	assert t.resolve('/proc/1')['fs_uuid'] is None
+
+
+def test_override():
+	t = table({'/srv/data': '/mnt/data_top'})
+	assert t.resolve('/srv/data/a')['id5'] == '/mnt/data_top'
+	assert t.resolve('/home')['id5'] == '/mnt/root top'
+
+
+def test_script_runs_here():
+	r = mounts.parse_script_output(subprocess.check_output(['sh', '-c', mounts.SCRIPT], text=True))
+	assert r['mounts'] == mounts.gather()['mounts']
+	assert '*' not in r['devices']
+
+
+def test_override_stays_on_its_filesystem():
+	t = table({'/': '/mnt/root top'})
+	assert t.resolve('/home/me') == dict(mount_point='/home', fs_uuid='aaaa-1111', id5='/mnt/root top')
+	# /srv/data is the other disk, the id5 file at / isn't about it
+	assert t.resolve('/srv/data/a') == dict(mount_point='/srv/data', fs_uuid='bbbb-2222', id5=None)
+
+
+def test_local_walk_stops_at_the_mount_point(tmp_path):
+	from btrfsgit.btrfsgit import Bfg
+	disk = tmp_path / 'disk'
+	(disk / 'data' / 'deeper').mkdir(parents=True)
+	# an id5 file of the filesystem that the second disk is mounted on
+	(tmp_path / '.bfg').mkdir()
+	(tmp_path / '.bfg' / 'id5').write_text('/mnt/root top\n')
+	mountinfo = MOUNTINFO + f'27 22 0:31 / {disk} rw - btrfs /dev/sdc1 rw,subvolid=5,subvol=/\n'
+	b = Bfg(YES=True, LISTING_CACHE=False)
+	b._mounts['local'] = mounts.MountTable(mounts.parse_mountinfo(mountinfo), mounts.uuids_by_device(DEVICES + ['/sys/fs/btrfs/cccc-3333/devices/sdc1']), {}, {})
+	assert b.find_local_fs_id5_mount_point(disk / 'data') == disk
+	# below the mount point, id5 files still count, for a filesystem mounted here as the "remote" side too
+	(disk / 'data' / '.bfg').mkdir()
+	(disk / 'data' / '.bfg' / 'id5').write_text(str(disk) + '\n')
+	b = Bfg('', YES=True, LISTING_CACHE=False)
+	b._mounts['local'] = mounts.MountTable(mounts.parse_mountinfo(MOUNTINFO), mounts.uuids_by_device(DEVICES), {}, {})
+	assert b.find_local_fs_id5_mount_point(disk / 'data' / 'deeper') == disk
+	assert b.find_remote_fs_id5_mount_point(disk / 'data' / 'deeper') == disk
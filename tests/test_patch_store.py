@@ -0,0 +1,84 @@
+"""Tests for `btrfsgit.patch_store`, on index entries without stream files, and for generating patches into a store with btrfs stubbed out."""
+
+from btrfsgit.btrfsgit import Bfg, Res
+from btrfsgit.patch_store import PatchStore
+
+
+def patch(snapshot_uuid, parent_uuid, size, created, subvol_uuid='sv'):
+	return dict(file=f'{snapshot_uuid}__{parent_uuid}', snapshot_uuid=snapshot_uuid, parent_uuid=parent_uuid, subvol_uuid=subvol_uuid, name=snapshot_uuid, codec=None, size=size, sha256='', created=created)
+
+
+# a full stream of a, patches a->b->c, and a newer full stream of c
+PATCHES = [
+	patch('a', None, 1000, '2024-01-01'),
+	patch('b', 'a', 10, '2024-01-02'),
+	patch('c', 'b', 10, '2024-01-03'),
+	patch('c2', None, 5000, '2024-01-04'),
+	patch('d', 'c', 10, '2024-01-05'),
+]
+
+
+def files(patches):
+	return [p['file'] for p in patches]
+
+
+def test_chain(tmp_path):
+	store = PatchStore(tmp_path)
+	assert files(store.chain({'b'}, 'd', PATCHES)) == ['c__b', 'd__c']
+	assert files(store.chain(set(), 'd', PATCHES)) == ['a__None', 'b__a', 'c__b', 'd__c']
+	assert store.chain({'d'}, 'd', PATCHES) == []
+	assert store.chain(set(), 'nope', PATCHES) is None
+
+
+def test_chain_prefers_fewer_bytes(tmp_path):
+	patches = PATCHES + [patch('d', 'a', 500, '2024-01-06')]
+	assert files(PatchStore(tmp_path).chain({'a'}, 'd', patches)) == ['b__a', 'c__b', 'd__c']
+	patches = PATCHES + [patch('d', 'a', 5, '2024-01-06')]
+	assert files(PatchStore(tmp_path).chain({'a'}, 'd', patches)) == ['d__a']
+
+
+def test_superseded(tmp_path):
+	store = PatchStore(tmp_path)
+	assert store.superseded(PATCHES) == [PATCHES[3]]
+	# once there's a cheap way from nothing to the newest snapshot, the old full stream and its patches go
+	newer = PATCHES + [patch('e', None, 100, '2024-01-07')]
+	assert files(store.superseded(newer)) == ['a__None', 'b__a', 'c__b', 'c2__None', 'd__c']
+
+
+def test_add_and_remove(tmp_path):
+	store = PatchStore(tmp_path)
+	(tmp_path / 'x.btrfs').write_bytes(b'stream')
+	p = store.add('x.btrfs', 'x', None, 'sv', 'x', None)
+	assert p['size'] == 6
+	assert store.newest() == p
+	store.remove([p])
+	assert store.load() == []
+	assert not (tmp_path / 'x.btrfs').exists()
+
+
+def test_second_patch_is_against_the_stored_snapshot(tmp_path, monkeypatch):
+	b = Bfg(YES=True, LISTING_CACHE=False)
+	uuids = {'/data': 'sv'}
+	sent = []
+
+	def local_commit(SUBVOL):
+		snapshot = f'/data/.bfg_snapshots/s{len(uuids)}'
+		uuids[snapshot] = f'u{len(uuids)}'
+		return Res(snapshot)
+
+	def local_send(snapshot, target, PARENT, path=None, codec=None):
+		sent.append((snapshot, PARENT))
+		with open(path, 'wb') as f:
+			f.write(b'stream')
+
+	# listing records have no 'machine', unlike records from the db
+	listing = lambda cmd, SUBVOL, src: [dict(local_uuid=u, path=p) for p, u in uuids.items()]
+	monkeypatch.setattr(b, 'get_subvol', lambda cmd, path: Res(dict(local_uuid=uuids[str(path)])))
+	monkeypatch.setattr(b, 'local_commit', local_commit)
+	monkeypatch.setattr(b, 'local_send', local_send)
+	monkeypatch.setattr(b, '_get_subvolumes', listing)
+
+	b.commit_and_generate_patch('/data', str(tmp_path))
+	b.commit_and_generate_patch('/data', str(tmp_path))
+	assert sent == [('/data/.bfg_snapshots/s1', None), ('/data/.bfg_snapshots/s2', '/data/.bfg_snapshots/s1')]
+	assert [(p['snapshot_uuid'], p['parent_uuid']) for p in PatchStore(tmp_path).load()] == [('u1', None), ('u2', 'u1')]
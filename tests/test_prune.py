@@ -0,0 +1,101 @@
+"""Tests for pruning: what is prunable, deleting in batches, and planning prune_all."""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from btrfsgit.btrfsgit import Bfg
+
+
+def snapshots(now, ages):
+	return [dict(path=f'/s/{i}', dt=now - age) for i, age in enumerate(ages)]
+
+
+def test_prunable_stops_at_mrc():
+	b = Bfg(YES=True)
+	now = datetime.now()
+	# all in the under-1-min bucket, where only the last one is kept
+	snaps = snapshots(now, [timedelta(seconds=50), timedelta(seconds=40), timedelta(seconds=30), timedelta(seconds=1)])
+	assert b._prunable(snaps, set()) == ['/s/0', '/s/1', '/s/2']
+	assert b._prunable(snaps, {'/s/1'}) == ['/s/0']
+	assert b._prunable([], set()) == []
+
+
+def test_delete_in_batches(monkeypatch):
+	b = Bfg(YES=True, LISTING_CACHE=False)
+	commands = []
+	monkeypatch.setattr(b, '_local_cmd', lambda c, *a, **k: commands.append(c))
+	paths = [f'/s/{i}' for i in range(5)]
+	r = b._prune({'local': (b, 'local', paths), 'remote': (b, 'remote', [])}, DRY_RUN=False, COMMIT='after')
+	assert r.val == paths
+	assert r.extra['summary']['local']['count'] == 5
+	assert commands == [['btrfs', 'subvolume', 'delete', '--commit-after'] + paths]
+	commands.clear()
+	r = b._delete_subvolumes('local', paths, 'after', batch=2)
+	assert commands == [
+		['btrfs', 'subvolume', 'delete', '/s/0', '/s/1'],
+		['btrfs', 'subvolume', 'delete', '/s/2', '/s/3'],
+		['btrfs', 'subvolume', 'delete', '--commit-after', '/s/4']]
+	assert r['batches'] == 3
+
+
+def test_plan_prune_all(tmp_path, monkeypatch):
+	from btrfsgit import db
+	monkeypatch.setattr(db, '_engine', None)
+	monkeypatch.setattr(db, '_url', None)
+	b = Bfg(YES=True, DB=db.sqlite_url(tmp_path / 'catalog.sqlite'), LISTING_CACHE=False)
+	monkeypatch.setattr(b, 'local_fs_uuid', lambda subvol: 'fs1')
+
+	def rec(uuid, path, fs_uuid='fs1', ro=True, parent_uuid=None, received_uuid=None):
+		return dict(id=fs_uuid + uuid, fs_uuid=fs_uuid, local_uuid=uuid, parent_uuid=parent_uuid, received_uuid=received_uuid, host='a', fs='/mnt', path=path, subvol_id=256, ro=ro)
+
+	def snaps(subvol, uuids):
+		return [rec(u, f'/mnt/.bfg_snapshots/{subvol}/{subvol}_2020-01-{i + 5:02}_00-00-00_a', parent_uuid=subvol) for i, u in enumerate(uuids)]
+
+	b._configure_db('/mnt')
+	with db.session() as session, session.begin():
+		db.sync_snapshots(session, 'fs1', [rec('data', '/mnt/data', ro=False), rec('home', '/mnt/home', ro=False)] + snaps('data', ['d1', 'd2', 'd3']) + snaps('home', ['h1', 'h2']))
+		db.sync_snapshots(session, 'fs2', [rec('r2', '/nas/.bfg_snapshots/data/data_2020-01-06_00-00-00_a', fs_uuid='fs2', received_uuid='d2')])
+	plan = b._plan_prune_all('/mnt', {})
+	db.get_engine().dispose()
+	assert [(x['subvol'], x['local'], x['mrcs']) for x in plan['subvolumes']] == [
+		('/mnt/data', ['/mnt/.bfg_snapshots/data/data_2020-01-05_00-00-00_a'], {'fs2': '/mnt/.bfg_snapshots/data/data_2020-01-06_00-00-00_a'}),
+		('/mnt/home', ['/mnt/.bfg_snapshots/home/home_2020-01-05_00-00-00_a'], {})]
+
+
+def test_local_catalog_needs_the_other_side(tmp_path, monkeypatch):
+	from pathlib import Path
+	from btrfsgit import db
+	from btrfsgit.btrfsgit import Res
+	monkeypatch.setattr(db, '_engine', None)
+	monkeypatch.setattr(db, '_url', None)
+
+	def rec(uuid, path, ro=True, parent_uuid=None, received_uuid=None):
+		return dict(local_uuid=uuid, parent_uuid=parent_uuid, received_uuid=received_uuid, path=Path(path), subvol_id=256, ro=ro)
+
+	def bfg(**options):
+		b = Bfg(YES=True, DB='local', LISTING_CACHE=False, **options)
+		b._local_fs_id5_mount_points.update({'/mnt': tmp_path, '/mnt/data': tmp_path})
+		monkeypatch.setattr(b, 'local_fs_uuid', lambda subvol: 'fs1')
+		monkeypatch.setattr(b, 'get_subvol', lambda cmd, subvol: Res(dict(local_uuid='data')))
+		return b
+
+	b = bfg()
+	here = [rec('data', '/mnt/data', ro=False)] + [rec(u, f'/mnt/.bfg_snapshots/data/data_2020-01-{i + 5:02}_00-00-00_a', parent_uuid='data') for i, u in enumerate(['d1', 'd2', 'd3'])]
+	monkeypatch.setattr(b, 'get_all_subvols_on_filesystem', lambda fs: Res([dict(x, fs_uuid='fs1', id='fs1_' + x['local_uuid'], host='a') for x in here]))
+	b.update_db('/mnt')
+	try:
+		with pytest.raises(Exception, match='update_db_remote'):
+			b._plan_prune_local('/mnt/data')
+		# the user says there's nothing else
+		assert len(bfg(PRUNE_WITHOUT_REMOTES=True)._plan_prune_local('/mnt/data')) == 2
+
+		# what the nas has, through the agent or a listing over ssh
+		monkeypatch.setattr(b, '_remote_prefetch', lambda path: None)
+		monkeypatch.setattr(b, 'remote_fs_uuid', lambda path: ('fs2', Path('/nas')))
+		monkeypatch.setattr(b, '_get_subvolumes', lambda cmd, mp, src: [rec('r2', '/nas/.bfg_snapshots/data/data_2020-01-06_00-00-00_a', received_uuid='d2')])
+		b.update_db_remote('/nas', '/mnt')
+		assert b._plan_prune_local('/mnt/data') == ['/mnt/.bfg_snapshots/data/data_2020-01-05_00-00-00_a']
+	finally:
+		db.get_engine().dispose()
+	assert (tmp_path / '.bfg' / 'catalog.sqlite').exists()
@@ -0,0 +1,74 @@
+"""Tests for `btrfsgit.pump`, with cat and sh standing in for send and receive."""
+
+import os
+import subprocess
+
+import pytest
+
+from btrfsgit import pump
+
+
+@pytest.fixture
+def stream(tmp_path):
+	path = tmp_path / 'stream'
+	path.write_bytes(os.urandom(3 * pump.CHUNK + 12345))
+	return path
+
+
+def test_run(stream, tmp_path):
+	out = tmp_path / 'out'
+	stats = pump.run(['cat', str(stream)], ['sh', '-c', f'cat > {out}'])
+	assert out.read_bytes() == stream.read_bytes()
+	assert stats['bytes'] == stream.stat().st_size
+	assert set(stats) == {'bytes', 'seconds', 'average_bytes_per_second', 'current_bytes_per_second', 'source_stall_seconds', 'sink_stall_seconds'}
+
+
+def test_run_without_splice(stream, tmp_path, monkeypatch):
+	monkeypatch.delattr(os, 'splice', raising=False)
+	out = tmp_path / 'out'
+	pump.run(['cat', str(stream)], ['sh', '-c', f'cat > {out}'])
+	assert out.read_bytes() == stream.read_bytes()
+
+
+def test_failing_consumer(stream):
+	with pytest.raises(subprocess.CalledProcessError) as e:
+		pump.run(['cat', str(stream)], ['sh', '-c', 'head -c 10 > /dev/null; exit 3'])
+	assert e.value.returncode == 3
+
+
+def test_failing_producer(tmp_path):
+	with pytest.raises(subprocess.CalledProcessError) as e:
+		pump.run(['sh', '-c', 'echo partial; exit 2'], ['sh', '-c', f'cat > {tmp_path / "out"}'])
+	assert e.value.returncode == 2
+
+
+def test_meter_windows():
+	now = [0.]
+	meter = pump.Meter(interval=10, clock=lambda: now[0])
+	now[0] = 5
+	meter.add(100)
+	assert meter.current == 0
+	now[0] = 10
+	meter.add(100)
+	assert meter.current == 20
+	now[0] = 20
+	summary = meter.summary()
+	assert summary['bytes'] == 200
+	assert summary['average_bytes_per_second'] == 10
+
+
+def test_run_into_file(stream, tmp_path):
+	out = tmp_path / 'out'
+	stats = pump.run(['cat', str(stream)], path=out)
+	assert out.read_bytes() == stream.read_bytes()
+	assert stats['bytes'] == stream.stat().st_size
+
+
+def test_tee(stream, tmp_path):
+	outs = [tmp_path / 'out1', tmp_path / 'out2']
+	results = pump.tee(['cat', str(stream)], [['sh', '-c', f'cat > {outs[0]}'], ['sh', '-c', 'head -c 10 > /dev/null; exit 4'], ['sh', '-c', f'cat > {outs[1]}']])
+	for out in outs:
+		assert out.read_bytes() == stream.read_bytes()
+	assert results[0]['bytes'] == results[2]['bytes'] == stream.stat().st_size
+	assert isinstance(results[1], subprocess.CalledProcessError)
+	assert results[1].returncode == 4
@@ -0,0 +1,46 @@
+import sys
+from types import SimpleNamespace
+
+import btrfsgit.pump as pump
+from btrfsgit.btrfsgit import Bfg, Res
+
+
+def test_with_remote_keeps_all_options():
+	b = Bfg(YES=True, LISTING_CACHE=False, MRCS='python', COMPRESS='zstd:5', RESUMABLE=True)
+	assert set(b._options) == set(Bfg.__init__.__code__.co_varnames[2:Bfg.__init__.__code__.co_argcount])
+	r = b._with_remote('somewhere')
+	assert r._options == b._options
+	assert r._sshstr == 'somewhere'
+	assert (r._mrcs, r._compress, r._resumable) == ('python', ('zstd', 5), True)
+
+
+def test_unreachable_target_doesnt_stop_the_others(monkeypatch):
+	b = Bfg(YES=True, LISTING_CACHE=False)
+	monkeypatch.setattr(b, 'get_subvol', lambda cmd, path: Res(dict(local_uuid='sv')))
+	with_remote = b._with_remote
+
+	def remote(sshstr):
+		r = with_remote(sshstr)
+		r._ssh = SimpleNamespace(argv=lambda: ['ssh', sshstr])
+		if sshstr == 'down':
+			r._remote_prefetch = lambda *a, **k: sys.exit(1)
+		else:
+			r._remote_prefetch = lambda *a, **k: None
+			r._remote_cmd = lambda *a, **k: ''
+			r.calculate_default_snapshot_parent_dir = lambda machine, subvol: Res(subvol / '.bfg_snapshots')
+			r.find_common_parent = lambda *a, **k: Res(None)
+		return r
+
+	tees = []
+
+	def tee(send, receivers, names):
+		tees.append(names)
+		return [dict(bytes=6)] * len(receivers)
+
+	monkeypatch.setattr(b, '_with_remote', remote)
+	monkeypatch.setattr(pump, 'tee', tee)
+	r = b.push_many('/data', '/data/.bfg_snapshots/s1', ['up:/a', 'down:/b', 'up2:/c']).val
+	assert tees == [['up:/a', 'up2:/c']]
+	assert 'SystemExit' in r['down:/b']['error']
+	assert r['up:/a']['path'] == '/a/.bfg_snapshots/s1'
+	assert r['up2:/c']['transfer'] == dict(bytes=6)
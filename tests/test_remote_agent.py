@@ -0,0 +1,95 @@
+"""Tests for `btrfsgit.remote_agent`, with a local python process standing in for the other machine."""
+
+import sys
+
+import pytest
+
+from btrfsgit import remote_agent
+from btrfsgit.remote_agent import AgentClient, AgentError
+
+
+SUB_SHOW = """data/.bfg_snapshots/data_2024-01-02_03-04-05_from_a
+	Name: 			data_2024-01-02_03-04-05_from_a
+	UUID: 			22222222-2222-2222-2222-222222222222
+	Parent UUID: 		11111111-1111-1111-1111-111111111111
+	Received UUID: 		-
+	Creation time: 		2024-01-02 03:04:05 +0100
+	Subvolume ID: 		257
+	Generation: 		21
+	Gen at creation: 	21
+	Parent ID: 		5
+	Top level ID: 		5
+	Flags: 			readonly
+	Snapshot(s):
+"""
+
+SUB_LIST = """ID	gen	top level	parent_uuid	received_uuid	uuid	path
+--	---	---------	-----------	-------------	----	----
+256	20	5	-	-	11111111-1111-1111-1111-111111111111	data
+257	21	5	11111111-1111-1111-1111-111111111111	-	22222222-2222-2222-2222-222222222222	.bfg_snapshots/data
+"""
+
+
+@pytest.fixture
+def agent():
+	a = AgentClient([sys.executable, '-c', remote_agent.BOOTSTRAP])
+	a.start()
+	yield a
+	a.close()
+
+
+def test_parse_sub_show():
+	assert remote_agent.parse_sub_show(SUB_SHOW) == dict(
+		local_uuid='22222222-2222-2222-2222-222222222222',
+		parent_uuid='11111111-1111-1111-1111-111111111111',
+		received_uuid=None,
+		subvol_id=257,
+		ro=True)
+
+
+def test_parse_sub_list():
+	lines = SUB_LIST.splitlines()[2:]
+	assert [remote_agent.parse_sub_list_line(l) for l in lines] == [
+		dict(subvol_id=256, generation=20, parent_uuid=None, received_uuid=None, local_uuid='11111111-1111-1111-1111-111111111111', path='data'),
+		dict(subvol_id=257, generation=21, parent_uuid='11111111-1111-1111-1111-111111111111', received_uuid=None, local_uuid='22222222-2222-2222-2222-222222222222', path='.bfg_snapshots/data'),
+	]
+
+
+def test_batch(agent, tmp_path):
+	(tmp_path / '.bfg').mkdir()
+	(tmp_path / '.bfg' / 'id5').write_text(str(tmp_path) + '\n')
+	sub = tmp_path / 'a' / 'b'
+	results = agent.batch([
+		('test', dict(path=str(sub))),
+		('mkdir', dict(path=str(sub))),
+		('test', dict(path=str(sub))),
+		('id5', dict(path=str(sub))),
+		('id5', dict(path='/')),
+	])
+	assert results == [False, None, True, str(tmp_path), None]
+	assert agent.round_trips == 2
+
+
+def test_snapshot_parent_dir_of_missing_subvol(agent, tmp_path):
+	assert agent.call('snapshot_parent_dir', subvol=str(tmp_path / 'new')) == str(tmp_path)
+
+
+def test_errors_are_raised(agent):
+	with pytest.raises(AgentError):
+		agent.call('ins_sub', subvol_id=256, path='/nonexistent')
+	# and the agent lives on
+	assert agent.call('ping') == 'pong'
+
+
+def test_run(agent):
+	assert agent.call('run', cmd=['echo', 'hi']) == dict(returncode=0, stdout='hi\n')
+	assert agent.call('run', cmd=['false'])['returncode'] == 1
+
+
+def test_helper_cmd_of_missing_executable(agent):
+	from btrfsgit.btrfsgit import Bfg
+	b = Bfg(YES=True, LISTING_CACHE=False)
+	assert b._helper_cmd(agent, ['/nonexistent/btrfs'], die_on_error=False) == -1
+	with pytest.raises(SystemExit):
+		b._helper_cmd(agent, ['/nonexistent/btrfs'], die_on_error=True)
+	assert b._helper_cmd(agent, ['echo', 'hi'], die_on_error=False) == 'hi\n'
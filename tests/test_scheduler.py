@@ -0,0 +1,72 @@
+"""Tests for `btrfsgit.scheduler`."""
+
+import threading
+import time
+
+import pytest
+
+from btrfsgit.scheduler import Scheduler
+
+
+def test_limits_per_key():
+	lock = threading.Lock()
+	now = {}
+	peak = {}
+
+	def fn(job):
+		with lock:
+			for r in job:
+				now[r] = now.get(r, 0) + 1
+				peak[r] = max(peak.get(r, 0), now[r])
+		time.sleep(0.02)
+		with lock:
+			for r in job:
+				now[r] -= 1
+		if job == [('host', 'b'), ('disk', 'd2')]:
+			raise Exception('boom')
+		return len(job)
+
+	jobs = [[('host', 'a'), ('disk', 'd1')], [('host', 'a'), ('disk', 'd2')], [('host', 'b'), ('disk', 'd1')], [('host', 'b'), ('disk', 'd2')], [('disk', 'd3')]] * 2
+	results = Scheduler(dict(host=1, disk=2)).run([(j, j) for j in jobs], fn)
+	assert peak[('host', 'a')] == peak[('host', 'b')] == 1
+	assert max(peak[('disk', d)] for d in ('d1', 'd2', 'd3')) <= 2
+	assert [r.get('result') for r in results] == [2, 2, 2, None, 1] * 2
+	assert 'boom' in results[3]['error']
+
+
+def test_max_jobs():
+	running = []
+	peak = []
+
+	def fn(job):
+		running.append(job)
+		peak.append(len(running))
+		time.sleep(0.01)
+		running.remove(job)
+
+	Scheduler({}, max_jobs=2).run([(i, []) for i in range(6)], fn)
+	assert max(peak) <= 2
+
+
+def test_run_manifest(tmp_path, monkeypatch):
+	import json
+	from btrfsgit import btrfsgit
+	calls = []
+	monkeypatch.setitem(btrfsgit.MANIFEST_OPS, 'fake', lambda b, subvol, remote, args: calls.append((b._sshstr, subvol, remote, args)) or btrfsgit.Res(subvol, n=len(calls)))
+	monkeypatch.setattr(btrfsgit.Bfg, 'local_fs_uuid', lambda s, subvol: 'fs-' + subvol[1])
+	manifest = tmp_path / 'manifest.json'
+	manifest.write_text(json.dumps(dict(jobs=[
+		dict(op='fake', subvol='/a'),
+		dict(op='fake', subvol='/b', remote=':/backup/b', args=dict(x=1))])))
+	b = btrfsgit.Bfg(YES=True, SSH_MULTIPLEX=False)
+	r = b.run_manifest(str(manifest))
+	assert sorted(calls) == [('', '/a', None, {}), ('', '/b', '/backup/b', {'x': 1})]
+	assert [(x['subvol'], x['result']) for x in r.val] == [('/a', '/a'), ('/b', '/b')]
+
+
+def test_manifest_op_without_args_refuses_them():
+	from btrfsgit import btrfsgit
+	with pytest.raises(TypeError):
+		btrfsgit.MANIFEST_OPS['remote_commit_and_pull'](None, '/a', '/backup/a', dict(PARENT='/x'))
+	with pytest.raises(TypeError):
+		btrfsgit.MANIFEST_OPS['update_db'](None, '/a', None, dict(x=1))
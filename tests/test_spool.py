@@ -0,0 +1,75 @@
+"""Tests for `btrfsgit.spool`, in-process, with small chunks."""
+
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+from btrfsgit import spool
+
+
+CHUNK = 1000
+
+
+def framed(data, sums=(), ok=True):
+	out = io.BytesIO()
+	spool.skip(list(sums), CHUNK, io.BytesIO(data), out)
+	if ok:
+		out.write(spool.HEADER.pack(0))
+	return out.getvalue()
+
+
+def spooled(directory):
+	out = io.BytesIO()
+	spool.feed(directory, out)
+	return out.getvalue()
+
+
+def test_roundtrip(tmp_path):
+	data = os.urandom(3500)
+	assert spool.write(str(tmp_path), CHUNK, io.BytesIO(framed(data))) == 4
+	assert spool.status(str(tmp_path))['complete']
+	assert spooled(str(tmp_path)) == data
+
+
+def test_cut_short_is_not_complete(tmp_path):
+	data = os.urandom(3500)
+	with pytest.raises(Exception):
+		spool.write(str(tmp_path), CHUNK, io.BytesIO(framed(data, ok=False)))
+	status = spool.status(str(tmp_path))
+	assert not status['complete']
+	assert len(status['sums']) == 4
+	with pytest.raises(Exception):
+		spooled(str(tmp_path))
+
+
+def test_resume_sends_only_what_is_missing(tmp_path):
+	data = os.urandom(3500)
+	stream = framed(data[:2500], ok=False)
+	with pytest.raises(Exception):
+		spool.write(str(tmp_path), CHUNK, io.BytesIO(stream))
+	sums = spool.status(str(tmp_path))['sums']
+	# the last chunk was cut in half, so it goes again
+	stream = framed(data, sums)
+	assert spool.HEADER.unpack_from(stream)[0] == 2
+	assert len(stream) < 2000
+	spool.write(str(tmp_path), CHUNK, io.BytesIO(stream))
+	assert spooled(str(tmp_path)) == data
+
+
+def test_damaged_chunk_is_sent_again(tmp_path):
+	data = os.urandom(3500)
+	spool.write(str(tmp_path), CHUNK, io.BytesIO(framed(data)))
+	with open(tmp_path / '00000001.chunk', 'r+b') as f:
+		f.write(b'x')
+	with pytest.raises(Exception):
+		spooled(str(tmp_path))
+	assert len(spool.status(str(tmp_path))['sums']) == 1
+
+
+def test_command(tmp_path):
+	(tmp_path / 'spool').mkdir()
+	out = subprocess.check_output([sys.executable if x == 'python3' else x for x in spool.command('status', tmp_path / 'spool')])
+	assert b'"complete": false' in out
@@ -0,0 +1,60 @@
+"""Tests for `btrfsgit.ssh`, with a stub ssh that logs its arguments."""
+
+import os
+
+import pytest
+
+from btrfsgit.ssh import SshConnection
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch):
+	""" the argument lists the stub ssh got; it fails when STUB_SSH_FAIL is set """
+	log = tmp_path / 'calls'
+	ssh = tmp_path / 'ssh'
+	ssh.write_text(f'#!/bin/sh\necho "$*" >> {log}\n[ -z "$STUB_SSH_FAIL" ]\n')
+	ssh.chmod(0o755)
+	monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+	monkeypatch.delenv('STUB_SSH_FAIL', raising=False)
+	return lambda: log.read_text().splitlines() if log.exists() else []
+
+
+def test_options_go_after_the_executable(calls):
+	c = SshConnection('ssh -p 2222 user@host')
+	argv = c.argv()
+	control_path = 'ControlPath=' + os.path.join(c._dir, 'master')
+	assert argv == ['ssh', '-o', control_path, '-o', 'ControlMaster=no', '-p', '2222', 'user@host']
+	assert calls() == [f'-o {control_path} -o ControlMaster=yes -o ControlPersist=yes -f -N -p 2222 user@host']
+	# the master is started once
+	c.argv()
+	assert len(calls()) == 1
+	assert c.commands == 2
+	c.close()
+
+
+def test_no_control_path_when_the_master_fails(calls, monkeypatch):
+	monkeypatch.setenv('STUB_SSH_FAIL', '1')
+	c = SshConnection('ssh user@host')
+	assert c.argv() == ['ssh', 'user@host']
+	assert c._dir is None
+	assert len(calls()) == 1
+
+
+def test_without_multiplexing(calls):
+	c = SshConnection('ssh user@host', multiplex=False)
+	assert c.argv() == ['ssh', 'user@host']
+	assert calls() == []
+
+
+def test_close(calls):
+	c = SshConnection('ssh user@host')
+	c.argv()
+	dir = c._dir
+	assert os.path.isdir(dir)
+	c.close()
+	assert calls()[-1] == f'-o ControlPath={os.path.join(dir, "master")} -o ControlMaster=no -O exit user@host'
+	assert not os.path.exists(dir)
+	assert c._dir is None
+	# and only once
+	c.close()
+	assert len(calls()) == 2
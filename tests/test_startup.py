@@ -0,0 +1,14 @@
+"""importing bfg must stay cheap, see misc/bench_startup.py"""
+
+import subprocess
+import sys
+
+
+def test_import_leaves_heavy_modules_alone():
+	code = 'import sys, btrfsgit.btrfsgit; print(" ".join(m for m in ("sqlalchemy", "psycopg", "fire", "pathvalidate", "logging.config") if m in sys.modules))'
+	assert subprocess.check_output([sys.executable, '-c', code], text=True).strip() == ''
+
+
+def test_db_loads_on_first_use():
+	code = 'import sys, btrfsgit.btrfsgit as b; b.db.Snapshot; print("sqlalchemy" in sys.modules)'
+	assert subprocess.check_output([sys.executable, '-c', code], text=True).strip() == 'True'
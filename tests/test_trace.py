@@ -0,0 +1,66 @@
+"""Tests for `btrfsgit.trace`: spans, annotations, and the trace-event file."""
+
+import json
+import threading
+
+import pytest
+
+from btrfsgit import trace
+
+
+@pytest.fixture
+def on(monkeypatch, tmp_path):
+	monkeypatch.setattr(trace, '_events', [])
+	monkeypatch.setattr(trace, '_path', str(tmp_path / 'trace.json'))
+	return tmp_path / 'trace.json'
+
+
+def test_off_records_nothing():
+	assert not trace.enabled()
+	with trace.span('x', a=1) as sp:
+		sp['b'] = 2
+		trace.annotate(c=3)
+	assert trace._events is None
+
+
+def test_spans_and_annotations(on):
+	@trace.traced('work', 'cmd')
+	def work(n):
+		trace.annotate(bytes=n)
+		return n
+
+	with trace.span('outer', path=on) as sp:
+		assert work(5) == 5
+		sp['exit_code'] = 0
+	with pytest.raises(ValueError):
+		with trace.span('failing'):
+			raise ValueError('no')
+	t = threading.Thread(target=work, args=(7,), name='worker')
+	t.start()
+	t.join()
+
+	trace.write()
+	events = json.load(open(on))['traceEvents']
+	spans = {(e['name'], e['tid']): e for e in events if e['ph'] == 'X'}
+	main = threading.get_ident()
+	assert spans[('work', main)]['args'] == {'bytes': 5}
+	assert spans[('work', main)]['cat'] == 'cmd'
+	assert spans[('work', t.ident)]['args'] == {'bytes': 7}
+	outer = spans[('outer', main)]
+	assert outer['args'] == {'path': str(on), 'exit_code': 0}
+	assert outer['ts'] <= spans[('work', main)]['ts'] and outer['dur'] >= spans[('work', main)]['dur']
+	assert 'ValueError' in spans[('failing', main)]['args']['error']
+	assert ('run', threading.main_thread().ident) in spans
+	names = {e['tid']: e['args']['name'] for e in events if e['ph'] == 'M'}
+	assert names[main] == threading.current_thread().name
+	assert names[t.ident] == 'worker'
+
+
+def test_failing_command_has_its_exit_code(on):
+	from btrfsgit.btrfsgit import Bfg
+	b = Bfg(YES=True, LISTING_CACHE=False)
+	assert b._cmd(['sh', '-c', 'exit 3'], die_on_error=False) == -1
+	assert b._cmd(['echo', 'hi'], die_on_error=False) == 'hi\n'
+	failed, ok = [e['args'] for e in trace.events() if e['name'] == 'cmd']
+	assert failed['exit_code'] == 3 and 'CalledProcessError' in failed['error']
+	assert ok == dict(cmd='echo hi', exit_code=0, bytes=3)
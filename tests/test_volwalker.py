@@ -0,0 +1,109 @@
+"""Tests for the common parent search in `btrfsgit.volwalker`."""
+
+import random
+
+from btrfsgit.volwalker import LineageIndex, VolWalker
+
+
+def rec(local_uuid, parent_uuid=None, received_uuid=None, ro=True, machine='local', subvol_id=0):
+	return dict(local_uuid=local_uuid, parent_uuid=parent_uuid, received_uuid=received_uuid, ro=ro, machine=machine, subvol_id=subvol_id)
+
+
+def by_uuid(*records):
+	return {r['local_uuid']: r for r in records}
+
+
+def walk(records, my_uuid, direction=('local', 'remote')):
+	return [v['local_uuid'] for v in VolWalker(records, direction).walk(my_uuid)]
+
+
+def test_index_children_in_table_order():
+	records = by_uuid(
+		rec('data', ro=False),
+		rec('s1', 'data'),
+		rec('r1', 'x', 's1', machine='remote'),
+		rec('s2', 'data'),
+	)
+	index = LineageIndex(records)
+	assert list(index.children('data')) == ['s1', 's2']
+	assert index.by_received_uuid['s1'] == ['r1']
+	assert index.by_parent_uuid['x'] == ['r1']
+	assert list(index.children('nope')) == []
+
+
+def test_picks_newest_snapshot_that_made_it_to_remote():
+	records = by_uuid(
+		rec('data', ro=False, subvol_id=256),
+		rec('s1', 'data', subvol_id=257),
+		rec('s2', 'data', subvol_id=258),
+		rec('s3', 'data', subvol_id=259),
+		rec('r1', None, 's1', machine='remote', subvol_id=300),
+		rec('r2', 'r1', 's2', machine='remote', subvol_id=301),
+	)
+	assert walk(records, 'data') == ['s2', 's1']
+
+
+def test_nearer_relatives_first():
+	# data was checked out from a received snapshot p; p's own snapshot is further away than data's snapshot
+	records = by_uuid(
+		rec('p', subvol_id=260),
+		rec('data', 'p', ro=False, subvol_id=261),
+		rec('sp', 'p', subvol_id=262),
+		rec('sd', 'data', subvol_id=263),
+		rec('rsp', None, 'sp', machine='remote'),
+		rec('rsd', None, 'sd', machine='remote'),
+	)
+	assert walk(records, 'data') == ['sd', 'p', 'sp']
+
+
+def test_rw_snapshot_breaks_the_chain():
+	records = by_uuid(
+		rec('data', ro=False),
+		rec('rw', 'data', ro=False),
+		rec('s1', 'rw'),
+		rec('r1', None, 's1', machine='remote'),
+	)
+	assert walk(records, 'data') == []
+
+
+def test_each_candidate_once():
+	# r2 is reachable both through its parent_uuid and its received_uuid
+	records = by_uuid(
+		rec('data', ro=False, subvol_id=256),
+		rec('s1', 'data', subvol_id=257),
+		rec('s2', 's1', subvol_id=258),
+		rec('r1', None, 's1', machine='remote'),
+		rec('r2', 'r1', 's2', machine='remote'),
+	)
+	assert walk(records, 'data') == ['s1', 's2']
+
+
+def test_long_chain_does_not_recurse():
+	n = 20000
+	records = by_uuid(rec('s0', ro=False), *[rec(f's{i}', f's{i - 1}', subvol_id=i) for i in range(1, n)])
+	records['remote'] = rec('remote', None, f's{n - 1}', machine='remote')
+	result = walk(records, 's0')
+	assert len(result) == n - 1
+	assert result[0] == 's1'
+
+
+def test_walk_filesystems_matches_a_walk_per_filesystem():
+	rnd = random.Random(2)
+	for _ in range(300):
+		records = {}
+		for i in range(rnd.randint(1, 30)):
+			uuids = list(records)
+			parent_uuid = rnd.choice(uuids) if uuids and rnd.random() < 0.9 else None
+			received_uuid = rnd.choice(uuids) if uuids and rnd.random() < 0.4 else None
+			records[f'u{i}'] = dict(rec(f'u{i}', parent_uuid, received_uuid, ro=rnd.random() < 0.7, subvol_id=rnd.randint(256, 300)), fs_uuid=rnd.choice(['a', 'a', 'b', 'c']))
+		for my_uuid, me in records.items():
+			if me['fs_uuid'] != 'a':
+				continue
+			expected = {}
+			for fs in ('b', 'c'):
+				labeled = {k: dict(v, machine='local' if v['fs_uuid'] == 'a' else 'remote' if v['fs_uuid'] == fs else 'other') for k, v in records.items()}
+				candidates = walk(labeled, my_uuid)
+				if candidates:
+					expected[fs] = candidates
+			result = VolWalker(records).walk_filesystems(my_uuid, 'a')
+			assert {fs: [v['local_uuid'] for v in c] for fs, c in result.items()} == expected